@@ -3,6 +3,7 @@
     编译器集群注册器
     提供一个注册与查询的服务接口
 """
+import json
 import logging
 import threading
 import time
@@ -18,19 +19,21 @@ FLASK_APP = Flask(__name__)
 logging.basicConfig(level=logging.NOTSET, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 LOGGER = logging.getLogger(__name__)
 
-ONLINE_LIST = set()
+# 在线的设备，由设备地址映射到设备上报的信息
+ONLINE_LIST = dict()
 DATA_LOCK = threading.Lock()
 
 
-def add_dev(addr):
+def add_dev(addr, info=None):
     """
         添加在线设备
     :param addr:
+    :param info: 设备上报的信息，例如CPU数量、任务上限、队列深度、工具链指纹
     :return:
     """
     try:
         with DATA_LOCK:
-            ONLINE_LIST.add(addr)
+            ONLINE_LIST[addr] = dict(info or {}, addr=addr, heartbeat=time.time())
     except Exception:
         pass
 
@@ -43,7 +46,7 @@ def rm_dev(addr):
     """
     try:
         with DATA_LOCK:
-            ONLINE_LIST.remove(addr)
+            del ONLINE_LIST[addr]
     except Exception:
         pass
 
@@ -72,7 +75,14 @@ def online():
     user_addr = request.remote_addr
     # 我们需要进行反向测试客户端是否提供了编译器服务
     if is_online(user_addr):
-        add_dev(user_addr)
+        # 记录设备随心跳上报的信息，旧版本的设备不会上报，记录为None
+        add_dev(user_addr, {
+            "cpu": request.values.get("cpu", type=int),
+            "task_max": request.values.get("task_max", type=int),
+            "count": request.values.get("count", type=int),
+            "queue": request.values.get("queue", type=int),
+            "toolchain": request.values.get("toolchain"),
+        })
         return "yes"
     else:
         try:
@@ -101,9 +111,14 @@ def offline():
 def getlist():
     """
         获取当前在线的设备列表
+        默认返回以逗号分隔的地址列表，
+        format=json 时返回所有设备的详细信息，客户端可以直接据此进行调度
     :return:
     """
-    return ','.join(ONLINE_LIST)
+    with DATA_LOCK:
+        if request.values.get("format") == "json":
+            return json.dumps(list(ONLINE_LIST.values()))
+        return ','.join(ONLINE_LIST.keys())
 
 
 def run_check():
@@ -839,7 +839,7 @@ class FactoryGUI(Tk):
         typ_for_database = icopy_maps.get_device_type_str(infos['type'])
         if typ_for_database is None:
             raise Exception("make_ipk_for_infos异常，无法将数据库中的版本码信息对应到设备类型字符串。")
-        return make_impl.make_ipk_for_infos(typ_for_database, infos)
+        return make_impl.make_ipk_for_infos(typ_for_database, infos, make_impl.print_progress)
 
     @staticmethod
     def delete_ipk_for_path(path):
@@ -1156,6 +1156,7 @@ class MainGui:
             file = make_impl.make_ipk_for_infos(
                 icopy_maps.get_device_type_str(infos["type"]),
                 infos,
+                make_impl.print_progress,
             )
 
             if file is None:
@@ -60,6 +60,9 @@ class OTAGui:
             self.action_set_wait_list_no_sn = "otasys/set_wait_list_sn_state.php"
             self.action_rm_toofar_history = "otasys/rm_toofar_history.php"
 
+        # 任务的HASH到构建进度（百分比）的映射
+        self.task_progress = dict()
+
         # 即将被处理的任务
         self.list_wait_task = []
         # 正在进行处理的任务
@@ -162,7 +165,7 @@ class OTAGui:
             for task_item in self.list_wait_task:
                 json_ret.append({
                     "hash": task_item['HASH'],
-                    "progress": 0,  # TODO 后期可以添加进度跟踪，目前不想做
+                    "progress": self.task_progress.get(task_item['HASH'], 0),
                 })
         # print("列表2中的数据", json_ret)
         # print("正在处理中的数据", self.list_run_task)
@@ -320,16 +323,22 @@ class OTAGui:
             time.sleep(1)
             # print("")
 
-    def make_ipk_for_sn(self, sn):
+    def make_ipk_for_sn(self, sn, code=None):
         """
             构建SN
         :param sn:
+        :param code: 任务的HASH，提供时跟踪构建进度
         :return:
         """
         infos = data_control.get_row_from_database_for_sn(sn)
+
+        def on_progress(progress):
+            self.task_progress[code] = progress['percent']
+
         return make_impl.make_ipk_for_infos(
             icopy_maps.get_device_type_str(infos["type"]),
             infos,
+            None if code is None else on_progress,
         )
 
     @staticmethod
@@ -367,7 +376,7 @@ class OTAGui:
                 code = task_item['HASH']
 
                 # 然后我们需要开始构建
-                ipk = self.make_ipk_for_sn(sn)
+                ipk = self.make_ipk_for_sn(sn, code)
                 if ipk is None:
                     self.notify_task_finish(code, 2)
                 else:
@@ -388,6 +397,7 @@ class OTAGui:
                 with self.lock_wait_list:
                     # 任务完成后后从待处理列表移除任务
                     self.list_wait_task.remove(task_item)
+                    self.task_progress.pop(code, None)
                     # for index in range(len(self.list_wait_task)):
                     #     item_in_list = self.list_wait_task[index]
                     #     if self.is_same_item(task_item, item_in_list):
@@ -1,3 +1,4 @@
+import json
 import re
 import time
 
@@ -7,10 +8,19 @@ import icopy_maps
 # 定义一个包构建器的设备的IP地址
 IP_PACKAGER_ADDR = "127.0.0.1"
 
+# 单次阻塞等待打包任务完成的时间(s)
+PACKAGER_WAIT_TIMEOUT = 30
 
-def get_packager_resp(addr, url, str_resp=True, method="", params=None):
+# 需要跟踪进度时，单次阻塞等待进度变化的时间(s)
+PACKAGER_PROGRESS_TIMEOUT = 5
+# 进度回调的最小间隔(s)
+PACKAGER_PROGRESS_INTERVAL = 0.5
+
+
+def get_packager_resp(addr, url, str_resp=True, method="", params=None, timeout=(8, 21)):
     """
         获取来自打包服务器的回复
+    :param timeout: 请求超时
     :param params: 请求的附带参数
     :param method: 请求方法
     :param addr: 服务器地址
@@ -18,14 +28,49 @@ def get_packager_resp(addr, url, str_resp=True, method="", params=None):
     :param str_resp: 是否以文本形式的返回
     :return:
     """
-    return generator_utils.get_server_resp(f"http://{addr}:7878/{url}", str_resp, method, params)
+    return generator_utils.get_server_resp(f"http://{addr}:7878/{url}", str_resp, method, params, timeout)
+
+
+def get_packager_progress(code, version=None):
+    """
+        获取打包任务的构建进度
+    :param code: 任务码
+    :param version: 已知的进度版本，提供时阻塞等待进度变化
+    :return: 进度信息，服务器不支持查询进度时返回None
+    """
+    url = f"progress?code={code}"
+    timeout = (8, 21)
+    if version is not None:
+        url += f"&version={version}&timeout={PACKAGER_PROGRESS_TIMEOUT}"
+        timeout = (8, PACKAGER_PROGRESS_TIMEOUT + 8)
+    try:
+        return json.loads(get_packager_resp(IP_PACKAGER_ADDR, url, timeout=timeout))
+    except Exception:
+        return None
+
+
+def print_progress(progress):
+    """
+        打印构建进度
+    :param progress: 进度信息
+    :return:
+    """
+    if progress.get('position') is not None:
+        print(f"打包任务排队中，前面还有 {progress['position']} 个任务。")
+        return
+    stages = ", ".join(
+        f"{name}: {info['done']}/{info['total']}" if info['total'] > 0 else f"{name}: {info['state']}"
+        for name, info in progress['stages'].items() if info['state'] in ("running", "done")
+    )
+    print(f"打包进度: {progress['percent']}% ({stages})")
 
 
-def make_ipk_for_infos(typ, infos):
+def make_ipk_for_infos(typ, infos, on_progress=None):
     """
         使用信息进行固件制作
     :param typ:
     :param infos:
+    :param on_progress: 进度回调，参数为打包服务器返回的进度信息，为None时不跟踪进度
     :return:
     """
     if infos is None:
@@ -61,12 +106,32 @@ def make_ipk_for_infos(typ, infos):
         return None
 
     unknown_retry = 5
+    # 优先使用阻塞等待的接口，服务器不支持的时候退回到轮询
+    use_wait = True
+
+    # 需要跟踪进度时，阻塞等待进度变化，任务结束后再确认任务状态
+    if on_progress is not None:
+        progress = get_packager_progress(uuid)
+        while progress is not None:
+            on_progress(progress)
+            if progress['state'] in ("done", "failed"):
+                break
+            # 进度变化很频繁，限制回调的频率
+            time.sleep(PACKAGER_PROGRESS_INTERVAL)
+            progress = get_packager_progress(uuid, progress['version'])
 
     # 运行到这里说明uuid正常，任务开始了，开始询问任务运行的咋样了
     while True:
         # 不断询问是否运行完成
         try:
-            res = get_packager_resp(IP_PACKAGER_ADDR, f"ok?code={uuid}")
+            if use_wait:
+                res = get_packager_resp(
+                    IP_PACKAGER_ADDR,
+                    f"wait?code={uuid}&timeout={PACKAGER_WAIT_TIMEOUT}",
+                    timeout=(8, PACKAGER_WAIT_TIMEOUT + 8)
+                )
+            else:
+                res = get_packager_resp(IP_PACKAGER_ADDR, f"ok?code={uuid}")
         except Exception as e:
             print("询问是否运行(编译）完成时网络出现异常:", e)
             return None
@@ -91,8 +156,12 @@ def make_ipk_for_infos(typ, infos):
             # True 说明文件已经编译运行完成
             break
         elif res == "False":
-            # False 说明文件已经编译运行尚未完成
-            time.sleep(1)
+            # False 说明文件已经编译运行尚未完成，阻塞等待超时的时候直接再次等待
+            if not use_wait:
+                time.sleep(1)
+        elif use_wait:
+            print("打包服务器不支持阻塞等待，将自动轮询任务是否完成。")
+            use_wait = False
         else:
             print("询问任务完成时得到了未知错误，内容为:", res)
             return None
@@ -7,9 +7,134 @@ import base64
 import os
 import hashlib
 import re
+import threading
+from collections import OrderedDict
 
 from Crypto.Cipher import AES
 
+# 编译好的代码转换计划，每个生成器类（以及开关组合）只编译一次
+TRANSFORM_PLAN_LOCK = threading.RLock()
+TRANSFORM_PLAN_CACHE = dict()
+
+# 代码生成结果的缓存，键为（生成器类、开关组合、文件名、源码哈希、读取到的bundle键值）
+# 大部分文件的生成结果与bundle无关，不同SN的设备重复打包时可以直接复用
+GEN_MEMO_LOCK = threading.RLock()
+GEN_MEMO_CACHE = OrderedDict()
+# 每个源码对应的已缓存的bundle依赖（读取的键的元组）以及缓存的结果数量
+GEN_MEMO_DEPENDS = dict()
+# 最多缓存的生成结果数量，超过后淘汰最久没有使用的结果
+GEN_MEMO_MAX = 2048
+GEN_MEMO_STATS = {"hit": 0, "miss": 0}
+
+# 当前线程正在记录的bundle读取，生成代码的任务是在线程池中并发执行的
+BUNDLE_READS = threading.local()
+# bundle中不存在该键时的占位
+BUNDLE_MISSING = "<missing>"
+
+
+class TransformPlan:
+    """
+        代码转换计划
+        先关闭print（替换为pass占位符），再关闭debug（删除代码段），输出与逐个正则转换的旧实现逐字节一致；
+        正则只编译一次，源码中没有print或者debug标记时跳过对应的扫描，大部分源码不需要任何正则扫描
+    """
+
+    # 关闭debug的正则，匹配到的代码段包括前面的空白
+    # 测试开始 <
+    #     代码段
+    # 测试结束 >
+    REGEX_DEBUG = re.compile(r'\s*?# 测试开始 <[\s\S]*?# 测试结束 >')
+    DEBUG_MARK = "# 测试开始 <"
+    # 关闭print的正则
+    REGEX_PRINT = re.compile(r'(?<= )print\(.*\)')
+    PRINT_MARK = " print("
+
+    def __init__(self, close_print, close_debug):
+        self.close_print = close_print
+        self.close_debug = close_debug
+
+    def apply(self, content: str):
+        """
+            执行所有的转换
+        :param content:
+        :return:
+        """
+        if self.close_print and self.PRINT_MARK in content:
+            content = self.REGEX_PRINT.sub("pass", content)
+        if self.close_debug and self.DEBUG_MARK in content:
+            # 以文本替换删除每一个代码段（包括其他位置相同的文本），与旧实现保持一致，
+            # 相同内容的代码段前面的空白不同时，先替换较短的代码段会留下较长的代码段前面多出的空白
+            for debug_code in self.REGEX_DEBUG.findall(content):
+                content = content.replace(debug_code, "")
+        return content
+
+
+class AttrCollector:
+    """
+        变量值的收集器
+        传给生成变量的函数代替源码，收集所有需要设置的变量，最后一次扫描全部设置
+    """
+
+    def __init__(self):
+        self.kvs = dict()
+
+    def add(self, attr, value):
+        # 同一个变量设置多次时，以最后一次为准
+        self.kvs.pop(attr, None)
+        self.kvs[attr] = value
+
+
+class RecordingBundle(dict):
+    """
+        会记录读取行为的bundle
+        只有当前线程正在记录时（代码生成过程中）才会记录读取的键，
+        其他地方的读取与普通的dict无异
+    """
+
+    def record(self, key):
+        keys = getattr(BUNDLE_READS, "keys", None)
+        if keys is not None:
+            keys.add(key)
+
+    def __getitem__(self, key):
+        self.record(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.record(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self.record(key)
+        return super().get(key, default)
+
+    def depends(self, keys):
+        """
+            获取指定的键的当前值，不会被记录
+        :param keys:
+        :return: 排好序的(键, 值)元组
+        """
+        return tuple((key, dict.get(self, key, BUNDLE_MISSING)) for key in sorted(keys))
+
+
+def get_memo_stats():
+    """
+        获取代码生成结果缓存的统计信息
+    :return:
+    """
+    with GEN_MEMO_LOCK:
+        return dict(GEN_MEMO_STATS, size=len(GEN_MEMO_CACHE), max=GEN_MEMO_MAX)
+
+
+def clear_memo():
+    """
+        清空代码生成结果缓存
+    :return:
+    """
+    with GEN_MEMO_LOCK:
+        GEN_MEMO_CACHE.clear()
+        GEN_MEMO_DEPENDS.clear()
+
 
 class AppGenerator:
     """
@@ -24,6 +149,8 @@ class AppGenerator:
         self.close_print = True
         # 是否关闭所有的debug代码块
         self.close_debug = True
+        # 是否缓存生成结果，注意：生成函数的结果只允许依赖源码与bundle
+        self.memo_enable = True
         # 生成一个白名单文件列表
         # 只允许此列表中的文件被编译打包进最终的ipk中
         self.maps = self.onGetGenFileMap()
@@ -54,6 +181,10 @@ class AppGenerator:
             value = '"{}"'.format(value)
         else:
             value = '{}'.format(value)
+        if isinstance(content, AttrCollector):
+            # 只收集，稍后由 genAttrKVs 一次设置
+            content.add(attr, value)
+            return content
         sea_obj = re.search(regex, content)
         if sea_obj is None:
             return content
@@ -62,45 +193,41 @@ class AppGenerator:
         return content.replace(sea_obj.group(1), value)
 
     @staticmethod
-    def checkBundle(obj):
-        if obj is None:
-            raise Exception("不允许开发者提供空的键值对。")
-
-    @staticmethod
-    def printClose(content: str):
+    def genAttrKVs(content: str, kvs):
         """
-            关闭print，替换为pass占位符
+            一次扫描设置多个变量的值，结果与逐个调用 genAttrKV 一致：
+            每个变量以第一次出现的行为准，替换所有与该行相同的内容
+        :param content:
+        :param kvs: 变量名到已经格式化的值的映射
         :return:
         """
-        regex = r'(?<= )print\(.*\)'
-        return re.sub(regex, "pass", content)
+        if len(kvs) == 0:
+            return content
+        regex = re.compile(r'({}).*?=.*'.format("|".join(map(re.escape, kvs.keys()))))
+        found = dict()
+
+        def replace(match):
+            attr = match.group(1)
+            line = found.setdefault(attr, match.group(0))
+            if line != match.group(0):
+                # 与第一次出现的行不同的，保持原样
+                return match.group(0)
+            return attr + ' = ' + kvs[attr]
+
+        return regex.sub(replace, content)
 
     @staticmethod
-    def debugClose(content: str):
-        """
-            关闭debug，删除Debug语句
-            # 测试开始 <
-                代码段
-            # 测试结束 >
-        :param content:
-        :return:
-        """
-        regex = r'\s*?# 测试开始 <[\s\S]*?# 测试结束 >'
-        debug_codes = re.findall(regex, content)
-        for index, debug_code in enumerate(debug_codes):
-            # print("\n\n************ 删除Debug语句（清空代码段！）************ ")
-            # print("被删除的计数:", index + 1)
-            # print("被删除的文本:")
-            content = content.replace(debug_code, "")
-            # print(debug_code)
-            # print("\n*******************  删除完成 **********************\n\n")
-        return content
+    def checkBundle(obj):
+        if obj is None:
+            raise Exception("不允许开发者提供空的键值对。")
 
-    def onGenerator(self, name, content):
+    def onGenerator(self, name, content, prepared=False, digest=None):
         """
             生成代码
         :param content:
         :param name:
+        :param prepared: 源码是否已经在预处理阶段关闭了print与debug，为True时只执行设备相关的处理函数
+        :param digest: 源码的sha256摘要，预处理阶段已经计算过的话直接使用，为None时重新计算
         :return: 生成的最终的代码
         """
         name = os.path.basename(name)
@@ -109,17 +236,83 @@ class AppGenerator:
         if name not in self.maps:
             # print("文件: ", name, "不允许被生成，自动忽略。")
             return None
-        # 先关闭print打印
-        if self.close_print:
-            content = self.printClose(content)
-        if self.close_debug:
-            # 然后关闭debug逻辑
-            content = self.debugClose(content)
+        if not self.memo_enable:
+            return self.onGeneratorImpl(name, content, prepared)
+        bundle = getattr(self, "bundle", None)
+        if not isinstance(bundle, RecordingBundle):
+            bundle = RecordingBundle()
+        if digest is None:
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        src_key = (type(self), self.close_print, self.close_debug, prepared, name, digest)
+        # 先查找缓存，只要之前生成时读取到的bundle键值与当前的一致，就可以直接复用
+        with GEN_MEMO_LOCK:
+            for keys in GEN_MEMO_DEPENDS.get(src_key, {}).keys():
+                memo_key = (src_key, bundle.depends(keys))
+                if memo_key in GEN_MEMO_CACHE:
+                    GEN_MEMO_CACHE.move_to_end(memo_key)
+                    GEN_MEMO_STATS["hit"] += 1
+                    return GEN_MEMO_CACHE[memo_key]
+            GEN_MEMO_STATS["miss"] += 1
+        # 缓存没有命中，生成的同时记录读取了哪些bundle的键
+        BUNDLE_READS.keys = set()
+        try:
+            result = self.onGeneratorImpl(name, content, prepared)
+            keys = tuple(sorted(BUNDLE_READS.keys))
+        finally:
+            BUNDLE_READS.keys = None
+        memo_key = (src_key, bundle.depends(keys))
+        try:
+            hash(memo_key)
+        except TypeError:
+            # bundle中的值无法作为键使用，不缓存
+            return result
+        with GEN_MEMO_LOCK:
+            if memo_key not in GEN_MEMO_CACHE:
+                depends = GEN_MEMO_DEPENDS.setdefault(src_key, dict())
+                depends[keys] = depends.get(keys, 0) + 1
+            GEN_MEMO_CACHE[memo_key] = result
+            GEN_MEMO_CACHE.move_to_end(memo_key)
+            while len(GEN_MEMO_CACHE) > GEN_MEMO_MAX:
+                (old_src_key, old_values), _ = GEN_MEMO_CACHE.popitem(last=False)
+                old_keys = tuple(key for key, _ in old_values)
+                # 同一个源码的同一组键已经没有缓存的值时，删除依赖记录
+                depends = GEN_MEMO_DEPENDS[old_src_key]
+                depends[old_keys] -= 1
+                if depends[old_keys] == 0:
+                    depends.pop(old_keys)
+                if len(depends) == 0:
+                    GEN_MEMO_DEPENDS.pop(old_src_key)
+        return result
+
+    def onGeneratorImpl(self, name, content, prepared=False):
+        """
+            生成代码的实际实现，不经过缓存
+        :param name: 文件名（不含路径）
+        :param content:
+        :param prepared: 源码是否已经预处理
+        :return:
+        """
+        if not prepared:
+            # 关闭print打印与debug逻辑
+            content = self.getTransformPlan().apply(content)
         if self.maps[name] is None:
             # 如果没有实现内容处理函数，就直接返回源内容
             return content
         return self.maps[name](content)
 
+    def getTransformPlan(self):
+        """
+            获取当前生成器类的代码转换计划，第一次使用时编译
+        :return:
+        """
+        key = (type(self), self.close_print, self.close_debug)
+        with TRANSFORM_PLAN_LOCK:
+            plan = TRANSFORM_PLAN_CACHE.get(key)
+            if plan is None:
+                plan = TransformPlan(self.close_print, self.close_debug)
+                TRANSFORM_PLAN_CACHE[key] = plan
+        return plan
+
     def onAppGenStart(self, app_path):
         """
             在APP开始打包的时候回调
@@ -161,7 +354,8 @@ class ICopyGenerator(AppGenerator):
         :param bundle: 生成代码的时候需要的数据
                         注意，某些代码生成可能并不需要数据
         """
-        self.bundle = bundle
+        # 记录生成代码时读取了哪些数据，用于缓存生成结果
+        self.bundle = RecordingBundle(bundle)
         super().__init__()
 
     def getTypeName(self):
@@ -340,10 +534,12 @@ class ICopyGenerator(AppGenerator):
         :param content:
         :return:
         """
-        content = self.genSN(content)
-        content = self.genVer(content)
-        content = self.genHW(content)
-        content = self.genPM3(content)
-        content = self.genTYP(content)
-        content = self.genUID(content)
-        return content
+        # 先收集所有需要设置的变量，再一次扫描全部设置
+        collector = AttrCollector()
+        collector = self.genSN(collector)
+        collector = self.genVer(collector)
+        collector = self.genHW(collector)
+        collector = self.genPM3(collector)
+        collector = self.genTYP(collector)
+        collector = self.genUID(collector)
+        return self.genAttrKVs(content, collector.kvs)
@@ -1,23 +1,251 @@
+import asyncio
+import functools
+import hashlib
+import io
 import json
 import os
 import logging
+import re
+import shutil
+import threading
 import time
+import types
 import uuid
 import zipfile
+import abs_generator
 import generator_utils
 
+from ipk_writer import IpkWriter, get_manifest_file, load_manifest
+
 import concurrent.futures
 from concurrent.futures.thread import ThreadPoolExecutor
 
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import NamedTemporaryFile
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 LOGGER = logging.getLogger(__name__)
 
+# 基础包的构建锁，同一个基础包同时只允许一个任务进行构建
+BASE_PKG_LOCK = threading.RLock()
+BASE_PKG_LOCK_MAP = dict()
+
+# 编译服务器的工具链指纹的缓存，由服务器地址映射到 (指纹, 获取的时间)
+COMPILER_TOOLCHAIN_LOCK = threading.RLock()
+COMPILER_TOOLCHAIN_MAP = dict()
+# 工具链指纹缓存的有效时间(s)
+COMPILER_TOOLCHAIN_TTL = 60
+
+# 单次阻塞等待编译任务完成的时间(s)
+COMPILER_WAIT_TIMEOUT = 30
+
+# 编译失败后换一个服务器重试的次数
+COMPILER_RETRY_MAX = 2
+
+# 异步编排时每个编译服务器同时进行的传输请求数（查询、上传与下载）
+COMPILER_NODE_CONCURRENCY = 8
+# 异步编排时每个编译服务器同时进行的阻塞等待编译完成的请求数，与传输请求分开限制，
+# 长时间挂起的等待请求不会占用上传与下载的名额
+COMPILER_NODE_WAIT_CONCURRENCY = 32
+# 构建失败时通知编译服务器取消任务的请求超时(s)
+COMPILER_CANCEL_TIMEOUT = 5
+# 同一个服务器上完成的运行库合并为一次批量下载，第一个完成的任务等待此时间(s)收集其他完成的任务
+COMPILER_DOWNLOAD_BATCH_DELAY = 0.05
+# 所有编排器共用的执行阻塞请求的线程池，不能设置为事件循环的默认线程池，关闭事件循环时会将其一起关闭
+COMPILER_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix="orchestrator_")
+# 所有编排器共用的执行阻塞等待编译完成的请求的线程池
+COMPILER_WAIT_EXECUTOR = ThreadPoolExecutor(max_workers=256, thread_name_prefix="orchestrator_wait_")
+
+# 当前提交的预处理源码树，在合并新的提交后重新制作，任务中只读
+PREPARED_TREE = None
+
+
+class BuildProgress:
+    """
+        构建进度，记录构建各个阶段的进度以及编译服务器的分配情况
+        构建线程更新进度，查询线程可以阻塞等待进度变化
+    """
+
+    # 构建的阶段以及在总进度中的权重
+    STAGES = (
+        ("copy", 5),  # 复制标准包或者基础包
+        ("base", 10),  # 制作基础包（基础包已经存在时跳过）
+        ("codegen", 10),  # 生成代码
+        ("compile", 55),  # 编译运行库
+        ("package", 5),  # 将运行库写入ipk
+        ("firmware", 5),  # 将固件写入ipk（使用基础包时跳过）
+        ("manifest", 10),  # 写入信息表并且完成ipk
+    )
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # 进度每次变化时递增，用于等待进度变化
+        self.version = 0
+        self.state = "pending"
+        self.error = None
+        self.start_time = None
+        self.end_time = None
+        self.cached = False
+        self.stages = {
+            name: {"state": "pending", "done": 0, "total": 0, "time": None, "start": None}
+            for name, _ in self.STAGES
+        }
+        # 编译服务器地址到分配的源文件数量的映射
+        self.nodes = dict()
+        # 阶段会多次开始（总数累加），记录已经报告过的最大进度，保证进度不回退
+        self.percent = 0
+
+    def changed(self):
+        self.version += 1
+        self.cond.notify_all()
+
+    def begin(self, stage, total=0):
+        """
+            开始一个阶段，阶段可以多次开始（例如分多个目录编译），总数累加
+        :param stage: 阶段名称
+        :param total: 该阶段需要处理的数量
+        :return:
+        """
+        with self.cond:
+            if self.state == "pending":
+                self.state = "running"
+                self.start_time = time.time()
+            info = self.stages[stage]
+            if info['state'] != "running":
+                info['state'] = "running"
+                info['start'] = time.time()
+            info['total'] += total
+            self.changed()
+
+    def step(self, stage, count=1):
+        """
+            阶段中完成了一些处理
+        :param stage:
+        :param count:
+        :return:
+        """
+        with self.cond:
+            self.stages[stage]['done'] += count
+            self.changed()
+
+    def end(self, stage):
+        """
+            结束一个阶段，累计该阶段的耗时，没有开始的阶段保持不变
+        :param stage:
+        :return:
+        """
+        with self.cond:
+            info = self.stages[stage]
+            if info['state'] == "running":
+                info['time'] = (info['time'] or 0) + time.time() - info['start']
+                info['state'] = "done"
+                self.changed()
+
+    def assign(self, addr, count):
+        """
+            记录分配给编译服务器的源文件数量
+        :param addr: 编译服务器地址
+        :param count:
+        :return:
+        """
+        with self.cond:
+            node = self.nodes.setdefault(addr, {"assigned": 0, "done": 0, "failed": 0})
+            node['assigned'] += count
+            self.changed()
+
+    def node_done(self, addr, done, failed):
+        """
+            记录编译服务器完成的源文件数量
+        :param addr: 编译服务器地址
+        :param done: 编译成功的数量
+        :param failed: 编译失败的数量
+        :return:
+        """
+        with self.cond:
+            node = self.nodes.setdefault(addr, {"assigned": 0, "done": 0, "failed": 0})
+            node['done'] += done
+            node['failed'] += failed
+            self.stages['compile']['done'] += done
+            self.changed()
+
+    def finish(self, success, error=None, cached=False):
+        """
+            构建结束，没有执行的阶段标记为跳过
+        :param success: 是否构建成功
+        :param error: 失败的原因
+        :param cached: 是否直接使用了缓存的构建结果
+        :return:
+        """
+        with self.cond:
+            for info in self.stages.values():
+                if info['state'] == "pending":
+                    info['state'] = "skipped"
+                elif info['state'] == "running":
+                    info['time'] = (info['time'] or 0) + time.time() - info['start']
+                    info['state'] = "done" if success else "failed"
+            self.state = "done" if success else "failed"
+            self.error = error
+            self.cached = cached
+            self.end_time = time.time()
+            self.changed()
+
+    def is_finished(self):
+        with self.cond:
+            return self.state in ("done", "failed")
+
+    def get_percent(self):
+        """
+            根据各个阶段的权重计算总的进度百分比
+        :return:
+        """
+        total = sum(weight for _, weight in self.STAGES)
+        value = 0
+        for name, weight in self.STAGES:
+            info = self.stages[name]
+            if info['state'] == "done" or (info['state'] == "skipped" and self.state == "done"):
+                value += weight
+            elif info['state'] == "running" and info['total'] > 0:
+                value += weight * min(info['done'], info['total']) / info['total']
+        percent = int(value * 100 / total)
+        if self.state != "failed":
+            self.percent = max(self.percent, percent)
+            return self.percent
+        return percent
+
+    def to_dict(self):
+        """
+            导出进度，用于序列化为json
+        :return:
+        """
+        with self.cond:
+            now = self.end_time or time.time()
+            return {
+                "version": self.version,
+                "state": self.state,
+                "error": self.error,
+                "cached": self.cached,
+                "percent": self.get_percent(),
+                "time": None if self.start_time is None else now - self.start_time,
+                "stages": {
+                    name: {k: v for k, v in self.stages[name].items() if k != "start"} for name, _ in self.STAGES
+                },
+                "nodes": {addr: dict(node) for addr, node in self.nodes.items()},
+            }
+
+    def wait_change(self, version, timeout):
+        """
+            阻塞等待进度变化
+        :param version: 已知的进度版本
+        :param timeout: 超时(s)
+        :return: 进度是否已经变化
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.version != version, timeout)
 
-def get_compiler_resp(addr, url, str_resp=True, method="", params=None):
+
+def get_compiler_resp(addr, url, str_resp=True, method="", params=None, timeout=(8, 21)):
     """
         获取来自编译服务器的回复
+    :param timeout: 请求超时
     :param params: 请求的附带参数
     :param method: 请求方法
     :param addr: 服务器地址
@@ -25,7 +253,7 @@ def get_compiler_resp(addr, url, str_resp=True, method="", params=None):
     :param str_resp: 是否以文本形式的返回
     :return:
     """
-    return generator_utils.get_server_resp(f"http://{addr}:5858/{url}", str_resp, method, params)
+    return generator_utils.get_server_resp(f"http://{addr}:5858/{url}", str_resp, method, params, timeout)
 
 
 def is_ipv4_addr(ip_addr: str):
@@ -37,175 +265,877 @@ def is_ipv4_addr(ip_addr: str):
     return True if [1] * 4 == [x.isdigit() and 0 <= int(x) <= 255 for x in ip_addr.split(".")] else False
 
 
-def get_compiler_list():
+def get_compiler_infos():
+    """
+        获取在线的编译器的列表，以及编译器随心跳上报到网域控制器的信息
+    :return: 服务器地址 -> 服务器信息，旧版本的网域控制器不提供信息，服务器信息为空字典
     """
-        获取在线的编译器的列表
+    resp: str = generator_utils.get_server_resp("http://127.0.0.1:6868/getlist?format=json")
+    try:
+        infos = json.loads(resp)
+    except ValueError:
+        infos = None
+
+    if not isinstance(infos, list):
+        # 旧版本的网域控制器只会返回逗号分隔的地址列表
+        return {addr: {} for addr in resp.split(',') if is_ipv4_addr(addr)}
+
+    return {
+        info['addr']: info for info in infos if isinstance(info, dict) and is_ipv4_addr(info.get('addr', ""))
+    }
+
+
+def get_md5_for_data(data):
+    """
+        计算一段数据的MD5
+    :param data: 数据
     :return:
     """
-    # print("开始请求获取当前的在线的编译服务器的列表......")
-    # 我们需要请求网域控制器，查询当前可以用来编译的服务器
-    resp: str = generator_utils.get_server_resp("http://127.0.0.1:6868/getlist")
-    # LOGGER.info(f"服务器列表请求结果 {resp}")
-    compiler_list = []
-    for addr in resp.split(','):
-        if is_ipv4_addr(addr):
-            compiler_list.append(addr)
+    return hashlib.md5(data).hexdigest()
+
+
+def get_compiler_toolchain(addr):
+    """
+        获取编译服务器的工具链指纹，在有效时间内使用本地缓存
+    :param addr: 服务器地址
+    :return: 工具链指纹，获取失败或者服务器不支持时返回None
+    """
+    with COMPILER_TOOLCHAIN_LOCK:
+        cached = COMPILER_TOOLCHAIN_MAP.get(addr)
+        if cached is not None and time.time() - cached[1] < COMPILER_TOOLCHAIN_TTL:
+            return cached[0]
+
+    try:
+        toolchain = get_compiler_resp(addr, "toolchain").strip()
+    except Exception as e:
+        LOGGER.error(f"获取编译服务器的工具链指纹失败: {e}")
+        return None
 
-    return compiler_list
+    # 旧版本的服务器没有此接口，返回的不会是MD5
+    if re.fullmatch(r"[0-9a-f]{32}", toolchain) is None:
+        toolchain = None
 
+    set_compiler_toolchain(addr, toolchain)
+    return toolchain
 
-def build_2lib(source, so_target_path):
+
+def set_compiler_toolchain(addr, toolchain):
     """
-        内部构建实现
+        记录由网域控制器得到的编译服务器的工具链指纹，省去单独的查询
+    :param addr: 服务器地址
+    :param toolchain: 工具链指纹
     :return:
     """
+    with COMPILER_TOOLCHAIN_LOCK:
+        COMPILER_TOOLCHAIN_MAP[addr] = (toolchain, time.time())
 
+
+def has_compiled(addr, codes):
+    """
+        以源码的MD5一次性向编译服务器查询已经编译好的运行库
+        工具链指纹通常已经由网域控制器的心跳信息缓存，不需要单独查询
+    :param addr: 服务器地址
+    :param codes: 源码的MD5列表
+    :return: 服务器上已经存在的运行库的MD5集合，服务器不支持查询时为空
+    """
+    toolchain = get_compiler_toolchain(addr)
+    if toolchain is None:
+        return set()
+    resp = get_compiler_resp(addr, "has", method="post", params={"codes": ",".join(codes), "tc": toolchain})
     try:
-        while True:  # 寻找已注册的空闲的服务器并且发起任务
-            exit_loop = False
-            task_addr = None
-            md5_code = None
-            compiler_list = get_compiler_list()
+        return set(json.loads(resp))
+    except ValueError:
+        # 旧版本的服务器不支持批量查询
+        return set()
 
-            if len(compiler_list) == 0:
-                raise Exception("没有发现在线的编译服务器！！！")
 
-            # 迭代所有的服务器，申请创建任务
-            for addr in compiler_list:
-                try:
-                    # 先判断是否繁忙
-                    busy_test = get_compiler_resp(addr, "busy")
-                    if busy_test == "yes" or busy_test == "True":
-                        continue
+class CompileError(Exception):
+    """
+        源码在编译服务器上编译出错，换一个服务器重试也不会成功
+    """
 
-                    # 不繁忙的情况下，我们需要申请进行编译任务的创建
-                    # print(f"选定了编译服务器: {addr} 编译: {source}")
-                    md5 = generator_utils.upload_file(f"http://{addr}:5858/up", source)
-                    if md5 is not None and md5 != "failed":
-                        task_addr = addr
-                        md5_code = md5
-                        # 选定了之后，我们需要退出外部循环
-                        exit_loop = True
-                        # LOGGER.info(f"编译任务提交成功: {md5} : {source}")
-                        break
-                except Exception as e:
-                    LOGGER.error(f"选定的编译服务器有异常: {e}")
-                    compiler_list.remove(addr)  # 从列表中直接移除这个服务器
-                    if len(compiler_list) == 0:
-                        raise Exception(f"已经没有可以用来编译的服务器。")
 
-            if exit_loop:
-                break
+def wait_compiled(addr, code, timeout=COMPILER_WAIT_TIMEOUT):
+    """
+        阻塞等待编译服务器完成任务，任务完成时服务器会立即返回
+    :param addr: 服务器地址
+    :param code: 任务的MD5
+    :param timeout: 单次等待的时间
+    :return: 完成返回True，超时返回False
+    """
+    resp = get_compiler_resp(addr, f"wait?code={code}&timeout={timeout}", timeout=(8, timeout + 8))
+    if resp == "True" or resp == "False":
+        return resp == "True"
+    if resp == "error":
+        raise CompileError(f"编译服务器 {addr} 编译出错: {code}")
+    if resp == "failed":
+        raise Exception(f"编译服务器 {addr} 上的任务已经结束，但是没有产出运行库: {code}")
+    # 旧版本的服务器不支持阻塞等待，退回到轮询
+    time.sleep(1)
+    return get_compiler_resp(addr, f"ok?code={code}") == "True"
+
+
+def download_compiled(addr, codes):
+    """
+        以zip压缩包的形式一次性下载多个编译完成的运行库，
+        旧版本的服务器不支持批量下载时逐个下载
+    :param addr: 服务器地址
+    :param codes: 任务的MD5列表
+    :return: 任务的MD5到运行库内容的映射，没有完成的任务不在其中
+    """
+    data = generator_utils.download_data(f"http://{addr}:5858/down_batch?codes={','.join(codes)}")
+    if data is None:
+        libs = dict()
+        for code in codes:
+            so_data = generator_utils.download_data(f"http://{addr}:5858/down?code={code}")
+            if so_data is not None:
+                libs[code] = so_data
+        return libs
 
-            LOGGER.info(f"{source} 正在选择编译服务器...")
-
-        while True:  # 查询任务是否编译完成
-            # 任务已经创建，我们需要不停的问任务完成了没
-            time.sleep(1)
-            # LOGGER.info(f"目标为 {task_addr} 的机器， 任务{md5_code} 完成了没？")
-            if get_compiler_resp(task_addr, f"ok?code={md5_code}") == "True":
-                # print(f"编译完成，将自动下载到指定目录: {so_target_path}......")
-                file_path = generator_utils.download_file(
-                    # 下载链接
-                    f"http://{task_addr}:5858/down?code={md5_code}",
-                    # 在ipk中的相对目录
-                    so_target_path,
-                )
-                # LOGGER.info(f"[+] 编译完成: {file_path}")
-                break
-            # print("没有哦。")
-            time.sleep(2)
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_fd:
+        return {os.path.splitext(name)[0]: zip_fd.read(name) for name in zip_fd.namelist()}
 
-            LOGGER.info(f"{source} 正在进行编译...")
 
-    except Exception as e:
-        print("编译:", source, "时出现异常:", e)
+class CompilerScheduler:
+    """
+        编译服务器的调度器
+        记录每个服务器的容量（任务上限）与负载（服务器上报的任务数与本地分配的任务数），
+        每次将任务分配给负载比例最低的服务器；
+        出现异常的服务器会按照指数退避的时间暂时避让，而不是在整个构建过程中被移除
+    """
+
+    def __init__(self, refresh_interval=2.0, backoff_min=1.0, backoff_max=30.0):
+        """
+            初始化调度器
+        :param refresh_interval: 刷新服务器列表与负载的间隔(s)
+        :param backoff_min: 服务器第一次出现异常时避让的时间(s)
+        :param backoff_max: 服务器避让的最长时间(s)
+        """
+        self.refresh_interval = refresh_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        # 保护服务器信息的锁
+        self.lock = threading.RLock()
+        # 刷新时持有的锁，同一时间只允许一个线程刷新
+        self.refresh_lock = threading.RLock()
+        self.refresh_time = 0
+        # 服务器地址 -> 服务器的状态信息
+        self.nodes = dict()
+
+    @staticmethod
+    def probe_int(addr, url):
+        """
+            向服务器查询一个整数值
+        :return: 查询失败时返回None
+        """
+        try:
+            value = get_compiler_resp(addr, url).strip()
+        except Exception as e:
+            LOGGER.error(f"查询编译服务器 {addr} 的 {url} 失败: {e}")
+            return None
+        return int(value) if value.isdigit() else None
+
+    def backoff(self, node):
+        """
+            让服务器避让一段时间，连续出错的次数越多，避让的时间越长
+        :param node: 服务器的状态信息
+        :return:
+        """
+        node['errors'] += 1
+        delay = min(self.backoff_max, self.backoff_min * (2 ** (node['errors'] - 1)))
+        node['retry_time'] = time.time() + delay
+
+    def refresh(self):
+        """
+            按照间隔刷新在线的服务器列表以及各个服务器的负载
+        :return:
+        """
+        with self.refresh_lock:
+            if time.time() - self.refresh_time < self.refresh_interval:
+                return
+
+            try:
+                compiler_infos = get_compiler_infos()
+            except Exception as e:
+                # 网域控制器暂时不可用的时候，继续使用之前的服务器列表
+                LOGGER.error(f"获取在线的编译服务器列表失败: {e}")
+                with self.lock:
+                    compiler_infos = {addr: {} for addr in self.nodes.keys()}
+
+            probes = dict()
+            for addr, info in compiler_infos.items():
+                # 优先使用服务器随心跳上报的信息，旧版本的服务器没有上报时才逐个探测
+                capacity = info.get('task_max')
+                if capacity is None:
+                    with self.lock:
+                        capacity = self.nodes[addr]['capacity'] if addr in self.nodes else None
+                # 容量基本不会变化，只在第一次发现服务器的时候查询
+                if capacity is None:
+                    capacity = self.probe_int(addr, "max")
+
+                count = info.get('count')
+                if count is None:
+                    count = self.probe_int(addr, "count")
+                else:
+                    # 排队中的任务同样算作服务器的负载
+                    count += info.get('queue') or 0
+
+                if info.get('toolchain'):
+                    set_compiler_toolchain(addr, info['toolchain'])
+
+                probes[addr] = (capacity, count)
+
+            with self.lock:
+                # 移除已经下线的服务器
+                for addr in list(self.nodes.keys()):
+                    if addr not in probes:
+                        del self.nodes[addr]
+
+                for addr, (capacity, count) in probes.items():
+                    node = self.nodes.setdefault(addr, {
+                        "capacity": None,  # 服务器的任务上限
+                        "count": 0,  # 服务器上报的任务数
+                        "inflight": 0,  # 本地分配给此服务器并且尚未结束的任务数
+                        "errors": 0,  # 连续出错的次数
+                        "retry_time": 0,  # 避让结束的时间
+                    })
+                    node['capacity'] = capacity
+                    if count is None:
+                        self.backoff(node)
+                    else:
+                        node['count'] = count
+
+            self.refresh_time = time.time()
+
+    def get_nodes(self):
+        """
+            获取当前在线的服务器列表
+        :return:
+        """
+        self.refresh()
+        with self.lock:
+            return list(self.nodes.keys())
+
+    def acquire(self, count=1):
+        """
+            选择一个负载最低的服务器，并且记录分配的任务数
+        :param count: 分配的任务数
+        :return: 服务器地址，没有在线的服务器时返回None
+        """
+        self.refresh()
+
+        with self.lock:
+            if len(self.nodes) == 0:
+                return None
+
+            now = time.time()
+            candidates = [item for item in self.nodes.items() if item[1]['retry_time'] <= now]
+            if len(candidates) == 0:
+                # 全部都在避让中的时候，选择最快结束避让的服务器
+                candidates = [min(self.nodes.items(), key=lambda item: item[1]['retry_time'])]
+
+            def load(item):
+                node = item[1]
+                # 旧版本的服务器无法查询容量，按照一个任务的容量计算
+                capacity = node['capacity'] or 1
+                return (node['count'] + node['inflight']) / capacity
+
+            addr, node = min(candidates, key=load)
+            node['inflight'] += count
+            return addr
+
+    def release(self, addr, count=1, error=False):
+        """
+            任务结束后释放服务器的负载记录
+        :param addr: 服务器地址
+        :param count: 结束的任务数
+        :param error: 服务器是否出现了异常
+        :return:
+        """
+        with self.lock:
+            node = self.nodes.get(addr)
+            if node is None:
+                return
+            node['inflight'] = max(0, node['inflight'] - count)
+            if error:
+                self.backoff(node)
+            else:
+                node['errors'] = 0
+
+
+# 全局的编译服务器调度器
+SCHEDULER = CompilerScheduler()
+
+
+def get_so_cache_dir(cache_path, commit, gen_obj):
+    """
+        获取共享运行库缓存的目录
+        缓存按照 APP提交的HASH -> 生成器类名 -> 生成后的源码的MD5 的层级存放，
+        与设备无关的模块（生成后的源码一致）可以被同一个提交下的同类设备复用
+    :param cache_path: 缓存的根目录
+    :param commit: APP仓库当前的提交HASH
+    :param gen_obj: 生成器对象
+    :return: 缓存目录，未启用缓存时返回None
+    """
+    if cache_path is None or commit is None:
         return None
+    return os.path.join(cache_path, commit, type(gen_obj).__name__)
+
 
-    return file_path
+def get_so_cache_file(cache_dir, data):
+    """
+        获取源码对应的运行库缓存文件
+    :param cache_dir: 缓存目录
+    :param data: 源码的内容（已经生成过代码的）
+    :return:
+    """
+    return os.path.join(cache_dir, get_md5_for_data(data) + ".so")
 
 
-def build_2libs(source_paths, so_path):
+def so_cache_get(cache_dir, data):
+    """
+        从缓存中取出已经编译过的运行库
+    :param cache_dir: 缓存目录
+    :param data: 源码的内容
+    :return: 运行库的内容，未命中缓存时返回None
     """
-        编译所有的py项目到指定的临时目录
-    :param so_path: 存放最终的运行库的目录
-    :param source_paths: 源文件路径
+    cache_file = get_so_cache_file(cache_dir, data)
+    try:
+        with open(cache_file, mode="rb") as fd:
+            return fd.read()
+    except FileNotFoundError:
+        return None
+
+
+def so_cache_put(cache_dir, data, so_data):
+    """
+        保存编译完成的运行库到缓存中
+    :param cache_dir: 缓存目录
+    :param data: 源码的内容
+    :param so_data: 编译完成的运行库的内容
     :return:
     """
-    # 确保文件夹存在
-    for source_item in source_paths:
-        if not os.path.exists(source_item):
-            LOGGER.error(f"源代码文件不存在: {os.path.abspath(source_item)}")
-            return False
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = get_so_cache_file(cache_dir, data)
+        # 先写入临时文件再重命名，避免并发的任务读取到写了一半的缓存
+        tmp_file = f"{cache_file}.{uuid.uuid4().hex}"
+        with open(tmp_file, mode="wb") as fd:
+            fd.write(so_data)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        LOGGER.error(f"保存运行库缓存失败: {e}")
+
+
+def clean_so_cache(cache_path, keep_commit):
+    """
+        清理其他提交的运行库缓存，只保留指定提交的缓存
+    :param cache_path: 缓存的根目录
+    :param keep_commit: 需要保留的提交HASH
+    :return:
+    """
+    if not os.path.isdir(cache_path):
+        return
+    for name in os.listdir(cache_path):
+        if name != keep_commit:
+            shutil.rmtree(os.path.join(cache_path, name), ignore_errors=True)
 
-    if not os.path.exists(so_path):
-        os.makedirs(so_path)
 
-    source_paths = list(filter(lambda item: not item.endswith("__init__.py"), source_paths))
+def cancel_compiled(addr, codes, owner):
+    """
+        通知编译服务器取消一个构建请求的还没有开始编译的任务，其他构建仍然需要的任务不会被取消
+    :param addr: 服务器地址
+    :param codes: 任务的MD5列表
+    :param owner: 上传任务时使用的构建ID
+    :return: 服务器的回复，被取消的任务的MD5以逗号分隔
+    """
+    return get_compiler_resp(addr, "cancel", method="post", params={"codes": ",".join(codes), "owner": owner},
+                             timeout=COMPILER_CANCEL_TIMEOUT)
 
-    # 添加任务到线程池
-    failed = False
-    with ThreadPoolExecutor() as pool:
-        # 提交并且生成任务列表
-        task_list = [
-            pool.submit(
-                # 可执行对象
-                build_2lib,
 
-                # 参数
-                source_item,
-                so_path
-            ) for source_item in source_paths
-        ]
-        # 已经完成的任务的列表
-        done_list = []
-
-        # 判断任务是否有失败的！
-        while True:
-            for task_item in task_list:
-                # 这里需要严谨判断，仅在任务成功并且不在已经记录中的时候，才去验证结果！
-                if task_item.done() and task_item not in done_list:
-                    done_list.append(task_item)
-                    result = task_item.result()
-
-                    # 这里判断一下之前的任务是否已经失败过了，再判断当前任务是否失败了！
-                    if result is None and not failed:
-                        LOGGER.error(f"有构建任务失败！")
-                        # 标志为失败
-                        failed = True
-                        # 然后我们需要取消剩下的任务，加速退出！
-                        for cancel_task in task_list:
-                            cancel_task.cancel()
-
-            # 在所有的任务都完成后，我们才能结束任务！
-            if len(done_list) == len(task_list):
+class BuildOrchestrator:
+    """
+        基于asyncio的编译编排器，负责源文件 查询 -> 上传 -> 编译 -> 下载 的完整生命周期
+        先以源码的MD5向集群查询已经编译好的运行库，命中的直接下载，只有未命中的源文件才分批上传；
+        每个源文件是一个协程，编译完成由服务器的阻塞等待接口通知，
+        同一个服务器上同时完成的运行库合并为一次批量下载；
+        HTTP请求仍然是阻塞的，在线程池中执行，每个服务器同时进行的传输请求与等待请求分别有上限；
+        源文件在所有的重试之后仍然失败时，立即取消其他的协程，并且通知编译服务器取消排队中的任务
+    """
+
+    def __init__(self, sources, cache_dir=None, progress=None, node_limit=COMPILER_NODE_CONCURRENCY):
+        """
+            初始化编排器
+        :param sources: 源文件名到源码内容的映射
+        :param cache_dir: 共享运行库缓存的目录，为None时不使用缓存
+        :param progress: 构建进度
+        :param node_limit: 每个服务器同时进行的传输请求数
+        """
+        self.sources = sources
+        self.cache_dir = cache_dir
+        self.progress = BuildProgress() if progress is None else progress
+        self.node_limit = node_limit
+        # 构建ID，上传时告知服务器，取消时服务器只会丢弃没有其他构建需要的任务
+        self.owner = uuid.uuid4().hex
+        self.loop = None
+        # 构建开始时在线的服务器列表，用于查询已经编译好的运行库
+        self.nodes = []
+        # 服务器地址 -> 限制同时传输请求数的信号量
+        self.node_slots = dict()
+        # 服务器地址 -> 限制同时等待编译完成的请求数的信号量
+        self.wait_slots = dict()
+        # 服务器地址 -> 已经上传但是还没有下载运行库的任务的MD5
+        self.inflight = dict()
+        # 源文件名 -> 当前分配的服务器地址，结束时需要释放调度器的负载记录
+        self.assigned = dict()
+        # 源文件名 -> 运行库的内容
+        self.results = dict()
+        # 服务器地址 -> {任务的MD5: [等待下载结果的future]}，等待下一次批量下载
+        self.downloads = dict()
+        # 服务器地址 -> 正在进行批量下载的协程
+        self.downloaders = dict()
+
+    async def call(self, addr, func, *args, **kwargs):
+        """
+            在线程池中执行一个对服务器的阻塞传输请求，受到服务器的同时传输请求数限制
+        :param addr: 服务器地址
+        :param func: 阻塞的请求函数
+        :return: 请求函数的返回值
+        """
+        slots = self.node_slots.get(addr)
+        if slots is None:
+            slots = self.node_slots[addr] = asyncio.Semaphore(self.node_limit)
+        async with slots:
+            return await self.loop.run_in_executor(COMPILER_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+    async def wait(self, addr, code):
+        """
+            在单独的线程池中阻塞等待服务器完成编译，受到服务器的同时等待请求数限制
+        :param addr: 服务器地址
+        :param code: 任务的MD5
+        :return: 完成返回True，超时返回False
+        """
+        slots = self.wait_slots.get(addr)
+        if slots is None:
+            slots = self.wait_slots[addr] = asyncio.Semaphore(COMPILER_NODE_WAIT_CONCURRENCY)
+        async with slots:
+            return await self.loop.run_in_executor(COMPILER_WAIT_EXECUTOR, wait_compiled, addr, code)
+
+    async def download(self, addr, code):
+        """
+            下载一个编译完成的运行库，同一个服务器上等待下载的运行库合并为一次批量下载
+        :param addr: 服务器地址
+        :param code: 任务的MD5
+        :return: 运行库的内容，失败时返回None
+        """
+        future = self.loop.create_future()
+        self.downloads.setdefault(addr, dict()).setdefault(code, []).append(future)
+        if addr not in self.downloaders:
+            self.downloaders[addr] = asyncio.ensure_future(self.download_batches(addr))
+        return await future
+
+    async def download_batches(self, addr):
+        """
+            批量下载服务器上等待下载的运行库，下载过程中新完成的运行库在下一批中下载
+        :param addr: 服务器地址
+        :return:
+        """
+        try:
+            await asyncio.sleep(COMPILER_DOWNLOAD_BATCH_DELAY)
+            while len(self.downloads.get(addr, {})) > 0:
+                batch = self.downloads.pop(addr)
+                try:
+                    libs = await self.call(addr, download_compiled, addr, list(batch.keys()))
+                except Exception as e:
+                    LOGGER.error(f"从编译服务器 {addr} 批量下载运行库失败: {e}")
+                    libs = dict()
+                for code, futures in batch.items():
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(libs.get(code))
+        finally:
+            del self.downloaders[addr]
+
+    def store(self, name, so_data):
+        """
+            记录一个源文件的运行库，并且保存到缓存中，供后续的任务复用
+        :param name: 源文件名
+        :param so_data: 运行库的内容
+        :return:
+        """
+        self.results[name] = so_data
+        if self.cache_dir is not None:
+            so_cache_put(self.cache_dir, self.sources[name], so_data)
+
+    async def find_compiled(self, codes):
+        """
+            同时向所有在线的服务器查询已经编译好的运行库，每个服务器只需要一次请求
+        :param codes: 源码的MD5列表
+        :return: 源码的MD5到存在该运行库的服务器地址的映射，未命中的不在其中
+        """
+        if len(codes) == 0:
+            return dict()
+        results = await asyncio.gather(
+            *(self.call(addr, has_compiled, addr, codes) for addr in self.nodes), return_exceptions=True
+        )
+        hits = dict()
+        for addr, result in zip(self.nodes, results):
+            if isinstance(result, Exception):
+                LOGGER.error(f"查询编译服务器 {addr} 的运行库失败: {result}")
+                continue
+            for code in result:
+                hits.setdefault(code, addr)
+        return hits
+
+    async def lookup(self, name, code, addr):
+        """
+            从集群中下载已经编译好的运行库，省去上传、排队以及编译的过程
+        :param name: 源文件名
+        :param code: 源码的MD5
+        :param addr: 存在该运行库的服务器地址，为None时表示未命中
+        :return: 命中并且下载成功返回True
+        """
+        if addr is None:
+            return False
+        so_data = await self.download(addr, code)
+        if so_data is None:
+            return False
+        self.store(name, so_data)
+        self.progress.step("compile")
+        return True
+
+    def assign(self, names):
+        """
+            由调度器按照负载将源文件逐个分配给各个编译服务器，每个服务器只需要一次批量上传
+            调度器可能需要阻塞地刷新服务器列表与负载，需要在线程池中执行
+        :param names: 需要编译的源文件名
+        :return: 服务器地址到该服务器的批次（源文件名到源码内容的映射）的映射，没有在线的服务器时返回None
+        """
+        batches = dict()
+        for name in names:
+            addr = SCHEDULER.acquire()
+            if addr is None:
+                LOGGER.error("没有发现在线的编译服务器！！！")
+                for assigned_addr, batch in batches.items():
+                    SCHEDULER.release(assigned_addr, len(batch))
+                return None
+            batches.setdefault(addr, {})[name] = self.sources[name]
+
+        for addr, batch in batches.items():
+            self.progress.assign(addr, len(batch))
+        return batches
+
+    async def upload(self, addr, batch):
+        """
+            批量上传源码到服务器，服务器不支持批量接口时逐个上传
+        :param addr: 服务器地址
+        :param batch: 源文件名到源码内容的映射
+        :return: 源文件名到任务MD5的映射，上传失败的源文件不在其中
+        """
+        # 上传之前就记录任务，上传过程中被取消时同样需要通知服务器，任务的MD5即源码的MD5
+        self.inflight.setdefault(addr, set()).update(get_md5_for_data(data) for data in batch.values())
+        try:
+            resp = await self.call(addr, generator_utils.upload_datas,
+                                   f"http://{addr}:5858/up_batch?owner={self.owner}", batch)
+            return json.loads(resp)
+        except Exception as e:
+            LOGGER.error(f"批量上传到编译服务器 {addr} 失败，将逐个文件上传: {e}")
+
+        codes = dict()
+        for name, data in batch.items():
+            try:
+                md5 = await self.call(addr, generator_utils.upload_datas,
+                                      f"http://{addr}:5858/up?owner={self.owner}", {name: data}, "file")
+            except Exception as e:
+                LOGGER.error(f"上传 {name} 到编译服务器 {addr} 失败: {e}")
+                continue
+            if md5 is not None and md5 != "failed":
+                codes[name] = md5
+        return codes
+
+    async def compile(self, addr, name, code):
+        """
+            等待服务器完成编译并且下载运行库
+        :param addr: 服务器地址
+        :param name: 源文件名
+        :param code: 任务的MD5
+        :return: 运行库的内容，服务器或者网络出现异常时返回None，编译出错时抛出 CompileError
+        """
+        try:
+            while not await self.wait(addr, code):
+                LOGGER.info(f"{name} 正在编译服务器 {addr} 上进行编译...")
+            so_data = await self.download(addr, code)
+        except CompileError:
+            self.inflight[addr].discard(code)
+            raise
+        except Exception as e:
+            LOGGER.error(f"在编译服务器 {addr} 上编译 {name} 时出现异常: {e}")
+            so_data = None
+        # 被取消时不会执行到这里，任务保留在记录中，稍后通知服务器取消
+        self.inflight[addr].discard(code)
+        return so_data
+
+    async def build_source(self, name, addr, upload):
+        """
+            构建一个源文件，失败时由调度器另外选择一个服务器重试
+        :param name: 源文件名
+        :param addr: 调度器分配的服务器地址
+        :param upload: 所在批次的上传任务
+        :return:
+        """
+        self.assigned[name] = addr
+        codes = await upload
+        for retry in range(COMPILER_RETRY_MAX + 1):
+            code = codes.get(name)
+            try:
+                so_data = None if code is None else await self.compile(addr, name, code)
+            except CompileError:
+                # 源码本身有错误，服务器是正常的，不需要避让，也不需要在其他服务器上重试
+                del self.assigned[name]
+                SCHEDULER.release(addr)
+                self.progress.node_done(addr, 0, 1)
+                raise Exception(f"源文件编译出错: {name}")
+
+            del self.assigned[name]
+            SCHEDULER.release(addr, error=so_data is None)
+            self.progress.node_done(addr, int(so_data is not None), int(so_data is None))
+            if so_data is not None:
+                self.store(name, so_data)
+                return
+
+            if retry == COMPILER_RETRY_MAX:
                 break
+            # 调度器可能需要阻塞地刷新服务器列表与负载，不能在事件循环的线程中执行
+            addr = await self.loop.run_in_executor(COMPILER_EXECUTOR, SCHEDULER.acquire)
+            if addr is None:
+                break
+            LOGGER.warning(f"{name} 构建失败，将在编译服务器 {addr} 上重试。")
+            self.assigned[name] = addr
+            self.progress.assign(addr, 1)
+            codes = await self.upload(addr, {name: self.sources[name]})
+
+        raise Exception(f"源文件构建失败: {name}")
+
+    async def cancel_remote(self):
+        """
+            通知服务器取消还没有完成的任务，被取消的等待请求在单独的线程池中，不会影响取消的请求
+        :return:
+        """
+        requests = [
+            self.loop.run_in_executor(COMPILER_EXECUTOR, cancel_compiled, addr, list(codes), self.owner)
+            for addr, codes in self.inflight.items() if len(codes) > 0
+        ]
+        for result in await asyncio.gather(*requests, return_exceptions=True):
+            if isinstance(result, Exception):
+                LOGGER.error(f"通知编译服务器取消任务失败: {result}")
+
+    async def run(self):
+        """
+            执行所有源文件的构建
+        :return: 全部构建成功返回True
+        """
+        self.loop = asyncio.get_event_loop()
+
+        names = list(self.sources.keys())
+        codes = {name: get_md5_for_data(data) for name, data in self.sources.items()}
+        found = await self.find_compiled(list(set(codes.values())))
+        hits = await asyncio.gather(*(self.lookup(name, codes[name], found.get(codes[name])) for name in names))
+        names = [name for name, hit in zip(names, hits) if not hit]
+        LOGGER.info(f"编译服务器上已经存在 {len(hits) - len(names)} 个运行库，需要编译 {len(names)} 个。")
+        if len(names) == 0:
+            return True
+
+        batches = await self.loop.run_in_executor(COMPILER_EXECUTOR, self.assign, names)
+        if batches is None:
+            return False
+
+        uploads = [asyncio.ensure_future(self.upload(addr, batch)) for addr, batch in batches.items()]
+        tasks = [
+            asyncio.ensure_future(self.build_source(name, addr, upload))
+            for upload, (addr, batch) in zip(uploads, batches.items()) for name in batch.keys()
+        ]
 
-            # LOGGER.error(f"等待所有任务结束: {len(done_list)}, {len(task_list)}")
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        errors = [task.exception() for task in done if task.exception() is not None]
+        if len(errors) == 0:
+            return True
+
+        LOGGER.error(f"有构建任务失败，取消剩下的 {len(pending)} 个任务: {errors[0]}")
+        downloaders = list(self.downloaders.values())
+        for task in list(pending) + uploads + downloaders:
+            task.cancel()
+        await asyncio.gather(*pending, *uploads, *downloaders, return_exceptions=True)
+        for name, addr in self.assigned.items():
+            SCHEDULER.release(addr)
+        self.assigned.clear()
+        await self.cancel_remote()
+        return False
 
-    return not failed
+    def start(self):
+        """
+            在独立的事件循环中执行构建，多个打包任务在各自的线程中同时构建时互不影响
+        :return: 全部构建成功返回True
+        """
+        loop = asyncio.new_event_loop()
+        self.nodes = SCHEDULER.get_nodes()
+        try:
+            return loop.run_until_complete(self.run())
+        finally:
+            loop.close()
 
 
-def gen_code_fun(py_file, generator, build_dir):
+def build_2libs(sources, cache_dir=None, progress=None):
     """
-        代码生成函数与保存函数
-    :return:
+        编译所有的py源码为运行库，源码与运行库都只在内存中传递
+    :param cache_dir: 共享运行库缓存的目录，为None时不使用缓存
+    :param sources: 源文件名到源码内容的映射
+    :param progress: 构建进度
+    :return: 源文件名（以.so为后缀）到运行库内容的映射，有构建失败的源文件时返回None
     """
-    os.makedirs(build_dir, exist_ok=True)
-    # 读取文件
-    with open(py_file, encoding='utf-8') as fd:
-        py_content = fd.read()
-    # 调用生成器生成代码
-    new_py_content: str = generator.onGenerator(py_file, py_content)
-    new_py_file = os.path.join(build_dir, os.path.basename(py_file))
+    if progress is None:
+        progress = BuildProgress()
+    sources = {name: data for name, data in sources.items() if not name.endswith("__init__.py")}
+    progress.begin("compile", len(sources))
+
+    def so_name_of(name):
+        return os.path.splitext(name)[0] + ".so"
+
+    libs = dict()
+
+    # 先从共享缓存中取出已经编译过的运行库，只有未命中的源文件才需要远程编译
+    if cache_dir is not None:
+        for name in list(sources.keys()):
+            so_data = so_cache_get(cache_dir, sources[name])
+            if so_data is not None:
+                libs[so_name_of(name)] = so_data
+                del sources[name]
+        LOGGER.info(f"运行库缓存命中 {len(libs)} 个，需要编译 {len(sources)} 个。")
+        progress.step("compile", len(libs))
+
+    if len(sources) == 0:
+        progress.end("compile")
+        return libs
+
+    # 由编排器完成查询、上传、编译与下载，有源文件构建失败时立即取消其他的任务
+    orchestrator = BuildOrchestrator(sources, cache_dir, progress)
+    success = orchestrator.start()
+
+    progress.end("compile")
+    if not success:
+        return None
+    for name, so_data in orchestrator.results.items():
+        libs[so_name_of(name)] = so_data
+    return libs
+
+
+class PreparedTree:
+    """
+        预处理源码树
+        在合并提交时对所有白名单内的源码统一换行符，关闭print与debug，
+        打包任务中只需要执行设备相关的处理函数。制作完成后不可修改
+    """
+
+    def __init__(self, project_path, commit, files, close_print=True, close_debug=True):
+        self.project_path = project_path
+        self.commit = commit
+        self.close_print = close_print
+        self.close_debug = close_debug
+        # 源文件路径到 (预处理后的源码, 摘要) 的映射，摘要作为代码生成结果缓存的键
+        self.files = types.MappingProxyType(files)
+
+    def get(self, py_file):
+        """
+            获取预处理后的源码
+        :param py_file: 源文件路径
+        :return: 不在预处理源码树中时返回None
+        """
+        prepared = self.files.get(py_file)
+        return None if prepared is None else prepared[0]
+
+    def get_digest(self, py_file):
+        """
+            获取预处理后的源码的摘要
+        :param py_file:
+        :return:
+        """
+        prepared = self.files.get(py_file)
+        return None if prepared is None else prepared[1]
+
+    def is_usable(self, project_path, generator):
+        """
+            判断生成器是否可以使用此预处理源码树
+        :param project_path:
+        :param generator:
+        :return:
+        """
+        return project_path == self.project_path and \
+            generator.close_print == self.close_print and \
+            generator.close_debug == self.close_debug
+
+
+def prepare_sources(project_path, commit, names=None):
+    """
+        预处理需要生成代码的源码，每个提交只需要执行一次
+    :param project_path: 项目所在目录
+    :param commit: 当前的提交HASH
+    :param names: 需要预处理的文件名（白名单），为None时处理所有文件
+    :return: 预处理源码树
+    """
+    global PREPARED_TREE
+
+    start = time.perf_counter()
+    plan = abs_generator.TransformPlan(close_print=True, close_debug=True)
+    files = dict()
+    for path in get_gencode_dirs(project_path).keys():
+        for py in generator_utils.list_file_dirs(path, ".py"):
+            if names is not None and os.path.basename(py) not in names:
+                continue
+            with open(py, encoding='utf-8') as fd:
+                content = fd.read().replace("\r\n", "\n")
+            content = plan.apply(content)
+            files[py] = (content, hashlib.sha256(content.encode("utf-8")).hexdigest())
+
+    PREPARED_TREE = PreparedTree(project_path, commit, files)
+    LOGGER.info(f"预处理源码完成，提交: {commit}，文件数量: {len(files)}，"
+                f"花费的时间(s): {time.perf_counter() - start}")
+    return PREPARED_TREE
+
+
+def get_prepared_tree(project_path, generator):
+    """
+        获取生成器可以使用的预处理源码树
+    :return: 没有可用的预处理源码树时返回None
+    """
+    tree = PREPARED_TREE
+    if tree is None or not tree.is_usable(project_path, generator):
+        return None
+    return tree
+
+
+def gen_code_fun(py_file, generator, prepared_tree=None):
+    """
+        代码生成函数，生成的代码只保存在内存中
+    :param prepared_tree: 预处理源码树，文件在其中时直接使用预处理后的源码
+    :return: 生成后的源码内容，生成器不需要生成此文件时返回None
+    """
+    py_content = None if prepared_tree is None else prepared_tree.get(py_file)
+    if py_content is not None:
+        # 预处理过的源码只需要执行设备相关的处理函数，预处理时计算的摘要直接作为生成结果缓存的键
+        new_py_content: str = generator.onGenerator(
+            py_file, py_content, prepared=True, digest=prepared_tree.get_digest(py_file)
+        )
+    else:
+        # 读取文件
+        with open(py_file, encoding='utf-8') as fd:
+            py_content = fd.read()
+        # 调用生成器生成代码
+        new_py_content: str = generator.onGenerator(py_file, py_content)
     if new_py_content is None:
-        return
-    # 写入生成结果到文件
-    with open(new_py_file, "w+", encoding='utf-8') as fd:
-        fd.write(new_py_content.replace("\r\n", "\n"))
+        return None
+    return new_py_content.replace("\r\n", "\n").encode("utf-8")
 
 
-def make_code_only_lr(zipfd: zipfile.ZipFile, src, dst):
+def make_code_only_lr(zipfd: IpkWriter, src, dst):
     """
         确保某个文件之中只有换行，没有回车
     :return:
@@ -255,7 +1185,7 @@ def make_std_package(project_path, output_path, zip_file_name):
         pkg_std_file_path = os.path.join(output_path, zip_file_name)
 
         # 生成规范包
-        with zipfile.ZipFile(pkg_std_file_path, mode="w", compression=zipfile.ZIP_DEFLATED) as zip_fd:
+        with IpkWriter(pkg_std_file_path, mode="w") as zip_fd:
             for rule in file_maps:
                 if rule.startswith(rules[0]):
                     fm = rule.strip().strip(rules[0]).strip()
@@ -292,57 +1222,56 @@ def make_std_package(project_path, output_path, zip_file_name):
                                 # zip_fd.write(src, dst)
                                 make_code_only_lr(zip_fd, src, dst)
 
+        # 保存标准包中条目的信息表，之后基于标准包的构建不需要再读取这些文件计算摘要
+        with open(get_manifest_file(pkg_std_file_path), mode="w+") as fd:
+            json.dump(zip_fd.manifest, fd)
+
     except Exception as e:
         raise e
     return True
 
 
-def package_so2_ipk(ipk_zip, so_path, path_in_ipk):
+def package_so2_ipk(ipk_writer: IpkWriter, libs, path_in_ipk):
     """
         打包so到ipk中
-    :param ipk_zip: ipk文件包
+    :param ipk_writer: ipk写入器
     :param path_in_ipk: 在ipk中存放的位置
-    :param so_path:  so的路径
+    :param libs:  运行库文件名到运行库内容的映射
     :return:
     """
-    with zipfile.ZipFile(ipk_zip, mode="a", compression=zipfile.ZIP_DEFLATED) as zip_fd:
-        paths = generator_utils.list_file_dirs(so_path, ".so")
-        for path in paths:
-            file_in_ipk = os.path.join(path_in_ipk, os.path.basename(path))
-            # LOGGER.info(f"正在写入文件 {path} 到zip {file_in_ipk}")
-            zip_fd.write(path, file_in_ipk)
+    for name in sorted(libs.keys()):
+        file_in_ipk = os.path.join(path_in_ipk, name)
+        # LOGGER.info(f"正在写入文件 {name} 到zip {file_in_ipk}")
+        ipk_writer.writestr(file_in_ipk, libs[name])
 
-        try:
-            init_file_name = path_in_ipk + "/" + "__init__.py"
-            zip_fd.getinfo(init_file_name)
-        except KeyError:
-            # 最终往有so的目录写入一个init文件
-            zip_fd.writestr(init_file_name, "")
+    init_file_name = path_in_ipk + "/" + "__init__.py"
+    if not ipk_writer.exists(init_file_name):
+        # 最终往有so的目录写入一个init文件
+        ipk_writer.writestr(init_file_name, "")
 
 
-def package_file2_ipk(ipk_zip, file_path, path_in_ipk):
+def package_file2_ipk(ipk_writer: IpkWriter, file_path, path_in_ipk):
     """
         打包so到ipk中
-    :param ipk_zip: ipk文件包
+    :param ipk_writer: ipk写入器
     :param path_in_ipk: 在ipk中存放的位置
     :param file_path:  so的路径
     :return:
     """
     try:
-        with zipfile.ZipFile(ipk_zip, mode="a", compression=zipfile.ZIP_DEFLATED) as zip_fd:
-            file_in_ipk = os.path.join(path_in_ipk, os.path.basename(file_path))
-            # LOGGER.info(f"正在写入文件 {path} 到zip {file_in_ipk}")
-            zip_fd.write(file_path, file_in_ipk)
+        file_in_ipk = os.path.join(path_in_ipk, os.path.basename(file_path))
+        # LOGGER.info(f"正在写入文件 {path} 到zip {file_in_ipk}")
+        ipk_writer.write(file_path, file_in_ipk)
     except Exception as e:
         LOGGER.info(e)
         return False
     return True
 
 
-def package_info2_ipk(ipk_file, gen_obj):
+def package_info2_ipk(ipk_writer: IpkWriter, gen_obj):
     """
-        打包信息进入
-    :param ipk_file:
+        打包信息进入，必须在所有的文件写入完成之后调用
+    :param ipk_writer: ipk写入器，其中已经记录了写入的所有条目
     :param gen_obj:
     :return:
     """
@@ -385,30 +1314,8 @@ def package_info2_ipk(ipk_file, gen_obj):
             },
         }
 
-        with TemporaryDirectory() as build_tmp_dir:
-
-            json_file = "manifest.json"
-            json_path = os.path.join(build_tmp_dir, json_file)
-
-            # 然后我们需要写进去这个压缩包中
-            with zipfile.ZipFile(ipk_file, mode="a", compresslevel=zipfile.ZIP_DEFLATED) as zip_fd:
-
-                # 先读出基本信息
-                for info in zip_fd.infolist():
-                    # 记录文件或者文件夹的路径
-                    if info.is_dir():
-                        infos['manifest']['path'].append(info.filename)
-                    else:
-                        infos['manifest']['file'].append(info.filename)
-                        # 记录文件的CRC32
-                        infos['manifest']['crc32'][info.filename] = info.CRC
-
-                # 然后根据所有需要的信息生成一个临时的json文件
-                with open(json_path, "w+") as json_fd:
-                    json.dump(infos, json_fd)
-
-                # 然后写入zip压缩包中
-                zip_fd.write(json_path, json_file)
+        # 信息表最后写入，其中记录了包括固件在内的所有条目
+        ipk_writer.write_manifest(infos)
 
     except Exception as e:
         LOGGER.error("打包信息进入ipk失败: ", e)
@@ -417,21 +1324,16 @@ def package_info2_ipk(ipk_file, gen_obj):
     return True
 
 
-def package_fw_2_ipk(depends_path, ipk_file, genobj):
+def get_fw_type_name(genobj):
     """
-        打包stm32固件包进入ipk中
+        根据硬件版本获取需要打包的MCU固件的类型
     :param genobj:  生成器对象
-    :param depends_path: 依赖项所在的位置
-    :param ipk_file: ipk文件
     :return:
     """
     hw_ver_major = genobj.bundle['hw_version_main']
     hw_ver_minor = genobj.bundle['hw_version_sub']
     hw_ver_code = f"{hw_ver_major}.{hw_ver_minor}"
 
-    if genobj.bundle.get('fac_auto_make', False):
-        LOGGER.info("此次操作为工厂申请生产固件。")
-
     # 1.5版本是旧的硬件，
     # 其中使用的MCU是STM32，
     # 我们需要打包对应的固件包
@@ -444,6 +1346,18 @@ def package_fw_2_ipk(depends_path, ipk_file, genobj):
         # 因此我们可以其更新永远可用
         typ_name = "GD32"
 
+    return typ_name
+
+
+def get_fw_file(depends_path, genobj):
+    """
+        获取需要打包进ipk中的最新的MCU固件文件
+    :param genobj:  生成器对象
+    :param depends_path: 依赖项所在的位置
+    :return:
+    """
+    typ_name = get_fw_type_name(genobj)
+
     # 拼接固件资源路径
     path_all_ver = os.path.join(depends_path, typ_name)
     dirs_all_ver = os.listdir(path_all_ver)
@@ -467,126 +1381,387 @@ def package_fw_2_ipk(depends_path, ipk_file, genobj):
         ver_name,
         f"{typ_name}_APP_{ver_name}.nib"
     )
+    return file_app_fw
+
+
+def package_fw_2_ipk(depends_path, ipk_writer: IpkWriter, genobj):
+    """
+        打包stm32固件包进入ipk中
+    :param genobj:  生成器对象
+    :param depends_path: 依赖项所在的位置
+    :param ipk_writer: ipk写入器
+    :return:
+    """
+    if genobj.bundle.get('fac_auto_make', False):
+        LOGGER.info("此次操作为工厂申请生产固件。")
 
     # 拼接完成后，直接打包进去
     return package_file2_ipk(
-        ipk_file,
-        file_app_fw,
+        ipk_writer,
+        get_fw_file(depends_path, genobj),
         "res/firmware/app"
     )
 
 
-def make_app_package(project_path, depends_path, output_path, std_ipk_path, gen_obj):
+def get_gencode_dirs(project_path):
     """
-        最终编译的启动入口
+        定义由指定目录下的py文件编译后存放到zip包的路径的映射（需要生成代码）
+    :param project_path: 项目所在目录
     :return:
     """
-    LOGGER.info(f"项目所在目录: {project_path}")
-    LOGGER.info(f"依赖所在目录: {depends_path}")
-    LOGGER.info(f"编译输出目录: {output_path}")
-
-    # 确保目录存在
-    os.makedirs(output_path, exist_ok=True)
-
-    # 定义由指定目录下的py文件编译后存放到zip包的路径的映射（需要生成代码）
-    py_source_dirs_gencode = {
+    return {
         os.path.join(project_path, "act"): "lib",
         os.path.join(project_path, "gui"): "lib",
     }
 
-    # 同上（不需要生成代码）
-    py_source_dirs_rawcode = {
+
+def get_rawcode_dirs(project_path):
+    """
+        同上（不需要生成代码）
+    :param project_path: 项目所在目录
+    :return:
+    """
+    return {
         os.path.join(project_path, "app", "main"): "main",
     }
 
-    LOGGER.info(f"开始拷贝规范ipk...")
-    uuid_hex = uuid.uuid4().hex
-    new_name = uuid_hex + ".ipk"
-    app_file = generator_utils.copy_file(std_ipk_path, output_path, gen_obj, new_name)
-    if app_file is None:
-        LOGGER.info(f"复制ipk失败")
-        return
-    LOGGER.info(f"拷贝完成: {app_file}\n")
 
-    start = time.perf_counter()
+def build_gencode_2ipk(ipk_writer: IpkWriter, project_path, gen_obj, cache_dir, name_filter=None, progress=None):
+    """
+        生成代码并且编译需要生成代码的组件，然后打包进ipk中
+    :param ipk_writer: ipk写入器
+    :param project_path: 项目所在目录
+    :param gen_obj: 生成器对象
+    :param cache_dir: 共享运行库缓存的目录
+    :param name_filter: 文件名过滤函数，只有返回True的文件才会被处理，为None时处理所有文件
+    :param progress: 构建进度
+    :return:
+    """
+    if progress is None:
+        progress = BuildProgress()
+    py_source_dirs_gencode = get_gencode_dirs(project_path)
+    prepared_tree = get_prepared_tree(project_path, gen_obj)
+
+    for path in py_source_dirs_gencode.keys():  # 先编译需要生成代码的组件
+
+        # 开始生成代码，生成的代码只保存在内存中
+        pys = generator_utils.list_file_dirs(path, ".py")
+        if name_filter is not None:
+            pys = [py for py in pys if name_filter(os.path.basename(py))]
+
+        # 循环往线程池添加代码生成的任务
+        progress.begin("codegen", len(pys))
+        with ThreadPoolExecutor() as pool:
+            task_list = [
+                pool.submit(
+                    gen_code_fun, py, gen_obj, prepared_tree
+                ) for py in pys
+            ]
+            for task in task_list:
+                task.add_done_callback(lambda x: progress.step("codegen"))
+            # 等待所有的线程完成工作
+            concurrent.futures.wait(task_list)
+        progress.end("codegen")
+
+        sources = {
+            os.path.basename(py): task.result() for py, task in zip(pys, task_list) if task.result() is not None
+        }
+
+        # 生成结果缓存命中的文件输出不变，编译时会直接命中运行库缓存
+        LOGGER.info(f"代码生成结果缓存: {abs_generator.get_memo_stats()}")
+        LOGGER.info("开始构建构建（生成过程）模块。")
+
+        # 开始进行功能性组件库文件编译
+        libs = build_2libs(sources, cache_dir, progress)
+        if libs is not None:
+            LOGGER.info("构建（生成过程）模块成功。")
+        else:
+            raise Exception("构建（生成过程）模块失败。")
+
+        # 非常重要的一步，将编译好的so打包进ipk中
+        progress.begin("package", len(libs))
+        package_so2_ipk(
+            ipk_writer,
+            libs,
+            py_source_dirs_gencode[path]
+        )
+        progress.step("package", len(libs))
+        progress.end("package")
+
+
+def build_rawcode_2ipk(ipk_writer: IpkWriter, project_path, gen_obj, cache_dir, progress=None):
+    """
+        编译不需要生成代码的组件，然后打包进ipk中
+    :param ipk_writer: ipk写入器
+    :param project_path: 项目所在目录
+    :param gen_obj: 生成器对象
+    :param cache_dir: 共享运行库缓存的目录
+    :param progress: 构建进度
+    :return:
+    """
+    if progress is None:
+        progress = BuildProgress()
+    py_source_dirs_rawcode = get_rawcode_dirs(project_path)
+
+    LOGGER.info(f"开始构建 构建（原生文件）模块。")
+
+    for path in py_source_dirs_rawcode.keys():  # 再编译需要不生成代码的组件
+
+        # 直接读取源码到内存中
+        sources = dict()
+        for py in generator_utils.list_file_dirs(path, ".py"):
+            with open(py, mode="rb") as fd:
+                sources[os.path.basename(py)] = fd.read()
+
+        # 开始进行功能性组件库文件编译
+        libs = build_2libs(sources, cache_dir, progress)
+        if libs is not None:
+            LOGGER.info("构建（原生文件）模块成功。")
+        else:
+            raise Exception("构建（原生文件）模块失败。")
+
+        progress.begin("package", len(libs))
+        package_so2_ipk(
+            ipk_writer,
+            libs,
+            py_source_dirs_rawcode[path]
+        )
+        progress.step("package", len(libs))
+        progress.end("package")
+
+
+def is_device_invariant(gen_obj, name):
+    """
+        判断一个文件生成的代码是否与设备无关
+        白名单中没有实现内容处理函数的文件，生成的代码只与源码有关
+    :param gen_obj: 生成器对象
+    :param name: 文件名
+    :return:
+    """
+    return name in gen_obj.maps and gen_obj.maps[name] is None
+
 
+def get_base_package_prefix(gen_obj):
+    """
+        获取设备类型对应的基础包的文件名前缀，同一个设备类型的所有基础包都以此开头
+    :param gen_obj: 生成器对象
+    :return:
+    """
+    return f"{type(gen_obj).__name__}_{get_fw_type_name(gen_obj)}_"
+
+
+def get_base_package_file(base_path, depends_path, gen_obj):
+    """
+        获取设备类型对应的基础包文件
+        基础包中含有MCU固件，因此除了生成器类之外，还需要以固件类型以及固件文件的摘要区分，
+        依赖仓库更新了固件之后，即使APP仓库没有新的提交，也会自动制作新的基础包
+    :param base_path: 存放基础包的目录
+    :param depends_path: 依赖项所在的位置
+    :param gen_obj: 生成器对象
+    :return: 找不到固件文件时返回None
+    """
     try:
-        for path in py_source_dirs_gencode.keys():  # 先编译需要生成代码的组件
+        fw_digest = generator_utils.get_file_digest(get_fw_file(depends_path, gen_obj))
+    except Exception as e:
+        LOGGER.error(f"获取基础包的固件失败: {e}")
+        return None
+    return os.path.join(base_path, f"{get_base_package_prefix(gen_obj)}{fw_digest[:16]}.ipk")
 
-            with TemporaryDirectory() as build_tmp_dir:
 
-                # 路径创建完毕，我们需要开始生成代码
-                pys = generator_utils.list_file_dirs(path, ".py")
+def clean_base_package(base_file, gen_obj):
+    """
+        删除同一个设备类型的旧的基础包（固件已经更新），
+        旧的基础包正在被复制而无法删除时（Windows）留到下一次制作基础包的时候再删除
+    :param base_file: 需要保留的基础包
+    :param gen_obj: 生成器对象
+    :return:
+    """
+    base_path = os.path.dirname(base_file)
+    prefix = get_base_package_prefix(gen_obj)
+    for name in os.listdir(base_path):
+        file = os.path.join(base_path, name)
+        if not name.startswith(prefix) or not name.endswith(".ipk") or file == base_file:
+            continue
+        try:
+            os.remove(file)
+            os.remove(get_manifest_file(file))
+        except OSError as e:
+            LOGGER.warning(f"删除旧的基础包失败: {e}")
 
-                # 循环往线程池添加代码生成的任务
-                with ThreadPoolExecutor() as pool:
-                    task_list = [
-                        pool.submit(
-                            gen_code_fun, py, gen_obj, build_tmp_dir
-                        ) for py in pys
-                    ]
-                    # 等待所有的线程完成工作
-                    concurrent.futures.wait(task_list)
 
-                pys = generator_utils.list_file_dir(build_tmp_dir, ".py")
+def make_base_package(project_path, depends_path, std_ipk_path, base_file, gen_obj, cache_dir):
+    """
+        制作某个设备类型的基础包
+        基础包包含了标准包、与设备无关的运行库、MCU固件以及部分的信息表，
+        每台设备的构建只需要在基础包之上补充与设备有关的运行库并且完成信息表
+    :return: 是否制作成功
+    """
+    base_path = os.path.dirname(base_file)
+    tmp_name = f"{uuid.uuid4().hex}.tmp"
+    tmp_file = generator_utils.copy_file(std_ipk_path, base_path, gen_obj, tmp_name)
+    if tmp_file is None:
+        LOGGER.error("复制基础包失败")
+        return False
 
-                LOGGER.info("开始构建构建（生成过程）模块。")
+    tmp_manifest_file = get_manifest_file(tmp_file)
 
-                # 开始进行功能性组件库文件编译
-                if build_2libs(pys, build_tmp_dir):
-                    LOGGER.info("构建（生成过程）模块成功。")
-                else:
-                    raise Exception("构建（生成过程）模块失败。")
+    try:
+        with IpkWriter(tmp_file, load_manifest(std_ipk_path)) as ipk_writer:
+            build_gencode_2ipk(
+                ipk_writer, project_path, gen_obj, cache_dir,
+                lambda name: is_device_invariant(gen_obj, name)
+            )
+            build_rawcode_2ipk(ipk_writer, project_path, gen_obj, cache_dir)
+
+            if not package_fw_2_ipk(depends_path, ipk_writer, gen_obj):
+                raise Exception("含入（HMI固件包）文件失败。")
+
+        # 记录基础包中已有的条目，作为部分的信息表
+        with open(tmp_manifest_file, mode="w+") as fd:
+            json.dump(ipk_writer.manifest, fd)
+
+        # 信息表先就位，基础包最后就位，基础包存在即代表完整可用
+        os.replace(tmp_manifest_file, get_manifest_file(base_file))
+        os.replace(tmp_file, base_file)
+    except Exception as e:
+        LOGGER.error(f"制作基础包失败: {e}")
+        for file in (tmp_file, tmp_manifest_file):
+            if os.path.exists(file):
+                os.remove(file)
+        return False
 
-                # 非常重要的一步，将编译好的so打包进ipk中
-                package_so2_ipk(
-                    app_file,
-                    build_tmp_dir,
-                    py_source_dirs_gencode[path]
-                )
+    return True
 
-        LOGGER.info(f"开始构建 构建（原生文件）模块。")
 
-        for path in py_source_dirs_rawcode.keys():  # 再编译需要不生成代码的组件
+def get_base_package(project_path, depends_path, std_ipk_path, base_path, gen_obj, cache_dir):
+    """
+        获取设备类型对应的基础包，不存在时自动制作
+    :return: 基础包文件，制作失败时返回None
+    """
+    base_file = get_base_package_file(base_path, depends_path, gen_obj)
+    if base_file is None:
+        return None
 
-            with TemporaryDirectory() as build_tmp_dir:
+    with BASE_PKG_LOCK:
+        lock = BASE_PKG_LOCK_MAP.setdefault(base_file, threading.RLock())
 
-                # 路径创建完毕，我们需要开始复制代码
-                generator_utils.copy_tree(path, build_tmp_dir, gen_obj)
-                pys = generator_utils.list_file_dirs(path, ".py")
+    with lock:
+        if not os.path.exists(base_file):
+            os.makedirs(base_path, exist_ok=True)
+            LOGGER.info(f"开始制作基础包: {base_file}")
+            if not make_base_package(project_path, depends_path, std_ipk_path, base_file, gen_obj, cache_dir):
+                return None
+            LOGGER.info(f"基础包制作完成: {base_file}")
+            clean_base_package(base_file, gen_obj)
 
-                # 开始进行功能性组件库文件编译
-                if build_2libs(pys, build_tmp_dir):
-                    LOGGER.info("构建（原生文件）模块成功。")
-                else:
-                    raise Exception("构建（原生文件）模块失败。")
+    return base_file
 
-                package_so2_ipk(
-                    app_file,
-                    build_tmp_dir,
-                    py_source_dirs_rawcode[path]
-                )
 
-        # 打包信息为json，并且放到zip包中
-        if package_info2_ipk(app_file, gen_obj):
-            LOGGER.info("构建（版本信息）文件成功。")
-        else:
-            raise Exception("构建（版本信息）文件失败。")
+def warmup_package(project_path, depends_path, std_ipk_path, gen_obj,
+                   cache_path=None, commit=None, base_path=None):
+    """
+        预热某个设备类型的构建
+        制作设备类型对应的基础包，同时将与设备无关的运行库编译到共享运行库缓存中，
+        之后该设备类型的构建只需要编译与设备有关的运行库
+    :return: 是否预热成功
+    """
+    start = time.perf_counter()
+    cache_dir = get_so_cache_dir(cache_path, commit, gen_obj)
+    if base_path is None:
+        return False
+    base_file = get_base_package(project_path, depends_path, std_ipk_path, base_path, gen_obj, cache_dir)
+    LOGGER.info(f"预热完成: {base_file}，花费的时间(s): {time.perf_counter() - start}")
+    return base_file is not None
 
-        if package_fw_2_ipk(depends_path, app_file, gen_obj):
-            LOGGER.info("含入（HMI固件包）文件成功。")
-        else:
-            raise Exception("含入（HMI固件包）文件失败。")
+
+def make_app_package(project_path, depends_path, output_path, std_ipk_path, gen_obj,
+                     cache_path=None, commit=None, base_path=None, progress=None):
+    """
+        最终编译的启动入口
+    :param cache_path: 共享运行库缓存的根目录
+    :param commit: APP仓库当前的提交HASH，与缓存目录同时提供时才启用缓存
+    :param base_path: 存放基础包的目录，为None时不使用基础包，从标准包开始完整构建
+    :param progress: 构建进度，构建的过程中更新
+    :return:
+    """
+    if progress is None:
+        progress = BuildProgress()
+    LOGGER.info(f"项目所在目录: {project_path}")
+    LOGGER.info(f"依赖所在目录: {depends_path}")
+    LOGGER.info(f"编译输出目录: {output_path}")
+
+    # 确保目录存在
+    os.makedirs(output_path, exist_ok=True)
+
+    start = time.perf_counter()
+
+    cache_dir = get_so_cache_dir(cache_path, commit, gen_obj)
+
+    # 优先使用基础包，基础包制作失败时回退到使用标准包完整构建
+    base_file = None
+    if base_path is not None:
+        base_file = get_base_package_file(base_path, depends_path, gen_obj)
+        if base_file is not None and not os.path.exists(base_file):
+            progress.begin("base")
+        base_file = get_base_package(project_path, depends_path, std_ipk_path, base_path, gen_obj, cache_dir)
+        progress.end("base")
+
+    LOGGER.info(f"开始拷贝规范ipk...")
+    progress.begin("copy")
+    uuid_hex = uuid.uuid4().hex
+    new_name = uuid_hex + ".ipk"
+    app_file = generator_utils.copy_file(base_file or std_ipk_path, output_path, gen_obj, new_name)
+    if app_file is None:
+        LOGGER.info(f"复制ipk失败")
+        progress.finish(False, "复制ipk失败")
+        return
+    progress.end("copy")
+    LOGGER.info(f"拷贝完成: {app_file}\n")
+
+    try:
+        # 标准包或者基础包中已有条目的信息表，其中已经含有文件的摘要
+        base_manifest = load_manifest(base_file or std_ipk_path)
+
+        # 整个构建过程中ipk只打开一次，信息表随写入记录，最后写入
+        with IpkWriter(app_file, base_manifest) as ipk_writer:
+            if base_file is not None:
+                # 基础包中已经含有与设备无关的运行库与固件，只需要补充与设备有关的运行库
+                build_gencode_2ipk(
+                    ipk_writer, project_path, gen_obj, cache_dir,
+                    lambda name: not is_device_invariant(gen_obj, name), progress
+                )
+            else:
+                build_gencode_2ipk(ipk_writer, project_path, gen_obj, cache_dir, progress=progress)
+                build_rawcode_2ipk(ipk_writer, project_path, gen_obj, cache_dir, progress)
+
+                progress.begin("firmware")
+                if package_fw_2_ipk(depends_path, ipk_writer, gen_obj):
+                    LOGGER.info("含入（HMI固件包）文件成功。")
+                else:
+                    raise Exception("含入（HMI固件包）文件失败。")
+                progress.end("firmware")
+
+            # 打包信息为json，并且放到zip包中
+            progress.begin("manifest")
+            if package_info2_ipk(ipk_writer, gen_obj):
+                LOGGER.info("构建（版本信息）文件成功。")
+            else:
+                raise Exception("构建（版本信息）文件失败。")
+        # 写入器关闭时才写入压缩包目录，之后ipk才完整可用
+        progress.end("manifest")
 
     except Exception as e:
         LOGGER.error(f"编译失败: {e}")
         os.remove(app_file)
         app_file = None
+        progress.finish(False, str(e))
+    else:
+        progress.finish(True)
 
     LOGGER.info(
         f"\n构建完成，输ipk文件为: {app_file} \n "
         f"构建花费的时间(s): {time.perf_counter() - start}\n"
+        f"连接复用统计（累计）: {generator_utils.get_http_stats()['total']}\n"
     )
 
     return app_file
-
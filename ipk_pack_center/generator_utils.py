@@ -1,16 +1,56 @@
 """
     代码生成用到的一些工具实现
 """
+import base64
+import hashlib
+import io
 import logging
 import os
 import shutil
+import tempfile
+import threading
 import time
 import random
+import re
+import uuid
 import requests
 
-from urllib.parse import unquote
-from urllib.request import urlopen
-from urllib.request import Request
+from urllib.parse import unquote, urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 每个服务器的连接池中保持的连接数量
+HTTP_POOL_SIZE = 16
+# 默认的请求超时(s)，(连接超时, 读取超时)，所有经过 http_request 的请求都会使用，调用者可以单独指定
+HTTP_TIMEOUT = (8, 21)
+# 上传与下载文件的超时(s)，读取超时是两次收到数据之间的最长间隔，上传时还包括服务器处理文件的时间
+HTTP_TRANSFER_TIMEOUT = (8, 120)
+# 请求失败时的重试次数与退避时间(s)，第n次重试前等待 HTTP_RETRY_BACKOFF * 2^(n-1)
+HTTP_RETRY_TOTAL = 3
+HTTP_RETRY_BACKOFF = 0.5
+# 读取失败（例如读取超时）时的重试次数，长轮询的请求超时后没有必要多次重试
+HTTP_RETRY_READ = 1
+# 服务器返回这些状态码时重试
+HTTP_RETRY_STATUS = (502, 503, 504)
+# 只有幂等的请求才会在读取失败或者状态码异常时重试，连接失败时所有的请求都会重试
+HTTP_RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# 服务器（协议+地址）到会话的映射，同一个服务器的请求复用连接
+HTTP_SESSION_LOCK = threading.RLock()
+HTTP_SESSION_MAP = dict()
+
+# 下载时每次读取的块大小，中断时最多丢失一个块已经接收的数据
+DOWNLOAD_CHUNK_SIZE = 1024 * 64
+# 下载中断后续传的次数上限
+DOWNLOAD_RETRY_MAX = 5
+
+# 上传时每次从磁盘读取的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024 * 4
+
+# 文件摘要的缓存，(路径, inode, 大小, 修改时间) 到摘要的映射
+FILE_DIGEST_LOCK = threading.RLock()
+FILE_DIGEST_MAP = dict()
+FILE_DIGEST_MAX = 1024
 
 user_agent = [
     "Mozilla/5.0 (compatible; Baiduspider/2.0; +http://www.baidu.com/search/spider.html)",
@@ -46,27 +86,117 @@ def get_darkside_headers():
     }
 
 
-def get_server_resp(url, str_resp=True, method="", params=None, timeout=(8, 21)):
+def new_http_retry():
+    """
+        创建请求的重试策略
+    :return:
+    """
+    kwargs = dict(
+        total=HTTP_RETRY_TOTAL,
+        read=HTTP_RETRY_READ,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=HTTP_RETRY_STATUS,
+        raise_on_status=False,
+    )
+    try:
+        return Retry(allowed_methods=HTTP_RETRY_METHODS, **kwargs)
+    except TypeError:
+        # 旧版本的urllib3
+        return Retry(method_whitelist=HTTP_RETRY_METHODS, **kwargs)
+
+
+def get_http_session(url):
+    """
+        获取服务器对应的会话，会话中的连接池保持长连接，线程之间共用
+    :param url: 请求的地址
+    :return:
+    """
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with HTTP_SESSION_LOCK:
+        session = HTTP_SESSION_MAP.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=new_http_retry(),
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            HTTP_SESSION_MAP[key] = session
+        return session
+
+
+def get_http_stats():
+    """
+        获取连接复用的统计信息
+    :return: 服务器到 {请求数, 建立的连接数, 复用连接的请求数} 的映射，以及所有服务器的合计
+    """
+    stats = dict()
+    total = {"requests": 0, "connections": 0, "reused": 0}
+    with HTTP_SESSION_LOCK:
+        sessions = list(HTTP_SESSION_MAP.items())
+    for key, session in sessions:
+        requests_count = 0
+        connections_count = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+        stats[key] = {
+            "requests": requests_count,
+            "connections": connections_count,
+            "reused": max(0, requests_count - connections_count),
+        }
+        for name in total.keys():
+            total[name] += stats[key][name]
+    stats["total"] = total
+    return stats
+
+
+def http_request(method, url, **kwargs):
+    """
+        使用服务器对应的会话发起请求
+    :param method: 请求方法
+    :param url: 请求的地址
+    :param kwargs: 同 requests.request，没有指定 timeout 时使用 HTTP_TIMEOUT，避免服务器停止响应时永远阻塞
+    :return:
+    """
+    kwargs.setdefault("headers", get_darkside_headers())
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    return get_http_session(url).request(method, url, **kwargs)
+
+
+def get_server_resp(url, str_resp=True, method="", params=None, timeout=None):
     """
         请求获取一个URL的回复内容
-    :param timeout: 请求超时
+    :param timeout: 请求超时，为None时使用默认的超时
     :param params:  请求的附带参数
     :param method: 请求方法，默认为get
     :param str_resp: 是否需要字符串类型的返回
     :param url:  将被请求的地址
     :return:
     """
+    if timeout is None:
+        timeout = HTTP_TIMEOUT
+
+    # 与 requests.get(url, params) 以及 requests.post(url, data) 的参数位置保持一致
     if len(method) == 0 or method.lower() == "get":
-        method = requests.get
+        method, params_key = "GET", "params"
     elif method.lower() == "post":
-        method = requests.post
+        method, params_key = "POST", "data"
     else:
         raise Exception(f"不支持的请求方法: {method}")
 
     if params is None:
-        resp = method(url, timeout=timeout, headers=get_darkside_headers())
+        resp = http_request(method, url, timeout=timeout)
     else:
-        resp = method(url, params, timeout=timeout, headers=get_darkside_headers())
+        resp = http_request(method, url, timeout=timeout, **{params_key: params})
 
     result = resp.content
     if str_resp:
@@ -78,67 +208,293 @@ def get_server_resp(url, str_resp=True, method="", params=None, timeout=(8, 21))
     return result
 
 
-def download_file(url, path):
+def get_disposition_filename(headers):
+    """
+        从回复头中的 Content-Disposition 获取文件名
+    :param headers: 回复头
+    :return: 没有提供文件名时返回空字符串
+    """
+    filename = ''
+    if 'Content-Disposition' in headers and headers['Content-Disposition']:
+        disposition_split = headers['Content-Disposition'].split(';')
+        if len(disposition_split) > 1:
+            if disposition_split[1].strip().lower().startswith('filename='):
+                file_name = disposition_split[1].split('=')
+                if len(file_name) > 1:
+                    filename = unquote(file_name[1].strip().strip('"'))
+    # 只使用文件名，避免服务器提供的文件名中带有路径
+    return os.path.basename(filename)
+
+
+def get_digest_sha256(headers):
+    """
+        从回复头中的 Digest（RFC 3230）获取服务器提供的SHA-256摘要
+    :param headers: 回复头
+    :return: 十六进制的摘要，服务器没有提供时返回None
+    """
+    for item in headers.get('Digest', '').split(','):
+        algorithm, _, value = item.strip().partition('=')
+        if algorithm.lower() == 'sha-256' and value:
+            return base64.b64decode(value).hex()
+    return None
+
+
+def get_file_digest(file):
+    """
+        计算文件的SHA-256摘要（十六进制），相同的文件（路径、inode、大小、修改时间都相同）只计算一次
+    :param file:
+    :return:
+    """
+    stat = os.stat(file)
+    key = (file, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with FILE_DIGEST_LOCK:
+        if key in FILE_DIGEST_MAP:
+            return FILE_DIGEST_MAP[key]
+    sha256 = hashlib.sha256()
+    with open(file, mode="rb") as fd:
+        for dat in iter(lambda: fd.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(dat)
+    digest = sha256.hexdigest()
+    with FILE_DIGEST_LOCK:
+        if len(FILE_DIGEST_MAP) >= FILE_DIGEST_MAX:
+            FILE_DIGEST_MAP.clear()
+        FILE_DIGEST_MAP[key] = digest
+    return digest
+
+
+def get_content_range_start(headers):
+    """
+        获取 206 回复的 Content-Range 的起始位置
+    :param headers: 回复头
+    :return: 起始位置，没有或者格式错误时返回None
+    """
+    match = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", headers.get('Content-Range', "").strip())
+    return None if match is None else int(match.group(1))
+
+
+def download_file(url, path, timeout=HTTP_TRANSFER_TIMEOUT):
     """
+        下载文件，只发起一次请求，从回复头中获取文件名，
+        连接中断时通过 Range 断点续传，下载完成后校验服务器提供的摘要，
+        先写入临时文件，校验通过后才重命名为最终的文件，不完整的文件不会出现在目标目录中
     :param url: to download file
     :param path: place to put the file
+    :param timeout: 请求超时，(连接超时, 读取超时)
+    :return: 下载完成的文件路径，服务器返回的是网页（一般是错误信息）时返回网页的内容
     """
-    # print("开始请求头部信息......")
-    url_connection = urlopen(Request(url, headers=get_darkside_headers()))
-    url_info = url_connection.info()
+    # print("开始请求......")
+    req = http_request("GET", url, stream=True, timeout=timeout)
+    url_info = req.headers
     # print("头部信息请求完成：", url_info)
 
-    filename = ''
+    # 错误的回复（不管是什么类型的内容）不能被当作文件保存
+    try:
+        req.raise_for_status()
+    except requests.HTTPError:
+        req.close()
+        raise
 
     if 'Content-Type' in url_info:
         if "text/html" in url_info['Content-Type']:
-            resp = url_connection.read().decode()
-            url_connection.close()
+            resp = req.content.decode()
+            req.close()
             return resp
 
-    if 'Content-Disposition' in url_info and url_info['Content-Disposition']:
-        disposition_split = url_info['Content-Disposition'].split(';')
-        if len(disposition_split) > 1:
-            if disposition_split[1].strip().lower().startswith('filename='):
-                file_name = disposition_split[1].split('=')
-                if len(file_name) > 1:
-                    filename = unquote(file_name[1])
-
-    url_connection.close()
+    filename = get_disposition_filename(url_info)
 
     if not filename and os.path.basename(url):
         filename = os.path.basename(url).split("?")[0]
 
     if not filename:
-        filename = time.time()
+        filename = str(time.time())
 
     if not os.path.exists(path):
         os.makedirs(path)
 
     file_path = os.path.join(path, filename)
 
-    with requests.get(url, stream=True) as req:
-        # print("download_file() 开始下载....")
-        with open(file_path, mode="wb") as fd:
-            for dat in req.iter_content(1024 * 1024 * 8):
-                fd.write(dat)
-                # print(f"读取到的块大小: {len(dat)}")
+    digest = get_digest_sha256(url_info)
+    etag = url_info.get('ETag')
+    length = url_info.get('Content-Length')
+    length = None if length is None else int(length)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    retry = 0
+    fd = tempfile.NamedTemporaryFile(mode="wb", dir=path, prefix=f".{filename}.", suffix=".part", delete=False)
+    try:
+        while True:
+            try:
+                if req is None:
+                    # 服务器支持断点续传时，从已经下载的位置继续，否则重新下载
+                    headers = get_darkside_headers()
+                    if url_info.get('Accept-Ranges') == 'bytes' and size > 0:
+                        headers['Range'] = f"bytes={size}-"
+                        if etag is not None:
+                            # 服务器上的文件已经变化时，返回完整的文件
+                            headers['If-Range'] = etag
+                    req = http_request("GET", url, stream=True, headers=headers, timeout=timeout)
+                    if req.status_code == 206 and get_content_range_start(req.headers) != size:
+                        # 续传的范围与已经下载的位置不一致，丢弃已经下载的内容，下一次重新下载完整的文件
+                        fd.seek(0)
+                        fd.truncate()
+                        sha256 = hashlib.sha256()
+                        size = 0
+                        raise IOError(f"续传的范围不一致: {req.headers.get('Content-Range')}")
+                    if req.status_code != 206:
+                        req.raise_for_status()
+                        fd.seek(0)
+                        fd.truncate()
+                        sha256 = hashlib.sha256()
+                        size = 0
+                        digest = get_digest_sha256(req.headers)
+                        length = req.headers.get('Content-Length')
+                        length = None if length is None else int(length)
+                with req:
+                    # print("download_file() 开始下载....")
+                    for dat in req.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fd.write(dat)
+                        sha256.update(dat)
+                        size += len(dat)
+                        # print(f"读取到的块大小: {len(dat)}")
+                if length is None or size >= length:
+                    break
+                raise IOError(f"连接提前结束: {size}/{length}")
+            except (IOError, requests.RequestException) as e:
+                if req is not None:
+                    req.close()
+                    req = None
+                retry += 1
+                if retry > DOWNLOAD_RETRY_MAX:
+                    raise
+                logging.getLogger().warning(f"下载中断，将自动续传（{retry}/{DOWNLOAD_RETRY_MAX}）: {e}")
+                # 续传请求本身同样可能失败，与其他请求使用相同的退避时间
+                time.sleep(HTTP_RETRY_BACKOFF * 2 ** (retry - 1))
+
+        fd.close()
+        if digest is not None and digest != sha256.hexdigest():
+            raise IOError(f"下载的文件校验失败: {filename}，期望的摘要为 {digest}，实际为 {sha256.hexdigest()}")
+        os.replace(fd.name, file_path)
+    except BaseException:
+        fd.close()
+        os.remove(fd.name)
+        raise
     return file_path
 
 
-def upload_file(url, path, name="file", **kwargs):
+def download_data(url, timeout=HTTP_TRANSFER_TIMEOUT):
+    """
+        下载一个资源到内存中
+    :param url: 资源的地址
+    :param timeout: 请求超时，(连接超时, 读取超时)
+    :return: 资源的内容，服务器返回的是网页（一般是错误信息）时返回None
+    """
+    with http_request("GET", url, timeout=timeout) as req:
+        if "text/html" in req.headers.get('Content-Type', ""):
+            return None
+        return req.content
+
+
+class MultipartFileStream:
+    """
+        以流的方式生成包含一个文件的 multipart/form-data 请求体，
+        文件内容在发送时才分块从磁盘读取，请求体的长度预先计算好，服务器可以得到 Content-Length
     """
-        上传一个文件到服务器
+
+    def __init__(self, path, name, fields=None):
+        """
+            初始化请求体
+        :param path: 要上传的文件
+        :param name: 文件的表单名称
+        :param fields: 其他的表单字段
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+
+        head = io.BytesIO()
+        for key, value in (fields or {}).items():
+            head.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n'.encode())
+            head.write(value if isinstance(value, bytes) else str(value).encode())
+            head.write(b"\r\n")
+        head.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+            f'filename="{os.path.basename(path)}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode()
+        )
+        tail = f"\r\n--{boundary}--\r\n".encode()
+
+        self.len = head.tell() + os.path.getsize(path) + len(tail)
+        head.seek(0)
+        self.segments = [head, open(path, 'rb'), io.BytesIO(tail)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while True:
+            data = self.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def read(self, size=-1):
+        """
+            读取请求体，每次最多只读取一个片段中的数据
+        :param size: 读取的长度，小于0时读取剩余的全部数据
+        :return:
+        """
+        if size is None or size < 0:
+            return b"".join(segment.read() for segment in self.segments)
+        for segment in self.segments:
+            data = segment.read(size)
+            if data:
+                return data
+        return b""
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def upload_file(url, path, name="file", data=None, **kwargs):
+    """
+        上传一个文件到服务器，文件内容以流的方式分块发送，内存占用与文件大小无关
     :param name: 文件的表单名称
     :param url:
     :param path:
+    :param data: 其他的表单字段
+    :param kwargs: 同 http_request，没有指定 timeout 时使用 HTTP_TRANSFER_TIMEOUT
     :return:
     """
-    with open(path, 'rb') as f:
-        with requests.post(url, files={name: f}, headers=get_darkside_headers(), **kwargs) as result:
+    kwargs.setdefault("timeout", HTTP_TRANSFER_TIMEOUT)
+    with MultipartFileStream(path, name, data) as body:
+        headers = kwargs.pop("headers", None) or get_darkside_headers()
+        headers["Content-Type"] = body.content_type
+        with http_request("POST", url, data=body, headers=headers, **kwargs) as result:
             return result.content.decode()
 
 
+def upload_datas(url, datas, name="files", **kwargs):
+    """
+        在一个请求中直接从内存上传多个文件到服务器
+    :param name: 文件的表单名称
+    :param url:
+    :param datas: 文件名到文件内容的映射
+    :param kwargs: 同 http_request，没有指定 timeout 时使用 HTTP_TRANSFER_TIMEOUT
+    :return:
+    """
+    files = [(name, (filename, data)) for filename, data in datas.items()]
+    kwargs.setdefault("timeout", HTTP_TRANSFER_TIMEOUT)
+    with http_request("POST", url, files=files, **kwargs) as result:
+        return result.content.decode()
+
+
 def copy_tree(src, out, gen_obj):
     """
         简化文件夹拷贝，并且带确认
@@ -4,19 +4,26 @@
 
 import re
 import os
+import base64
 import hashlib
+import json
 import logging
+import shutil
 import subprocess
 import threading
 import time
 
+from collections import deque
+from concurrent.futures import Future, wait
 from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import timedelta
-from queue import Queue
 from flask import Flask, request, current_app
 
 import app_generator
+import generator_utils
 import icopy_maps
+import ipk_cache
+import server_utils
 
 
 class AtomInt(object):
@@ -42,6 +49,116 @@ class AtomInt(object):
             self.value -= 1
 
 
+class TaskScheduler(object):
+    """
+        打包任务的优先级调度器
+        1、工厂生产的任务优先于OTA的任务
+        2、任务每等待一段时间提升一级优先级，避免低优先级的任务一直得不到执行（不提升的任务除外）
+        3、同一优先级下，在各个来源（工作站）之间轮流调度，避免一个来源的大量任务阻塞其他来源
+        同一个来源同一优先级的任务按照提交的顺序执行
+    """
+
+    def __init__(self, aging_time):
+        """
+            初始化调度器
+        :param aging_time: 任务每等待此时间(s)提升一级优先级
+        """
+        self.aging_time = aging_time
+        self.cond = threading.Condition()
+        # (优先级, 来源) 到排队中的任务的映射，任务为 (任务码, 任务, 优先级, 提交时间, 是否随等待提升优先级)
+        self.queues = dict()
+        # 来源最后一次被调度的时间
+        self.served = dict()
+        self.size = 0
+
+    def put(self, code, task, priority, source, aging=True):
+        """
+            添加一个任务
+        :param code: 任务码
+        :param task: 任务参数
+        :param priority: 优先级，数字越小越优先
+        :param source: 任务的来源
+        :param aging: 是否随等待的时间提升优先级
+        :return:
+        """
+        with self.cond:
+            self.queues.setdefault((priority, source), deque()).append((code, task, priority, time.time(), aging))
+            self.size += 1
+            self.cond.notify_all()
+
+    def get_level(self, item, now):
+        # 等待的时间越久，优先级越高
+        if not item[4]:
+            return item[2]
+        return max(0, item[2] - int((now - item[3]) // self.aging_time))
+
+    def select(self, queues, served, now):
+        """
+            选出下一个需要执行的任务所在的队列
+            先比较优先级，再比较来源最后一次被调度的时间，最后比较提交的时间
+        :return:
+        """
+        return min(
+            queues.keys(),
+            key=lambda key: (self.get_level(queues[key][0], now), served.get(key[1], 0), queues[key][0][3])
+        )
+
+    def get(self):
+        """
+            阻塞获取下一个需要执行的任务
+        :return: (任务码, 任务)
+        """
+        with self.cond:
+            while self.size == 0:
+                self.cond.wait()
+            now = time.time()
+            key = self.select(self.queues, self.served, now)
+            code, task = self.queues[key].popleft()[:2]
+            if len(self.queues[key]) == 0:
+                del self.queues[key]
+            self.served[key[1]] = now
+            self.size -= 1
+            return code, task
+
+    def empty(self):
+        with self.cond:
+            return self.size == 0
+
+    def position(self, code):
+        """
+            获取任务在队列中的位置，按照当前的调度规则模拟出队
+        :param code: 任务码
+        :return: 下一个执行的任务为0，不在队列中时返回None
+        """
+        with self.cond:
+            queues = {key: deque(items) for key, items in self.queues.items()}
+            served = dict(self.served)
+            now = time.time()
+            index = 0
+            while len(queues) > 0:
+                key = self.select(queues, served, now)
+                item = queues[key].popleft()
+                if item[0] == code:
+                    return index
+                if len(queues[key]) == 0:
+                    del queues[key]
+                # 模拟调度的时间需要递增，保证轮流调度的顺序
+                served[key[1]] = now + index + 1
+                index += 1
+            return None
+
+    def stats(self):
+        """
+            获取各个来源各个优先级排队中的任务数量
+        :return:
+        """
+        with self.cond:
+            stats = dict()
+            for (priority, source), items in self.queues.items():
+                stats.setdefault(source, dict())[priority] = len(items)
+            return stats
+
+
 # 存放项目的仓库的信息
 PROJECT_GIT_PROTOCOL = "https://"
 PROJECT_APP_GIT_URL = "github.com/icopy-x/icopy_app.git"
@@ -64,6 +181,19 @@ PROJECT_STD_APPPKG_BASE = os.path.join(PROJECT_BUILD_PATH, "std")
 PROJECT_DEP_SOURCE_PATH = os.path.join(PROJECT_BUILD_PATH, "dep")
 PROJECT_STD_APPPKG_NAME = "icopy_std_pkg.ipk"
 PROJECT_STD_APPPKG_PATH = os.path.join(PROJECT_STD_APPPKG_BASE, PROJECT_STD_APPPKG_NAME)
+PROJECT_BASE_APPPKG_PATH = os.path.join(PROJECT_STD_APPPKG_BASE, "base")
+PROJECT_SO_CACHE_PATH = os.path.join(PROJECT_BUILD_PATH, "cache")
+PROJECT_IPK_CACHE_PATH = os.path.join(PROJECT_BUILD_PATH, "ipk_cache")
+
+# 构建结果缓存的总大小上限(byte)与最长存放时间(s)
+IPK_CACHE_SIZE_MAX = 8 * 1024 * 1024 * 1024
+IPK_CACHE_AGE_MAX = 3 * 24 * 60 * 60
+# 影响构建结果的任务参数（生成器读取的键），只有这些参数参与构建结果缓存的键，
+# 任务的来源、是否为工厂生产等参数不影响构建结果，不同工作站提交的相同设备可以复用缓存
+IPK_CACHE_TASK_KEYS = (
+    "type", "sn_str", "os_ver_major", "os_ver_minor", "hw_version_main", "hw_version_sub",
+    "pm", "id_cpu", "id_pm3", "id_stm32", "id_type",
+)
 
 # 克隆APP仓库使用的指令
 PROJECT_APP_CLONE_CMD = "git clone {}{}:{}@{} {}".format(
@@ -91,16 +221,49 @@ TASK_COUNT = AtomInt(value=0)
 GIT_UPDATING_LOCK = threading.RLock()
 GIT_UPDATING = False
 
-# 任务队列
-QUEUE_TASK = Queue()
+# APP仓库当前的提交HASH，在标准包构建时更新，用于区分共享运行库缓存
+APP_COMMIT_HASH = None
+# 依赖仓库(固件)当前的提交HASH，在依赖仓库更新后刷新，用于区分构建结果缓存
+DEP_COMMIT_HASH = None
+
+# 任务的优先级，数字越小越优先
+PRIORITY_FACTORY = 0
+PRIORITY_OTA = 1
+# 预热任务的优先级最低，并且不随等待的时间提升，只在没有排队的打包任务时执行
+PRIORITY_WARMUP = 2
+# 任务每等待此时间(s)提升一级优先级
+TASK_AGING_TIME = 120
+
+# 任务调度器
+SCHEDULER = TaskScheduler(TASK_AGING_TIME)
 # 线程池，用于分配子编译任务
 POOL_TASK = ThreadPoolExecutor(max_workers=TASK_MAX.get())
+# 线程池的空闲位置，只在有空闲位置时才从调度器中取出任务，保证高优先级的任务先执行
+POOL_TASK_SLOTS = threading.BoundedSemaphore(TASK_MAX.get())
 # 任务对象列表
 STATE_LIST = dict()
+# 任务的构建进度列表
+PROGRESS_LIST = dict()
+# 构建结果缓存，在启动时初始化
+IPK_CACHE = None
 
 # 锁
 ADD_TASK_LOCK = threading.RLock()
 
+# 阻塞等待任务完成的最长时间(s)
+WAIT_TIMEOUT_MAX = 60
+
+# 预热任务在调度器中的来源与任务码前缀，预热任务与打包任务共用线程池的位置，同时只排队一个预热任务
+WARMUP_SOURCE = "warmup"
+WARMUP_CODE_PREFIX = "warmup_"
+# 预热任务的状态
+WARMUP_LOCK = threading.RLock()
+WARMUP_RUNNING = False
+WARMUP_STATE = {"commit": None, "jobs": []}
+# 需要预热的硬件版本，默认预热正式量产版本，之后会加入生产任务中出现过的硬件版本
+WARMUP_HW_VERSIONS = {("1", "8")}
+
+
 # HTTP服务
 FLASK_APP = Flask(__name__)
 
@@ -276,11 +439,23 @@ def branch_has_update():
     return result_cloud.get('commit') != result_local.get('commit')
 
 
+def update_dep_commit_hash():
+    """
+        记录依赖仓库当前的提交HASH，获取失败时为None
+    :return:
+    """
+    global DEP_COMMIT_HASH
+    commit = get_output("git rev-parse HEAD", PROJECT_DEP_SOURCE_PATH).strip()
+    DEP_COMMIT_HASH = commit if re.fullmatch(r"[0-9a-f]{40,64}", commit) else None
+    if DEP_COMMIT_HASH is None:
+        LOGGER.warning(f"无法获取依赖仓库的提交HASH，构建结果将不会被缓存: {commit}")
+
+
 def resource_update():
     """
         更新项目到最新提交的代码
         注：将会从release分支拉取
-    :return:
+    :return: APP仓库有更新并且已经重新构建标准包时返回True
     """
     # 需要先等待所有的任务都结束
     # 我们才能进入更新状态，避免用户被终止更新
@@ -290,12 +465,18 @@ def resource_update():
 
     set_git_updating(True)
 
+    # 预热任务会读取仓库中的代码，需要等待正在进行的预热任务完成
+    while is_warmup_running():
+        time.sleep(1)
+
     # 自动拉取依赖仓库的更新
     # 由于依赖仓库是可以直接更新的，不需要担心云端覆盖代码导致
     get_output("git pull", PROJECT_DEP_SOURCE_PATH)
+    update_dep_commit_hash()
 
     switch_app_to_default_branch()
-    if branch_has_update():
+    updated = branch_has_update()
+    if updated:
         # 1、自动合并更新代码
         # 2、在代码有更新之后，我们需要进行新的ipk包的制作，避免使用了旧的IPK资源
         LOGGER.warning("\n正在更新合并代码...")
@@ -304,6 +485,7 @@ def resource_update():
         LOGGER.warning("合并完成！！！")
 
     set_git_updating(False)
+    return updated
 
 
 def get_md5_for_data(databyte):
@@ -312,20 +494,50 @@ def get_md5_for_data(databyte):
     return myhash.hexdigest()
 
 
-def run_pkg_task():
+def get_task_cache_key(values):
     """
-        实际上的编译器编译实现的过程
+        获取任务的构建结果在缓存中的键，由影响构建结果的任务参数与两个仓库当前的提交HASH决定
+    :param values: 任务参数
     :return:
     """
-    while True:
-        task: dict = QUEUE_TASK.get()
+    return ipk_cache.get_cache_key(
+        {k: values[k] for k in IPK_CACHE_TASK_KEYS if k in values}, APP_COMMIT_HASH, DEP_COMMIT_HASH
+    )
+
+
+def make_app_package_cached(cache_key, *args, progress=None):
+    """
+        构建ipk，构建成功后放入构建结果缓存
+    :param cache_key: 缓存的键
+    :param args: 构建参数，同 make_app_package
+    :param progress: 构建进度
+    :return: 构建好的ipk文件
+    """
+    app_file = app_generator.make_app_package(*args, progress=progress)
+    if IPK_CACHE is None:
+        return app_file
+    return IPK_CACHE.put(cache_key, app_file)
+
+
+def is_cached_file(file):
+    """
+        判断文件是否是缓存中的ipk
+    :param file:
+    :return:
+    """
+    return IPK_CACHE is not None and os.path.dirname(file) == IPK_CACHE.cache_path
 
-        # 此处我们需要判断是否有在更新，有在更新的话需要等待更新结束！
-        while is_git_updating():
-            LOGGER.warning("正在更新仓库，生产暂停中，稍后自动开启...")
-            time.sleep(1)
 
-        task_code = task['code']  # 任务的唯一标志码
+def run_pkg_impl(state: Future, task):
+    """
+        在线程池中执行一个打包任务，结果设置到任务的状态对象
+    :param state: 任务的状态对象，任务添加时就已经创建
+    :param task: 任务参数
+    :return:
+    """
+    if not state.set_running_or_notify_cancel():
+        return
+    try:
         device_typ = task['type']  # 设备的软件区分类型
 
         # 获得映射的实体类
@@ -337,28 +549,75 @@ def run_pkg_task():
         # 建立对象
         obj_icopy = clz_icopy(task)
 
-        # 提交一个任务到线程池
-        STATE_LIST[task_code] = POOL_TASK.submit(
-            # 将执行的打包处理函数
-            app_generator.make_app_package,
-
+        state.set_result(make_app_package_cached(
             # 参数
+            get_task_cache_key(task),  # 构建结果缓存的键
             PROJECT_APP_SOURCE_PATH,  # 项目所在的目录
             PROJECT_DEP_SOURCE_PATH,  # 项目的依赖项所在的目录
             PROJECT_APP_OUTPUT_PATH,  # 项目编译后的输出目录
             PROJECT_STD_APPPKG_PATH,  # 标准规范包的路径
             obj_icopy,  # 需要被编译打包的固件类型实现类
-        )
-        # 在任务完成后自减计数
-        STATE_LIST[task_code].add_done_callback(
-            lambda x: TASK_COUNT.decrement()
-        )
+            PROJECT_SO_CACHE_PATH,  # 共享运行库缓存的目录
+            APP_COMMIT_HASH,  # 当前的提交HASH
+            PROJECT_BASE_APPPKG_PATH,  # 各个设备类型的基础包的目录
+            progress=PROGRESS_LIST.get(task['code']),  # 构建进度
+        ))
+    except Exception as e:
+        LOGGER.error(f"打包任务执行失败: {e}")
+        if task['code'] in PROGRESS_LIST:
+            PROGRESS_LIST[task['code']].finish(False, str(e))
+        state.set_exception(e)
+
+
+def on_warmup_task_done(future):
+    """
+        预热任务完成后，释放线程池的位置
+    :param future:
+    :return:
+    """
+    POOL_TASK_SLOTS.release()
+
+
+def on_pkg_task_done(state):
+    """
+        任务完成后，自减计数并且释放线程池的位置
+    :param state:
+    :return:
+    """
+    TASK_COUNT.decrement()
+    POOL_TASK_SLOTS.release()
+
+
+def run_pkg_task():
+    """
+        实际上的编译器编译实现的过程
+    :return:
+    """
+    while True:
+        # 有空闲的位置之后，再取出当前优先级最高的任务
+        POOL_TASK_SLOTS.acquire()
+        task_code, task = SCHEDULER.get()
+
+        # 此处我们需要判断是否有在更新，有在更新的话需要等待更新结束！
+        while is_git_updating():
+            LOGGER.warning("正在更新仓库，生产暂停中，稍后自动开启...")
+            time.sleep(1)
+
+        # 预热任务不计入打包任务的计数
+        if task_code.startswith(WARMUP_CODE_PREFIX):
+            POOL_TASK.submit(run_warmup_job, task).add_done_callback(on_warmup_task_done)
+            continue
+
+        state: Future = STATE_LIST[task_code]
 
         # 当前任务计数递增
         TASK_COUNT.increment()
 
-        # 设置队列任务完成标志位
-        QUEUE_TASK.task_done()
+        # 在任务完成后自减计数
+        state.add_done_callback(on_pkg_task_done)
+
+        # 提交一个任务到线程池
+        POOL_TASK.submit(run_pkg_impl, state, task)
 
 
 def start_flask_api():
@@ -437,6 +696,9 @@ def start_make_std_pkg():
     if not os.path.exists(PROJECT_STD_APPPKG_BASE):
         os.makedirs(PROJECT_STD_APPPKG_BASE, exist_ok=True)
 
+    # 基础包是在标准包之上制作的，标准包更新后需要全部重新制作
+    shutil.rmtree(PROJECT_BASE_APPPKG_PATH, ignore_errors=True)
+
     make_success = app_generator.make_std_package(
         PROJECT_APP_SOURCE_PATH,
         PROJECT_STD_APPPKG_BASE,
@@ -445,6 +707,127 @@ def start_make_std_pkg():
     if not make_success:
         raise Exception("无法构建有效的标准规范包！")
 
+    # 标准包更新后，记录当前的提交，并且清理旧提交的运行库缓存
+    global APP_COMMIT_HASH
+    log = get_log("")
+    APP_COMMIT_HASH = None if log is None else log['hash'].strip()
+    if APP_COMMIT_HASH is not None:
+        app_generator.clean_so_cache(PROJECT_SO_CACHE_PATH, APP_COMMIT_HASH)
+
+    # 每个提交只需要预处理一次源码，打包任务中只执行设备相关的处理
+    app_generator.prepare_sources(PROJECT_APP_SOURCE_PATH, APP_COMMIT_HASH, icopy_maps.get_gen_file_names())
+
+    # 标准包更新后，在后台预热各个设备类型的构建
+    start_warmup(APP_COMMIT_HASH)
+
+
+def is_warmup_running():
+    with WARMUP_LOCK:
+        return WARMUP_RUNNING
+
+
+def add_warmup_hw_version(values):
+    """
+        记录生产任务中出现的硬件版本，下次更新后也预热该硬件版本对应的构建
+    :param values: 任务的参数
+    :return:
+    """
+    if "hw_version_main" in values and "hw_version_sub" in values:
+        with WARMUP_LOCK:
+            WARMUP_HW_VERSIONS.add((str(values["hw_version_main"]), str(values["hw_version_sub"])))
+
+
+def put_next_warmup_job():
+    """
+        将下一个等待中的预热任务以最低的优先级加入调度器，预热任务逐个执行
+    :return:
+    """
+    with WARMUP_LOCK:
+        jobs = WARMUP_STATE['jobs']
+        # 旧提交的预热任务结束时，新提交的预热任务可能已经在排队
+        if any(job['state'] in ("queued", "running") for job in jobs):
+            return
+        for index, job in enumerate(jobs):
+            if job['state'] == "pending":
+                job['state'] = "queued"
+                SCHEDULER.put(f"{WARMUP_CODE_PREFIX}{index}", job, PRIORITY_WARMUP, WARMUP_SOURCE, aging=False)
+                return
+
+
+def run_warmup_job(job):
+    """
+        执行一个预热任务，由调度器在没有排队的打包任务时取出
+    :param job: 预热任务的状态
+    :return:
+    """
+    global WARMUP_RUNNING
+
+    # 等待仓库更新完成
+    while True:
+        with WARMUP_LOCK:
+            if job['commit'] != APP_COMMIT_HASH:
+                # 仓库已经更新了，预热旧的提交已经没有意义，新的提交会重新添加预热任务
+                job['state'] = "cancelled"
+                return
+            if not is_git_updating():
+                WARMUP_RUNNING = True
+                job['state'] = "running"
+                break
+        time.sleep(1)
+
+    start = time.perf_counter()
+    success = False
+    try:
+        clz_icopy = icopy_maps.getICopyClz4Name(job['type'])
+        obj_icopy = clz_icopy({
+            "type": job['type'],
+            "hw_version_main": job['hw_version_main'],
+            "hw_version_sub": job['hw_version_sub'],
+        })
+        success = app_generator.warmup_package(
+            PROJECT_APP_SOURCE_PATH,
+            PROJECT_DEP_SOURCE_PATH,
+            PROJECT_STD_APPPKG_PATH,
+            obj_icopy,
+            PROJECT_SO_CACHE_PATH,
+            job['commit'],
+            PROJECT_BASE_APPPKG_PATH,
+        )
+    except Exception as e:
+        LOGGER.error(f"预热失败: {e}")
+    finally:
+        with WARMUP_LOCK:
+            job['state'] = "done" if success else "failed"
+            job['time'] = time.perf_counter() - start
+            WARMUP_RUNNING = False
+        put_next_warmup_job()
+
+
+def start_warmup(commit):
+    """
+        为每个设备类型与硬件版本添加预热任务
+    :param commit: 当前的提交HASH
+    :return:
+    """
+    if commit is None:
+        return
+    jobs = []
+    with WARMUP_LOCK:
+        for typ in icopy_maps.TYPE_TO_CLZ_MAPS.keys():
+            for hw_main, hw_sub in sorted(WARMUP_HW_VERSIONS):
+                jobs.append({
+                    "type": typ,
+                    "hw_version_main": hw_main,
+                    "hw_version_sub": hw_sub,
+                    "commit": commit,
+                    "state": "pending",
+                    "time": None,
+                })
+        WARMUP_STATE['commit'] = commit
+        WARMUP_STATE['jobs'] = jobs
+    LOGGER.info(f"添加预热任务: {len(jobs)} 个，提交: {commit}")
+    put_next_warmup_job()
+
 
 def make_path_exists(path):
     """
@@ -466,13 +849,19 @@ def start_pkg_app():
     make_path_exists(PROJECT_DEP_SOURCE_PATH)
     make_path_exists(PROJECT_APP_OUTPUT_PATH)
     make_path_exists(PROJECT_STD_APPPKG_BASE)
+    make_path_exists(PROJECT_SO_CACHE_PATH)
+    make_path_exists(PROJECT_IPK_CACHE_PATH)
+
+    # 从缓存目录恢复构建结果缓存
+    global IPK_CACHE
+    IPK_CACHE = ipk_cache.IpkCache(PROJECT_IPK_CACHE_PATH, IPK_CACHE_SIZE_MAX, IPK_CACHE_AGE_MAX)
 
     # 先从仓库克隆手持机资源
     start_make_repo_clone()
-    # 然后检查资源更新
-    resource_update()
-    # 然后构建标准包
-    start_make_std_pkg()
+    # 然后检查资源更新，有更新时已经构建了标准包
+    if not resource_update():
+        # 然后构建标准包
+        start_make_std_pkg()
     # 启动打包器任务轮询队列
     # 此时进行一些构建任务了
     start_pkg_queue_loop()
@@ -524,14 +913,40 @@ def flask_api_add_task():
         if typ not in icopy_maps.TYPE_TO_CLZ_MAPS:
             return f"只支持: {','.join(icopy_maps.TYPE_TO_CLZ_MAPS.keys())} 这几种设备版本类型。"
 
+        # 记录硬件版本，用于之后的预热
+        add_warmup_hw_version(values)
+
+        # 同样的任务在当前的提交下已经构建过，直接使用缓存的结果
+        if IPK_CACHE is not None:
+            cache_file = IPK_CACHE.get(get_task_cache_key(values))
+            if cache_file is not None:
+                task = Future()
+                task.set_result(cache_file)
+                progress = app_generator.BuildProgress()
+                progress.finish(True, cached=True)
+                PROGRESS_LIST[code] = progress
+                STATE_LIST[code] = task
+                LOGGER.info(f"构建结果缓存命中: {values}")
+                return code
+
         # 创建一个缓存信息的对象
         values_new = dict(values)
         # 添加一个UUID用于标志当前的任务
         values_new['code'] = code
+        # 工厂生产的任务优先于OTA的任务
+        if str(values.get('fac_auto_make', False)) == "True":
+            priority = PRIORITY_FACTORY
+        else:
+            priority = PRIORITY_OTA
+        # 任务的来源，用于在各个工作站之间轮流调度
+        source = values.get('source', request.remote_addr)
+        # 任务在排队的时候就已经可以查询状态与进度
+        PROGRESS_LIST[code] = app_generator.BuildProgress()
+        STATE_LIST[code] = Future()
         # 提交任务
-        QUEUE_TASK.put(values_new)
+        SCHEDULER.put(code, values_new, priority, source)
         # 缓存任务
-        LOGGER.info(f"将进行生产过程的数据: {values_new}")
+        LOGGER.info(f"将进行生产过程的数据: {values_new}，优先级: {priority}，来源: {source}")
 
         return code
 
@@ -539,10 +954,117 @@ def flask_api_add_task():
 @FLASK_APP.route("/progress")
 def flask_api_progress():
     """
-        获取一个任务的进度
+        获取一个任务的构建进度（json）
+        ?code=任务码 -> 立即返回当前的进度
+        ?code=任务码&stream=1 -> 以流的形式持续返回进度，每次进度变化返回一行json，任务结束后关闭
+        ?code=任务码&version=进度版本&timeout=超时 -> 阻塞等待进度变化后返回
+    :return:
+    """
+    if 'code' not in request.values:
+        return "noparam"
+    code = request.values['code']
+    if code not in PROGRESS_LIST:
+        return "unknown"
+    progress: app_generator.BuildProgress = PROGRESS_LIST[code]
+
+    def get_progress():
+        ret = progress.to_dict()
+        # 排队中的任务同时返回在队列中的位置
+        ret['position'] = SCHEDULER.position(code)
+        return json.dumps(ret)
+
+    if request.values.get('stream') == "1":
+        def generate():
+            version = None
+            while True:
+                # 排队中的位置变化不会更新进度版本，需要定时返回
+                progress.wait_change(version, 1)
+                version = progress.version
+                yield get_progress() + "\n"
+                if progress.is_finished():
+                    break
+
+        return current_app.response_class(generate(), mimetype='application/x-ndjson')
+
+    if 'version' in request.values:
+        timeout = min(float(request.values.get('timeout', WAIT_TIMEOUT_MAX)), WAIT_TIMEOUT_MAX)
+        progress.wait_change(int(request.values['version']), timeout)
+    return get_progress()
+
+
+@FLASK_APP.route("/warmup")
+def flask_api_warmup():
+    """
+        获取预热任务的进度，全部完成后生产任务的构建只需要编译与设备有关的运行库
+    :return:
+    """
+    with WARMUP_LOCK:
+        jobs = [dict(job) for job in WARMUP_STATE['jobs']]
+        commit = WARMUP_STATE['commit']
+    count = dict()
+    for job in jobs:
+        count[job['state']] = count.get(job['state'], 0) + 1
+    return json.dumps({
+        "commit": commit,
+        "total": len(jobs),
+        "pending": count.get("pending", 0),
+        "queued": count.get("queued", 0),
+        "running": count.get("running", 0),
+        "done": count.get("done", 0),
+        "failed": count.get("failed", 0),
+        "cancelled": count.get("cancelled", 0),
+        "ready": len(jobs) > 0 and count.get("done", 0) == len(jobs),
+        "jobs": jobs,
+    })
+
+
+@FLASK_APP.route("/cache")
+def flask_api_cache():
+    """
+        获取构建结果缓存的统计信息
+    :return:
+    """
+    if IPK_CACHE is None:
+        return json.dumps(None)
+    return json.dumps(IPK_CACHE.stats())
+
+
+@FLASK_APP.route("/position")
+def flask_api_position():
+    """
+        获取一个任务在队列中的位置
+        排队中返回前面的任务数量（下一个执行的任务为0），
+        已经开始执行返回running，已经完成返回done
+    :return:
+    """
+    if 'code' in request.values:
+        code = request.values['code']
+        if code not in STATE_LIST:
+            return "unknown"
+        position = SCHEDULER.position(code)
+        if position is not None:
+            return str(position)
+        return "done" if STATE_LIST[code].done() else "running"
+    else:
+        return "noparam"
+
+
+@FLASK_APP.route("/queue")
+def flask_api_queue():
+    """
+        获取各个来源排队中的任务数量
+    :return:
+    """
+    return json.dumps(SCHEDULER.stats())
+
+
+@FLASK_APP.route("/http")
+def flask_api_http():
+    """
+        获取与编译服务器等之间的连接复用统计信息
     :return:
     """
-    # TODO 待实现
+    return json.dumps(generator_utils.get_http_stats())
 
 
 @FLASK_APP.route("/ok")
@@ -564,6 +1086,27 @@ def flask_api_ok():
     return "notget"
 
 
+@FLASK_APP.route("/wait")
+def flask_api_wait():
+    """
+        阻塞等待一个任务完成，任务完成时立即返回，超时返回False
+    :return:
+    """
+    if request.method == 'GET':
+        if 'code' in request.values:
+            code = request.values['code']
+            timeout = min(float(request.values.get('timeout', WAIT_TIMEOUT_MAX)), WAIT_TIMEOUT_MAX)
+            if code in STATE_LIST:
+                task = STATE_LIST[code]
+                wait([task], timeout)
+                return str(task.done())
+            else:
+                return "unknown"
+        else:
+            return "noparam"
+    return "notget"
+
+
 @FLASK_APP.route("/download")
 def flask_api_download():
     """
@@ -574,31 +1117,95 @@ def flask_api_download():
         code = request.values['code']
         if code in STATE_LIST:
             task = STATE_LIST[code]
-            file = task.result()
+            try:
+                file = task.result()
+            except Exception as e:
+                LOGGER.error(f"任务执行失败: {e}")
+                file = None
 
             if file is None or not os.path.exists(file):
                 del STATE_LIST[code]
+                PROGRESS_LIST.pop(code, None)
                 return "failed"
 
-            def generate():
-                with open(file, mode='rb') as f:
-                    yield from f
-                try:
-                    os.remove(file)
-                except Exception as e:
-                    print("自动移除文件失败: ", e)
+            def on_complete():
+                # 缓存中的ipk由缓存负责淘汰，不需要删除
+                if not is_cached_file(file):
+                    try:
+                        os.remove(file)
+                    except Exception as e:
+                        print("自动移除文件失败: ", e)
                 try:
                     del STATE_LIST[code]
+                    PROGRESS_LIST.pop(code, None)
                 except Exception as e:
                     print("移除任务失败: ", e)
 
-            r = current_app.response_class(generate(), mimetype='application/octet-stream')
-            r.headers.set('Content-Disposition', 'attachment', filename=os.path.basename(file))
+            # 以文件的摘要作为ETag，并且提供摘要，下载端可以校验文件是否完整
+            digest = generator_utils.get_file_digest(file)
+            r = server_utils.make_file_response(file, os.path.basename(file), etag=digest, on_complete=on_complete)
+            r.headers.set('Digest', "sha-256=" + base64.b64encode(bytes.fromhex(digest)).decode())
             return r
         else:
             return "unknown"
     return "不支持非GET请求查询"
 
 
+def benchmark_download(file_size=256 * 1024 * 1024, rounds=3):
+    """
+        对比逐行迭代文件与固定大块发送文件的下载速度，
+        在本地回环上测试，结果接近链路速度说明发送端不再是瓶颈
+    :param file_size: 测试文件的大小
+    :param rounds: 每种方式测试的次数
+    :return:
+    """
+    import tempfile
+    from werkzeug.serving import make_server
+
+    app = Flask("benchmark_download")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file = os.path.join(tmp_dir, "bench.ipk")
+        with open(file, "wb") as fd:
+            fd.write(os.urandom(file_size))
+        digest = generator_utils.get_file_digest(file)
+
+        @app.route("/legacy")
+        def bench_legacy():
+            def generate():
+                with open(file, mode='rb') as f:
+                    yield from f
+
+            r = current_app.response_class(generate(), mimetype='application/octet-stream')
+            r.headers.set('Content-Disposition', 'attachment', filename="legacy.ipk")
+            return r
+
+        @app.route("/chunked")
+        def bench_chunked():
+            return server_utils.make_file_response(file, "chunked.ipk", etag=digest)
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for name in ["legacy", "chunked"]:
+                url = f"http://127.0.0.1:{server.server_port}/{name}"
+                cost = []
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    down_file = generator_utils.download_file(url, tmp_dir)
+                    cost.append(time.perf_counter() - start)
+                    same = generator_utils.get_file_digest(down_file) == digest
+                    os.remove(down_file)
+                speed = file_size / min(cost) / 1024 / 1024
+                print(f"{name}: 最快 {min(cost):.3f}s, {speed:.1f}MB/s, 文件一致: {same}")
+        finally:
+            server.shutdown()
+
+
 if __name__ == '__main__':
-    start_pkg_app()
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark_download()
+    else:
+        start_pkg_app()
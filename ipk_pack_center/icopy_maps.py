@@ -141,6 +141,40 @@ def genTagTypesMapRow(content: str, typ, readable=None, writeable=None):
     return content.replace(replace_line, new_row)
 
 
+# 标签映射表的行，从类型名到最后一个右括号，与 genTagTypesMapRow 匹配的行范围一致
+REGEX_TAG_TYPES_ROW = re.compile(r'^[ \t]*((\w+)\s*:\s*\(.*\))', re.MULTILINE)
+# 标签映射表的行中的参数
+REGEX_TAG_TYPES_ARGS = re.compile(r'\(\s*"(.*)"\s*,\s*(False|True)\s*,\s*(False|True)\s*,*\)')
+
+
+def genTagTypesMapRows(content: str, rows):
+    """
+        一次扫描生成多个类型的字典行，结果与逐个调用 genTagTypesMapRow 一致
+    :param content:
+    :param rows: 类型到 (readable, writeable) 的映射，值为None时保持原值
+    :return:
+    """
+    found = dict()
+
+    def replace(match):
+        typ = match.group(2)
+        if typ not in rows:
+            return match.group(0)
+        line = found.setdefault(typ, match.group(1))
+        args = REGEX_TAG_TYPES_ARGS.search(line)
+        if line != match.group(1) or args is None:
+            return match.group(0)
+        readable, writeable = rows[typ]
+        if readable is None:
+            readable = args.group(2)
+        if writeable is None:
+            writeable = args.group(3)
+        new_row = '{}: ("{}", {}, {})'.format(typ, args.group(1), readable, writeable)
+        return match.group(0).replace(line, new_row)
+
+    return REGEX_TAG_TYPES_ROW.sub(replace, content)
+
+
 class BaseICopyGenerator(abs_generator.ICopyGenerator):
     """
         基础生产实现类定义
@@ -313,6 +347,24 @@ class XGen(BaseICopyGenerator):
         单独实现的ICopyX的代码生成工具类
     """
 
+    # 需要禁用的标签类型
+    TAG_FALSE_TYPES = {
+        # "M1_S50_1K_4B": (False, False),
+
+        "M1_S50_1K_7B": (False, False),
+        "M1_S70_4K_4B": (False, False),
+        "M1_S70_4K_7B": (False, False),
+
+        "M1_POSSIBLE_4B": (False, False),
+        "M1_POSSIBLE_7B": (False, False),
+
+        "M1_MINI": (False, False),
+        "M1_PLUS_2K": (False, False),
+
+        "ICLASS_ELITE": (False, False),
+        "ICLASS_LEGACY": (False, False),
+    }
+
     def onGetGenFileMap(self):
         return {
             "appfiles.py": None,
@@ -402,21 +454,7 @@ class XGen(BaseICopyGenerator):
             2、iclass的读写
         :return:
         """
-        # content = self.genTagTypesMapRow(content, tagtypes.M1_S50_1K_4B, False, False)
-
-        content = genTagTypesMapRow(content, "M1_S50_1K_7B", False, False)
-        content = genTagTypesMapRow(content, "M1_S70_4K_4B", False, False)
-        content = genTagTypesMapRow(content, "M1_S70_4K_7B", False, False)
-
-        content = genTagTypesMapRow(content, "M1_POSSIBLE_4B", False, False)
-        content = genTagTypesMapRow(content, "M1_POSSIBLE_7B", False, False)
-
-        content = genTagTypesMapRow(content, "M1_MINI", False, False)
-        content = genTagTypesMapRow(content, "M1_PLUS_2K", False, False)
-
-        content = genTagTypesMapRow(content, "ICLASS_ELITE", False, False)
-        content = genTagTypesMapRow(content, "ICLASS_LEGACY", False, False)
-        return content
+        return genTagTypesMapRows(content, self.TAG_FALSE_TYPES)
 
     def getTypeName(self):
         return TYPE_ICOPY_X
@@ -427,6 +465,12 @@ class XRGen(BaseICopyGenerator):
         单独实现的ICopyXR的代码生成工具类
     """
 
+    # 需要禁用的标签类型
+    TAG_FALSE_TYPES = {
+        "ICLASS_ELITE": (False, False),
+        "ICLASS_LEGACY": (False, False),
+    }
+
     def onGetGenFileMap(self):
         return {
             "appfiles.py": None,
@@ -515,9 +559,7 @@ class XRGen(BaseICopyGenerator):
         :return:
         """
 
-        content = genTagTypesMapRow(content, "ICLASS_ELITE", False, False)
-        content = genTagTypesMapRow(content, "ICLASS_LEGACY", False, False)
-        return content
+        return genTagTypesMapRows(content, self.TAG_FALSE_TYPES)
 
     def getTypeName(self):
         return TYPE_ICOPY_XR
@@ -640,6 +682,12 @@ class ZHGen(BaseICopyGenerator):
         中文版本
     """
 
+    # 需要禁用的标签类型
+    TAG_FALSE_TYPES = {
+        "ICLASS_ELITE": (False, False),
+        "ICLASS_LEGACY": (False, False),
+    }
+
     def onGetGenFileMap(self):
         return {
             "appfiles.py": None,
@@ -723,9 +771,7 @@ class ZHGen(BaseICopyGenerator):
         :return:
         """
 
-        content = genTagTypesMapRow(content, "ICLASS_ELITE", False, False)
-        content = genTagTypesMapRow(content, "ICLASS_LEGACY", False, False)
-        return content
+        return genTagTypesMapRows(content, self.TAG_FALSE_TYPES)
 
     def getTypeName(self):
         return TYPE_ICOPY_ZH
@@ -782,6 +828,17 @@ TYPE_TO_CLZ_MAPS = {
 }
 
 
+def get_gen_file_names():
+    """
+        获取所有设备类型的白名单文件的合集
+    :return:
+    """
+    names = set()
+    for clz in TYPE_TO_CLZ_MAPS.values():
+        names.update(clz(dict()).maps.keys())
+    return names
+
+
 def getICopyClz4Name(name):
     """
         获得从设备类型名称到设备类型实现类的映射
@@ -838,3 +895,106 @@ def get_type_factory_name(typ_str):
     :return:
     """
     return TYPE_TO_FAC_MAPS[typ_str]
+
+
+def benchmark(project_path, rounds=5):
+    """
+        对比逐个正则转换与编译好的转换计划的代码生成耗时，
+        同时校验两者生成的代码是否逐字节一致
+    :param project_path: APP项目所在目录，读取其中act与gui目录下的py文件
+    :param rounds: 每个设备类型重复生成的次数
+    :return:
+    """
+    import time
+
+    sources = dict()
+    for sub_dir in ("act", "gui"):
+        for root, dirs, files in os.walk(os.path.join(project_path, sub_dir)):
+            for file in files:
+                if file.endswith(".py"):
+                    with open(os.path.join(root, file), encoding="utf-8") as fd:
+                        sources[file] = fd.read()
+
+    bundle = {
+        "sn_str": "00000001", "os_ver_major": 1, "os_ver_minor": 0,
+        "hw_version_main": 1, "hw_version_sub": 8, "pm": "1.0",
+        "id_cpu": "cpu", "id_pm3": "pm3", "id_stm32": "stm32",
+    }
+
+    def legacy_print_close(content):
+        # 旧实现：关闭print，替换为pass占位符
+        return re.sub(r'(?<= )print\(.*\)', "pass", content)
+
+    def legacy_debug_close(content):
+        # 旧实现：关闭debug，逐个以文本替换删除代码段
+        for debug_code in re.findall(r'\s*?# 测试开始 <[\s\S]*?# 测试结束 >', content):
+            content = content.replace(debug_code, "")
+        return content
+
+    def legacy_generate(gen_obj, name, content):
+        # 逐个正则转换的旧实现
+        if name not in gen_obj.maps:
+            return None
+        if gen_obj.close_print:
+            content = legacy_print_close(content)
+        if gen_obj.close_debug:
+            content = legacy_debug_close(content)
+        fun = gen_obj.maps[name]
+        if fun is None:
+            return content
+        if fun == gen_obj.genVerAll:
+            for gen_fun in (gen_obj.genSN, gen_obj.genVer, gen_obj.genHW,
+                            gen_obj.genPM3, gen_obj.genTYP, gen_obj.genUID):
+                content = gen_fun(content)
+            return content
+        if fun == getattr(gen_obj, "genTagFalseTypes", None):
+            for typ, (readable, writeable) in gen_obj.TAG_FALSE_TYPES.items():
+                content = genTagTypesMapRow(content, typ, readable, writeable)
+            return content
+        return fun(content)
+
+    print(f"源文件数量: {len(sources)}，重复次数: {rounds}")
+    for typ_name, clz in TYPE_TO_CLZ_MAPS.items():
+        gen_obj = clz(dict(bundle))
+        count = len([name for name in sources.keys() if name in gen_obj.maps])
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            legacy = {name: legacy_generate(gen_obj, name, content) for name, content in sources.items()}
+        legacy_time = (time.perf_counter() - start) / rounds
+
+        gen_obj.memo_enable = False
+        start = time.perf_counter()
+        for _ in range(rounds):
+            planned = {name: gen_obj.onGenerator(name, content) for name, content in sources.items()}
+        planned_time = (time.perf_counter() - start) / rounds
+
+        # 每一轮使用不同的序列号，只有依赖序列号的文件需要重新生成
+        abs_generator.clear_memo()
+        memo_same = True
+        memo_time = 0
+        for index in range(rounds):
+            memo_obj = clz(dict(bundle, sn_str=f"{index:08d}"))
+            start = time.perf_counter()
+            memoized = {name: memo_obj.onGenerator(name, content) for name, content in sources.items()}
+            memo_time += (time.perf_counter() - start) / rounds
+            memo_obj.memo_enable = False
+            memo_same = memo_same and memoized == {
+                name: memo_obj.onGenerator(name, content) for name, content in sources.items()
+            }
+
+        print(f"{typ_name:<14} 文件: {count:>3}, "
+              f"逐个正则: {legacy_time * 1000:8.2f}ms/设备 {legacy_time * 1000 / max(count, 1):6.3f}ms/文件, "
+              f"转换计划: {planned_time * 1000:8.2f}ms/设备 {planned_time * 1000 / max(count, 1):6.3f}ms/文件, "
+              f"缓存(不同SN): {memo_time * 1000:8.2f}ms/设备, "
+              f"输出一致: {legacy == planned and memo_same}")
+    print("生成结果缓存: ", abs_generator.get_memo_stats())
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print("用法: python icopy_maps.py APP项目所在目录")
+    else:
+        benchmark(sys.argv[1])
@@ -0,0 +1,206 @@
+"""
+    ipk构建结果的磁盘缓存
+    以任务参数与APP提交的HASH为键保存已经构建好的ipk，
+    同样的任务（例如上传失败后重试，下载失败后重新生产）可以直接复用，不需要重新构建
+
+    缓存有总大小与存放时间的限制，超出限制时淘汰最久没有使用的ipk，
+    文件的修改时间即最后使用的时间，重启之后从缓存目录恢复
+    缓存文件名为 {键}.{随机ID}.ipk
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+# 缓存的ipk文件的后缀
+CACHE_FILE_SUFFIX = ".ipk"
+
+
+def get_cache_key(values, commit, dep_commit):
+    """
+        根据任务参数与提交HASH生成缓存的键
+    :param values: 任务参数
+    :param commit: APP仓库当前的提交HASH
+    :param dep_commit: 依赖仓库(固件)当前的提交HASH
+    :return: 任意提交HASH为None时不能缓存，返回None
+    """
+    if commit is None or dep_commit is None:
+        return None
+    content = json.dumps({"values": dict(values), "commit": commit, "dep_commit": dep_commit}, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class IpkCache:
+    """
+        ipk构建结果缓存
+        每次放入的ipk都使用唯一的文件名，不会覆盖可能正在被下载的文件，
+        Windows下打开中的文件无法删除，删除失败的文件会被记录下来稍后重试
+    """
+
+    def __init__(self, cache_path, size_max, age_max):
+        """
+            初始化缓存，恢复缓存目录中已有的ipk
+        :param cache_path: 缓存目录
+        :param size_max: 缓存的总大小上限(byte)
+        :param age_max: 缓存最长的存放时间(s)，从最后一次使用开始计算
+        """
+        self.cache_path = cache_path
+        self.size_max = size_max
+        self.age_max = age_max
+        self.lock = threading.RLock()
+        # 键到 (缓存文件, 文件大小, 最后使用时间) 的映射，按照最后使用的时间排序
+        self.entries = OrderedDict()
+        # 已经不在缓存中，但是删除失败(正在被下载)的文件
+        self.pending = set()
+        self.size = 0
+        self.hit = 0
+        self.miss = 0
+        self.evicted = 0
+
+        os.makedirs(cache_path, exist_ok=True)
+        files = []
+        for name in os.listdir(cache_path):
+            file = os.path.join(cache_path, name)
+            if not name.endswith(CACHE_FILE_SUFFIX) or not os.path.isfile(file):
+                continue
+            stat = os.stat(file)
+            files.append((stat.st_mtime, name.split(".", 1)[0], file, stat.st_size))
+        for mtime, key, file, size in sorted(files):
+            # 同一个键有多个文件时，保留最后使用的那一个
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (file, size, mtime)
+            self.size += size
+        self.evict()
+
+    def new_file(self, key):
+        """
+            为键生成一个新的缓存文件路径
+        :param key:
+        :return:
+        """
+        return os.path.join(self.cache_path, f"{key}.{uuid.uuid4().hex}{CACHE_FILE_SUFFIX}")
+
+    def get(self, key):
+        """
+            查找缓存
+        :param key: 缓存的键
+        :return: 缓存的ipk文件，没有命中时返回None
+        """
+        with self.lock:
+            if key is None or key not in self.entries:
+                self.miss += 1
+                return None
+            file, size, _ = self.entries[key]
+            now = time.time()
+            try:
+                # 更新最后使用的时间，重启之后以此恢复使用顺序
+                os.utime(file, (now, now))
+            except FileNotFoundError:
+                # 文件被外部删除了
+                self.remove(key)
+                self.miss += 1
+                return None
+            except OSError as e:
+                # 只是无法记录使用时间，缓存仍然可用
+                LOGGER.warning(f"更新缓存的ipk使用时间失败: {e}")
+            self.entries[key] = (file, size, now)
+            self.entries.move_to_end(key)
+            self.hit += 1
+            return file
+
+    def put(self, key, file):
+        """
+            将构建好的ipk移动到缓存中，失败时不影响构建的结果
+        :param key: 缓存的键，为None时不缓存
+        :param file: 构建好的ipk文件
+        :return: 缓存中的文件，不缓存时返回原文件
+        """
+        if key is None or file is None or not os.path.exists(file):
+            return file
+        cache_file = self.new_file(key)
+        with self.lock:
+            try:
+                os.replace(file, cache_file)
+                size = os.path.getsize(cache_file)
+            except OSError as e:
+                LOGGER.warning(f"放入缓存失败，使用原始的构建结果: {e}")
+                return file if os.path.exists(file) else cache_file
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (cache_file, size, time.time())
+            self.size += size
+            self.evict(keep=key)
+        return cache_file
+
+    def remove(self, key):
+        """
+            删除一个缓存，删除失败的文件稍后重试
+        :param key:
+        :return:
+        """
+        with self.lock:
+            file, size, _ = self.entries.pop(key)
+            self.size -= size
+            self.pending.add(file)
+            self.purge()
+
+    def purge(self):
+        """
+            删除已经不在缓存中的文件，仍然无法删除的留到下一次
+        :return:
+        """
+        with self.lock:
+            for file in list(self.pending):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    LOGGER.debug(f"缓存的ipk暂时无法删除: {e}")
+                    continue
+                self.pending.discard(file)
+
+    def evict(self, keep=None):
+        """
+            淘汰超出大小或者存放时间的缓存，最久没有使用的最先被淘汰
+        :param keep: 不允许被淘汰的键（刚刚放入的缓存）
+        :return:
+        """
+        with self.lock:
+            self.purge()
+            expired = time.time() - self.age_max
+            for key in list(self.entries.keys()):
+                _, size, used = self.entries[key]
+                if key == keep:
+                    continue
+                if self.size <= self.size_max and used >= expired:
+                    break
+                self.remove(key)
+                self.evicted += 1
+
+    def stats(self):
+        """
+            获取缓存的统计信息
+        :return:
+        """
+        with self.lock:
+            return {
+                "count": len(self.entries),
+                "size": self.size,
+                "size_max": self.size_max,
+                "age_max": self.age_max,
+                "hit": self.hit,
+                "miss": self.miss,
+                "evicted": self.evicted,
+                "pending": len(self.pending),
+            }
@@ -0,0 +1,365 @@
+"""
+    ipk写入器，一次打开ipk文件包，写入所有的条目，
+    写入的同时记录信息表，最后写入manifest.json并且只在关闭时生成一次压缩包目录
+
+    条目的压缩在线程池中并行进行（zlib在压缩时会释放GIL），
+    压缩好的数据按照提交的顺序写入压缩包，输出与zipfile串行压缩的结果一致
+
+    压缩的同时计算每个文件的SHA-256，写入信息表时再计算整个包的摘要，
+    设备与上传工具可以直接校验，不需要重新读取或者解压文件
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+import zlib
+
+from concurrent.futures.thread import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+LOGGER = logging.getLogger(__name__)
+
+# 信息表在ipk中的文件名
+MANIFEST_FILE = "manifest.json"
+
+# 压缩条目的线程池，所有的ipk写入器共用
+COMPRESS_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="ipk_deflate_")
+# 等待写入的条目超过此数量时，先写入已经压缩完成的条目，避免占用过多的内存
+COMPRESS_WINDOW = (os.cpu_count() or 1) * 4
+
+
+def new_manifest():
+    """
+        创建一个空的信息表
+    :return:
+    """
+    return {"path": [], "file": [], "crc32": {}, "sha256": {}}
+
+
+def merge_manifest(manifest, other):
+    """
+        合并另一个（部分的）信息表
+    :param manifest: 合并到的信息表
+    :param other: 被合并的信息表
+    :return:
+    """
+    manifest['path'].extend(other.get('path', []))
+    manifest['file'].extend(other.get('file', []))
+    manifest['crc32'].update(other.get('crc32', {}))
+    manifest['sha256'].update(other.get('sha256', {}))
+    return manifest
+
+
+def get_manifest_file(ipk_file):
+    """
+        获取ipk对应的信息表文件，标准包与基础包制作完成的时候会保存其中已有条目的信息表
+    :param ipk_file: ipk文件
+    :return:
+    """
+    return ipk_file + ".json"
+
+
+def load_manifest(ipk_file):
+    """
+        读取ipk对应的信息表文件
+    :param ipk_file: ipk文件
+    :return: 信息表，不存在或者无法读取时返回None
+    """
+    try:
+        with open(get_manifest_file(ipk_file)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def get_package_digest(manifest):
+    """
+        计算整个包的摘要，由所有文件的路径与SHA-256按照写入的顺序计算而来
+    :param manifest: 信息表
+    :return:
+    """
+    digest = hashlib.sha256()
+    for name in manifest['file']:
+        digest.update(f"{name}:{manifest['sha256'].get(name, '')}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def compress_entry(data, compress_type):
+    """
+        压缩一个条目的数据，与zipfile使用相同的参数，保证输出的数据完全一致
+    :param data: 未压缩的数据
+    :param compress_type: 压缩方式，只支持ZIP_DEFLATED与ZIP_STORED
+    :return: 压缩后的数据，以及未压缩的数据的CRC32与SHA-256
+    """
+    crc = zlib.crc32(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return data, crc, sha256
+
+
+def read_ipk_manifest(zip_fd: zipfile.ZipFile, manifest=None):
+    """
+        读取ipk中的文件夹、文件以及文件的CRC32与SHA-256，合并到信息表中
+    :param zip_fd: 已经打开的ipk文件包
+    :param manifest: 已有的（部分的）信息表，其中已经记录的条目不会重复记录
+    :return:
+    """
+    if manifest is None:
+        manifest = new_manifest()
+
+    recorded = set(manifest['path'])
+    recorded.update(manifest['file'])
+
+    for info in zip_fd.infolist():
+        if info.filename in recorded:
+            continue
+        # 记录文件或者文件夹的路径
+        if info.is_dir():
+            manifest['path'].append(info.filename)
+        else:
+            manifest['file'].append(info.filename)
+            # 记录文件的CRC32
+            manifest['crc32'][info.filename] = info.CRC
+            # 没有信息表文件的旧包，只能读出文件来计算SHA-256
+            manifest['sha256'][info.filename] = hashlib.sha256(zip_fd.read(info)).hexdigest()
+
+    return manifest
+
+
+class IpkWriter:
+    """
+        在已有的ipk文件包（标准包或者基础包）之上追加条目，
+        整个构建过程中ipk只打开一次，不再为每个步骤重新解析和重写压缩包目录
+    """
+
+    def __init__(self, ipk_file, base_manifest=None, mode="a", pool=None):
+        """
+            打开ipk文件包
+        :param ipk_file: ipk文件，一般是复制出来的标准包或者基础包
+        :param base_manifest: 标准包或者基础包中已经记录好的部分信息表，为None时读取已有的条目
+        :param mode: 打开的方式，a为追加，w为新建
+        :param pool: 压缩条目的线程池，为None时使用共用的线程池
+        """
+        self.ipk_file = ipk_file
+        self.zip_fd = zipfile.ZipFile(ipk_file, mode=mode, compression=zipfile.ZIP_DEFLATED)
+        self.names = set(self.zip_fd.NameToInfo.keys())
+        self.pool = pool or COMPRESS_POOL
+        # 正在压缩或者等待写入的条目，按照提交的顺序排列
+        self.pending = []
+
+        self.manifest = new_manifest()
+        if base_manifest is not None:
+            # 基础包中已经记录的条目直接复用，只需要补充信息表之外的条目
+            merge_manifest(self.manifest, base_manifest)
+        read_ipk_manifest(self.zip_fd, self.manifest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # 出现异常的时候，不需要再写入还没写入的条目
+            for _, task in self.pending:
+                task.cancel()
+            self.pending.clear()
+        self.close()
+
+    def exists(self, name):
+        """
+            判断ipk中是否已经存在（或者即将写入）某个条目
+        :param name:
+        :return:
+        """
+        return name in self.names
+
+    def record(self, info: zipfile.ZipInfo, sha256=None):
+        """
+            记录刚写入的条目到信息表中
+        :param info:
+        :param sha256: 文件的SHA-256
+        :return:
+        """
+        if info.is_dir():
+            self.manifest['path'].append(info.filename)
+        else:
+            self.manifest['file'].append(info.filename)
+            self.manifest['crc32'][info.filename] = info.CRC
+            self.manifest['sha256'][info.filename] = sha256
+
+    def submit(self, info: zipfile.ZipInfo, data):
+        """
+            提交一个条目到线程池中压缩
+        :param info: 条目的信息
+        :param data: 未压缩的数据
+        :return:
+        """
+        info.file_size = len(data)
+        self.names.add(info.filename)
+        self.pending.append((info, self.pool.submit(compress_entry, data, info.compress_type)))
+        if len(self.pending) > COMPRESS_WINDOW:
+            self.flush(False)
+
+    def write_compressed(self, info: zipfile.ZipInfo, data, crc, sha256):
+        """
+            将已经压缩好的数据写入压缩包，写入的内容与zipfile自己压缩写入的完全一致
+        :param info: 条目的信息
+        :param data: 已经压缩好的数据
+        :param crc: 未压缩的数据的CRC32
+        :param sha256: 未压缩的数据的SHA-256
+        :return:
+        """
+        zip_fd = self.zip_fd
+        info.flag_bits = 0x00
+        info.compress_size = len(data)
+        info.CRC = crc
+        zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        with zip_fd._lock:
+            zip_fd.fp.seek(zip_fd.start_dir)
+            info.header_offset = zip_fd.fp.tell()
+            zip_fd._writecheck(info)
+            zip_fd._didModify = True
+            zip_fd.fp.write(info.FileHeader(zip64))
+            zip_fd.fp.write(data)
+            zip_fd.start_dir = zip_fd.fp.tell()
+            zip_fd.filelist.append(info)
+            zip_fd.NameToInfo[info.filename] = info
+        self.record(info, sha256)
+
+    def flush(self, wait=True):
+        """
+            按照提交的顺序写入压缩完成的条目
+        :param wait: 是否等待所有的条目压缩完成，为False时只写入前面已经压缩完成的条目
+        :return:
+        """
+        while len(self.pending) > 0:
+            info, task = self.pending[0]
+            if not wait and not task.done() and len(self.pending) <= COMPRESS_WINDOW:
+                break
+            data, crc, sha256 = task.result()
+            self.pending.pop(0)
+            self.write_compressed(info, data, crc, sha256)
+
+    def write(self, file_path, name):
+        """
+            写入一个磁盘上的文件
+        :param file_path: 文件的路径
+        :param name: 在ipk中存放的位置
+        :return:
+        """
+        info = zipfile.ZipInfo.from_file(file_path, name)
+        if info.is_dir():
+            # 文件夹没有数据，按顺序直接写入
+            self.flush()
+            self.zip_fd.write(file_path, name)
+            self.names.add(info.filename)
+            self.record(self.zip_fd.filelist[-1])
+            return
+
+        info.compress_type = zipfile.ZIP_DEFLATED
+        # 文件需要马上读取，调用者可能会在写入之后立即删除文件
+        with open(file_path, "rb") as fd:
+            self.submit(info, fd.read())
+
+    def writestr(self, name, data, compress_type=None):
+        """
+            写入一段数据
+        :param name: 在ipk中存放的位置
+        :param data: 数据
+        :param compress_type: 压缩方式，为None时使用默认的压缩方式
+        :return:
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        info = zipfile.ZipInfo(filename=name, date_time=time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress_type is None else compress_type
+        if info.filename[-1] == '/':
+            info.external_attr = 0o40775 << 16  # drwxrwxr-x
+            info.external_attr |= 0x10  # MS-DOS directory flag
+        else:
+            info.external_attr = 0o600 << 16  # ?rw-------
+        self.submit(info, data)
+
+    def write_manifest(self, infos):
+        """
+            将信息表写入ipk，信息表必须是最后一个写入的条目
+        :param infos: 包信息，其中的manifest将会合并已经写入的所有条目
+        :return:
+        """
+        self.flush()
+        infos['manifest'].update(self.manifest)
+        infos['manifest']['digest'] = get_package_digest(self.manifest)
+        # 设备端一直以来收到的信息表都是不压缩的，保持不变
+        self.zip_fd.writestr(MANIFEST_FILE, json.dumps(infos), zipfile.ZIP_STORED)
+
+    def close(self):
+        """
+            写入剩余的条目并且关闭ipk文件包，此时才会生成压缩包目录
+        :return:
+        """
+        if self.zip_fd is not None:
+            try:
+                self.flush()
+            finally:
+                self.zip_fd.close()
+                self.zip_fd = None
+
+
+def benchmark(file_count=400, file_size=256 * 1024):
+    """
+        对比zipfile串行压缩与不同线程数下并行压缩组装ipk的耗时，
+        同时校验并行压缩的输出与串行压缩的输出是否完全一致
+    :param file_count: 测试文件的数量
+    :param file_size: 单个测试文件的大小
+    :return:
+    """
+    import random
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = []
+        rand = random.Random(0)
+        words = [bytes(rand.choices(range(256), k=rand.randint(2, 12))) for _ in range(512)]
+        for i in range(file_count):
+            # 生成压缩率接近so文件的测试数据
+            data = b"".join(rand.choices(words, k=file_size // 7))[:file_size]
+            file = os.path.join(tmp_dir, f"{i}.so")
+            with open(file, "wb") as fd:
+                fd.write(data)
+            files.append(file)
+
+        serial_file = os.path.join(tmp_dir, "serial.ipk")
+        start = time.perf_counter()
+        with zipfile.ZipFile(serial_file, mode="w", compression=zipfile.ZIP_DEFLATED) as zip_fd:
+            for file in files:
+                zip_fd.write(file, "lib/" + os.path.basename(file))
+        serial_time = time.perf_counter() - start
+        with open(serial_file, "rb") as fd:
+            serial_data = fd.read()
+        print(f"zipfile 串行: {serial_time:.3f}s")
+
+        workers = 1
+        while True:
+            parallel_file = os.path.join(tmp_dir, f"parallel_{workers}.ipk")
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                start = time.perf_counter()
+                with IpkWriter(parallel_file, mode="w", pool=pool) as ipk_writer:
+                    for file in files:
+                        ipk_writer.write(file, "lib/" + os.path.basename(file))
+                parallel_time = time.perf_counter() - start
+            with open(parallel_file, "rb") as fd:
+                same = fd.read() == serial_data
+            print(f"IpkWriter {workers} 线程: {parallel_time:.3f}s, "
+                  f"加速比: {serial_time / parallel_time:.2f}, 输出一致: {same}")
+
+            if workers >= (os.cpu_count() or 1):
+                break
+            workers = min(workers * 2, os.cpu_count() or 1)
+
+
+if __name__ == '__main__':
+    benchmark()
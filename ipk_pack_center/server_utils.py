@@ -0,0 +1,60 @@
+"""
+    服务端用到的一些工具实现
+    打包器与编译服务器共用，与 generator_utils 一样由其他工程直接导入
+"""
+import os
+
+from flask import request, current_app
+
+# 下载时每次发送的块大小，过小的块会带来大量的系统调用与WSGI迭代开销
+SEND_CHUNK_SIZE = 1024 * 1024
+
+
+def make_file_response(file, name, etag=None, on_complete=None):
+    """
+        以固定的大块发送文件，提供 Content-Length 与 ETag，
+        支持单个 Range 的断点续传，If-Range 与 ETag 不一致时发送完整的文件
+    :param file: 要发送的文件
+    :param name: 下载时的文件名
+    :param etag: 文件的强校验标签，为None时不接受 If-Range
+    :param on_complete: 文件的最后一个字节发送完成后的回调，客户端中途断开时不会调用
+    :return:
+    """
+    size = os.path.getsize(file)
+    start, stop = 0, size
+    status = 200
+
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) or (etag is not None and if_range.etag == etag):
+            content_range = byte_range.range_for_length(size)
+            if content_range is None:
+                r = current_app.response_class(status=416)
+                r.headers.set('Content-Range', f"bytes */{size}")
+                return r
+            start, stop = content_range
+            status = 206
+
+    def generate():
+        with open(file, mode='rb') as f:
+            f.seek(start)
+            remain = stop - start
+            while remain > 0:
+                data = f.read(min(SEND_CHUNK_SIZE, remain))
+                if not data:
+                    break
+                remain -= len(data)
+                yield data
+        if stop == size and on_complete is not None:
+            on_complete()
+
+    r = current_app.response_class(generate(), status=status, mimetype='application/octet-stream')
+    r.headers.set('Content-Disposition', 'attachment', filename=name)
+    r.headers.set('Content-Length', str(stop - start))
+    r.headers.set('Accept-Ranges', 'bytes')
+    if status == 206:
+        r.headers.set('Content-Range', f"bytes {start}-{stop - 1}/{size}")
+    if etag is not None:
+        r.set_etag(etag)
+    return r
@@ -3,18 +3,27 @@
 """
 
 import os
+import re
 import hashlib
+import io
 import json
 import logging
+import multiprocessing
 import shutil
+import subprocess
 import tempfile
 import threading
 import time
+import zipfile
 
 import requests
 
-from queue import Queue
-from flask import Flask, request, send_file
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from flask import Flask, request, current_app
+
+import server_utils
 
 
 class TaskQueue(Queue):
@@ -30,6 +39,26 @@ class TaskQueue(Queue):
                     return True
             return False
 
+    def remove(self, codes):
+        """
+            从队列中移除包含指定MD5的任务
+        :param codes: 需要移除的任务的MD5集合
+        :return: 被移除的任务中的MD5列表
+        """
+        removed = []
+        with self.mutex:
+            for item in list(self.queue):
+                if any(code in codes for code in item):
+                    self.queue.remove(item)
+                    removed.extend(item.keys())
+                    # 移除的任务不会再调用 task_done
+                    self.unfinished_tasks -= 1
+            if len(removed) > 0:
+                self.not_full.notify_all()
+                if self.unfinished_tasks == 0:
+                    self.all_tasks_done.notify_all()
+        return removed
+
 
 TITLE = "ICopy-X 分布式编译集群服务端 by DXL"
 FLASK_APP = Flask(__name__)
@@ -47,6 +76,10 @@ TIPS = f"""
 
     {ADDR}:{PORT}/count -> 查询当前的任务计数
 
+    {ADDR}:{PORT}/max -> 查询当前的任务上限数
+
+    {ADDR}:{PORT}/state -> 以json的格式查询运行中、排队中以及因为队列已满而被拒绝的任务数
+
     {ADDR}:{PORT}/up -> 表单类型，向此url提交一个py文件，
                             将自动获取其MD5并且返回，
                             同时开启一个编译任务。
@@ -55,10 +88,39 @@ TIPS = f"""
                             将自动查询运行时的任务列表，如果未发现
                             将自动查询输出目录下是否有相同MD5的文件
 
+    {ADDR}:{PORT}/wait?code=MD5&timeout=30 -> 阻塞等待一个任务完成，
+                            完成时立即返回True，超时返回False，
+                            编译出错（源码或者编译器报错）时返回error，
+                            任务被拒绝或者被取消时返回failed
+
     {ADDR}:{PORT}/down?code=MD5 -> 下载一个资源，
                             如果该资源已经完成处理
+
+    {ADDR}:{PORT}/up_batch -> 表单类型，向此url一次性提交多个py文件(表单名称为files)，
+                            将以json的格式返回 文件名 -> MD5 的映射，
+                            同时为每个文件开启一个编译任务。
+
+    以上的上传接口都可以附带 owner=构建ID 参数，/cancel 只会取消所有请求者都已经取消的任务
+
+    {ADDR}:{PORT}/down_batch?codes=MD5,MD5 -> 以zip压缩包的形式一次性下载多个资源，边打包边发送，
+                            压缩包中的文件以 MD5.so 命名，未完成处理的资源不会被打包
+
+    {ADDR}:{PORT}/toolchain -> 查询当前的编译工具链的指纹
+
+    {ADDR}:{PORT}/has?code=MD5&tc=指纹 -> 查询是否已经存在以该指纹的工具链
+                            编译完成的资源，存在的话可以直接下载
+
+    {ADDR}:{PORT}/has?codes=MD5,MD5&tc=指纹 -> 一次性查询多个资源（也可以以表单提交），
+                            以json的格式返回其中已经存在的资源的MD5列表
+
+    {ADDR}:{PORT}/stats -> 以json的格式返回每个编译任务的耗时统计，
+                            以及cython工作进程的回收情况、运行中与排队中（包括等待名额）的任务数
                             
                             
+    {ADDR}:{PORT}/cancel?codes=MD5,MD5&owner=构建ID -> 取消一个构建请求的还没有开始编译的任务，
+                            其他构建仍然需要的任务不会被取消，
+                            返回被取消的任务的MD5，等待这些任务的请求会得到failed
+
     {ADDR}:{PORT}/del?code=MD5 -> 删除一个资源，请注意并发使用文件的问题！
                    
 """.strip()
@@ -84,16 +146,33 @@ ROOT_PATH = "output"
 VAR_COMPILER_TASK_COUNT_LOCK = threading.RLock()
 VAR_COMPILER_TASK_COUNT = 0  # 当前在运行的任务个数
 
-# 任务队列
-QUEUE_TASK = TaskQueue()
+# 任务队列，队列满了之后新的任务会被拒绝
+QUEUE_TASK_MAX = 1024
+QUEUE_TASK = TaskQueue(maxsize=QUEUE_TASK_MAX)
+VAR_COMPILER_REJECTED_COUNT = 0  # 因为队列已满而被拒绝的任务个数
+VAR_COMPILER_WAITING_COUNT = 0  # 已经从队列中取出，正在等待编译名额的任务个数
 
 # 存放当前编译状态的列表
 STATE_LOCK = threading.RLock()
 STATE_TASK = set()  # 操作状态列表时需要持有的锁
+STATE_RUNNING = set()  # 已经开始编译的任务，不能再被取消
+# 任务的MD5 -> 请求了此任务的构建ID集合，只有所有的请求者都取消时任务才会被取消，
+# 没有携带构建ID的上传记录为 TASK_OWNER_ANONYMOUS，这样的任务不会被取消
+STATE_OWNERS = dict()
+TASK_OWNER_ANONYMOUS = ""
+# 任务完成时通知所有正在阻塞等待的请求
+STATE_CONDITION = threading.Condition(STATE_LOCK)
+# 编译失败（源码或者编译器报错）的任务的MD5，等待的请求会得到error而不是failed，
+# 客户端不需要在其他服务器上重试同样的源码，重新上传时清除
+STATE_ERRORS = OrderedDict()
+STATE_ERRORS_MAX = 1024
+# 阻塞等待任务完成的最长时间(s)
+WAIT_TIMEOUT_MAX = 60
 
 # 存放编译信息的配置文件
 JSON_LOCK = threading.RLock()  # 操作json文件时需要持有的锁
 PY_INFO_FILE = os.path.join(ROOT_PATH, "config", "py_file_map.json")
+BUILD_INFO_FILE = os.path.join(ROOT_PATH, "config", "build_file_map.json")
 SETTING_FILE = os.path.join(ROOT_PATH, "config", "setting_map.json")
 KEY_TASK_MAX = "task_max"
 KEY_TOOLS_PATH = "tools_path"
@@ -103,6 +182,42 @@ DEFAULT_PATH_TOOLS = os.path.join(ROOT_PATH, "arm-gcc")
 DEFAULT_PATH_UPLOAD = os.path.join(ROOT_PATH, "upload")
 DEFAULT_PATH_OUTPUT = os.path.join(ROOT_PATH, "build")
 
+# 编译参数，参与工具链指纹的计算
+CYTHON_FLAGS = "-3 -D -X emit_code_comments=False"
+GCC_FLAGS = "-shared -pthread -fPIC -fwrapv -O3 -w -fno-strict-aliasing"
+
+# 工具链指纹，第一次使用时计算
+TOOLCHAIN_FINGERPRINT_LOCK = threading.RLock()
+TOOLCHAIN_FINGERPRINT = None
+
+# 常驻的cython工作进程，单个进程处理一定数量的任务或者内存占用过高后回收，
+# 进程内编译省去了每个文件启动解释器与导入cython的时间，回收进程可以控制住cython的内存泄漏
+CYTHON_WORKER_LOCK = threading.RLock()
+CYTHON_WORKER_IDLE = list()
+CYTHON_WORKER_TASKS_MAX = 50
+CYTHON_WORKER_RSS_MAX = 512 * 1024 * 1024
+# 单个文件在工作进程中编译的最长时间(s)，超时的进程会被杀死
+CYTHON_WORKER_TIMEOUT = 120
+# 工作进程中无法导入cython的时候不再启动工作进程，直接使用命令行编译
+CYTHON_WORKER_DISABLED = False
+
+# 接收上传时每次读取的块大小，上传的文件边读取边计算MD5并写入磁盘，内存占用与文件大小无关
+RECV_CHUNK_SIZE = 1024 * 1024
+
+# 编译任务的耗时统计
+STATS_LOCK = threading.RLock()
+STATS_RECENT = deque(maxlen=100)
+STATS_TOTAL = {
+    "tasks": 0,
+    "worker_tasks": 0,
+    "cmd_tasks": 0,
+    "cython_time": 0.0,
+    "gcc_time": 0.0,
+    "total_time": 0.0,
+    "worker_started": 0,
+    "worker_recycled": 0,
+}
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 LOGGER = logging.getLogger(__name__)
 
@@ -146,6 +261,20 @@ def get_kv_data(key, value=None, file=PY_INFO_FILE):
     return value
 
 
+def get_kv_datas(file=PY_INFO_FILE):
+    """
+        获取所有的键值对数值
+    :param file:
+    :return:
+    """
+    make_sure_dir_exists(os.path.dirname(file))
+    if os.path.exists(file):
+        with JSON_LOCK:
+            with open(file, 'r') as f:
+                return json.load(f)
+    return dict()
+
+
 def save_kv_data(key, value, file=PY_INFO_FILE):
     """
         保存键值对数值
@@ -186,6 +315,10 @@ def save_kv_data(key, value, file=PY_INFO_FILE):
 
 VAR_COMPILER_MAX = get_kv_data(KEY_TASK_MAX, os.cpu_count(), SETTING_FILE)  # 编译器的运行时任务上限
 
+# 编译线程池，同时运行的任务由信号量限制，避免任务堆积在线程池内部的无界队列中
+COMPILER_EXECUTOR = ThreadPoolExecutor(max_workers=VAR_COMPILER_MAX, thread_name_prefix="compiler_")
+COMPILER_SLOTS = threading.BoundedSemaphore(VAR_COMPILER_MAX)
+
 VAR_COMPILER_PATH = get_kv_data(KEY_TOOLS_PATH, DEFAULT_PATH_TOOLS, SETTING_FILE)  # 编译器的目录
 
 VAR_COMPILER_UPLOAD = get_kv_data(KEY_UPLOAD_PATH, DEFAULT_PATH_UPLOAD, SETTING_FILE)  # 上传到服务器的文件的保存目录
@@ -206,6 +339,31 @@ def is_cc_exists():
     return os.path.exists(cc)
 
 
+def get_toolchain_fingerprint():
+    """
+        获取编译工具链的指纹
+        由cython与gcc的版本信息以及编译参数计算而来，
+        工具链或者编译参数变化后，之前编译的资源将不会被复用
+    :return:
+    """
+    global TOOLCHAIN_FINGERPRINT
+    with TOOLCHAIN_FINGERPRINT_LOCK:
+        if TOOLCHAIN_FINGERPRINT is None:
+            cc = os.path.join(os.path.abspath(VAR_COMPILER_PATH), "bin", "arm-linux-gnueabihf-gcc.exe")
+            versions = []
+            for cmd in (["cython", "--version"], [cc, "--version"]):
+                try:
+                    process = subprocess.run(cmd, capture_output=True)
+                    versions.append((process.stdout + process.stderr).decode(errors="ignore").strip())
+                except Exception as e:
+                    LOGGER.warning(f"获取工具链版本失败: {e}")
+                    versions.append("")
+            versions.append(CYTHON_FLAGS)
+            versions.append(GCC_FLAGS)
+            TOOLCHAIN_FINGERPRINT = get_md5_for_data("\n".join(versions).encode())
+        return TOOLCHAIN_FINGERPRINT
+
+
 def task_count_increment():
     with VAR_COMPILER_TASK_COUNT_LOCK:
         global VAR_COMPILER_TASK_COUNT
@@ -224,6 +382,39 @@ def get_task_count():
         return VAR_COMPILER_TASK_COUNT
 
 
+def task_waiting_increment():
+    with VAR_COMPILER_TASK_COUNT_LOCK:
+        global VAR_COMPILER_WAITING_COUNT
+        VAR_COMPILER_WAITING_COUNT += 1
+
+
+def task_waiting_decrement():
+    with VAR_COMPILER_TASK_COUNT_LOCK:
+        global VAR_COMPILER_WAITING_COUNT
+        VAR_COMPILER_WAITING_COUNT -= 1
+
+
+def get_queue_count():
+    """
+        排队中的任务数，包括已经从队列中取出但是还在等待编译名额的任务
+    :return:
+    """
+    with VAR_COMPILER_TASK_COUNT_LOCK:
+        return QUEUE_TASK.qsize() + VAR_COMPILER_WAITING_COUNT
+
+
+def task_rejected_increment():
+    with VAR_COMPILER_TASK_COUNT_LOCK:
+        global VAR_COMPILER_REJECTED_COUNT
+        VAR_COMPILER_REJECTED_COUNT += 1
+
+
+def get_rejected_count():
+    with VAR_COMPILER_TASK_COUNT_LOCK:
+        global VAR_COMPILER_REJECTED_COUNT
+        return VAR_COMPILER_REJECTED_COUNT
+
+
 def start_flask_api():
     """
         启动flask以提供api功能
@@ -342,12 +533,248 @@ def is_task_exists(code, name):
     return b1 or b2
 
 
-def compile2_c(file, target_path=None):
+def get_process_rss_windows():
+    """
+        在Windows下通过 GetProcessMemoryInfo 获取当前进程的工作集大小
+    :return: 内存占用的字节数，无法获取时返回0
+    """
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    kernel32 = ctypes.WinDLL("kernel32")
+    # Windows 7 之后由kernel32提供，更早的系统只有psapi中的版本
+    get_memory_info = getattr(kernel32, "K32GetProcessMemoryInfo", None)
+    if get_memory_info is None:
+        get_memory_info = ctypes.WinDLL("psapi").GetProcessMemoryInfo
+    get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    get_memory_info.restype = wintypes.BOOL
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    if not get_memory_info(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return 0
+    return counters.WorkingSetSize
+
+
+def get_process_rss():
+    """
+        获取当前进程的内存占用，没有安装psutil的话，
+        Windows下使用 GetProcessMemoryInfo，其他系统使用resource获取峰值内存
+    :return: 内存占用的字节数，无法获取时返回0
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if os.name == "nt":
+        try:
+            return get_process_rss_windows()
+        except (OSError, AttributeError):
+            return 0
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+def run_cython_worker(conn, parent_pid):
+    """
+        cython工作进程的主循环，在进程内编译py文件为.c
+        参数与命令行的 CYTHON_FLAGS 保持一致
+    :param conn: 与主进程通信的管道
+    :param parent_pid: 主进程的pid，主进程退出后工作进程也随之退出
+    :return:
+    """
+    try:
+        import Cython.Compiler.Options
+        from Cython.Compiler.Main import compile as cython_compile, CompilationOptions, default_options
+    except ImportError as e:
+        conn.send((None, f"cython不可用: {e}", 0))
+        return
+
+    Cython.Compiler.Options.docstrings = False  # -D
+    Cython.Compiler.Options.embed_pos_in_docstring = False
+
+    while True:
+        if not conn.poll(5):
+            if os.getppid() != parent_pid:
+                break
+            continue
+        task = conn.recv()
+        if task is None:
+            break
+        file, out_file = task
+        try:
+            options = CompilationOptions(
+                default_options,
+                language_level=3,  # -3
+                output_file=out_file,
+                compiler_directives={"emit_code_comments": False},  # -X emit_code_comments=False
+            )
+            result = cython_compile(file, options)
+            conn.send((result.num_errors == 0, None, get_process_rss()))
+        except Exception as e:
+            conn.send((False, str(e), get_process_rss()))
+
+
+class CythonWorker:
+    """
+        常驻的cython工作进程
+    """
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_cython_worker, args=(child_conn, os.getpid()), daemon=True)
+        self.process.start()
+        self.tasks = 0
+        self.rss = 0
+        with STATS_LOCK:
+            STATS_TOTAL["worker_started"] += 1
+
+    def compile(self, file, out_file):
+        """
+            在工作进程中编译文件
+        :param file:
+        :param out_file:
+        :return: 是否编译成功
+        """
+        self.conn.send((file, out_file))
+        if not self.conn.poll(CYTHON_WORKER_TIMEOUT):
+            raise Exception(f"cython工作进程编译超时: {file}")
+        ok, error, self.rss = self.conn.recv()
+        self.tasks += 1
+        if ok is None:
+            global CYTHON_WORKER_DISABLED
+            CYTHON_WORKER_DISABLED = True
+        if error is not None:
+            LOGGER.warning(f"cython工作进程编译失败: {error}")
+        return bool(ok)
+
+    def is_expired(self):
+        """
+            判断工作进程是否需要回收
+        :return:
+        """
+        return (not self.process.is_alive() or
+                self.tasks >= CYTHON_WORKER_TASKS_MAX or
+                self.rss >= CYTHON_WORKER_RSS_MAX)
+
+    def close(self):
+        """
+            关闭工作进程
+        :return:
+        """
+        try:
+            if self.process.is_alive():
+                self.conn.send(None)
+                self.process.join(1)
+        except Exception as e:
+            LOGGER.info(f"关闭cython工作进程异常: {e}")
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+        with STATS_LOCK:
+            STATS_TOTAL["worker_recycled"] += 1
+
+
+def acquire_cython_worker():
+    """
+        获取一个空闲的cython工作进程，没有的话启动一个新的
+    :return:
+    """
+    with CYTHON_WORKER_LOCK:
+        if len(CYTHON_WORKER_IDLE) > 0:
+            return CYTHON_WORKER_IDLE.pop()
+    return CythonWorker()
+
+
+def release_cython_worker(worker, broken=False):
+    """
+        归还cython工作进程，处理的任务数量或者内存占用超出限制的进程将被回收
+    :param worker:
+    :param broken: 工作进程是否已经不可用
+    :return:
+    """
+    if broken or worker.is_expired():
+        LOGGER.info(f"回收cython工作进程，已处理任务: {worker.tasks}，内存占用: {worker.rss}")
+        worker.close()
+        return
+    with CYTHON_WORKER_LOCK:
+        CYTHON_WORKER_IDLE.append(worker)
+
+
+def compile2_c_worker(file, out_file):
+    """
+        在常驻的cython工作进程中编译python文件为.c
+    :param file:
+    :param out_file:
+    :return: 是否编译成功
+    """
+    if CYTHON_WORKER_DISABLED:
+        return False
+    worker = acquire_cython_worker()
+    broken = False
+    try:
+        return worker.compile(file, out_file)
+    except Exception as e:
+        LOGGER.warning(f"cython工作进程异常: {e}")
+        broken = True
+        return False
+    finally:
+        release_cython_worker(worker, broken)
+
+
+def record_task_stats(code, name, mode, cython_time, gcc_time, total_time):
+    """
+        记录一个编译任务的耗时
+    :param code:
+    :param name:
+    :param mode: 编译为.c时使用的方式，worker或者cmd
+    :param cython_time:
+    :param gcc_time:
+    :param total_time:
+    :return:
+    """
+    with STATS_LOCK:
+        STATS_RECENT.append({
+            "code": code,
+            "name": name,
+            "mode": mode,
+            "cython": round(cython_time, 3),
+            "gcc": round(gcc_time, 3),
+            "total": round(total_time, 3),
+        })
+        STATS_TOTAL["tasks"] += 1
+        STATS_TOTAL[f"{mode}_tasks"] += 1
+        STATS_TOTAL["cython_time"] += cython_time
+        STATS_TOTAL["gcc_time"] += gcc_time
+        STATS_TOTAL["total_time"] += total_time
+
+
+def compile2_c(file, target_path=None, use_worker=True):
     """
         编译python文件为.c
     :param target_path:
     :param file:
-    :return:
+    :param use_worker: 优先在常驻的工作进程中编译，失败的时候再使用命令行编译
+    :return: 输出的文件以及使用的编译方式
     """
     # """
     #     Cython.Compiler.Options.docstrings = False | -D
@@ -364,6 +791,11 @@ def compile2_c(file, target_path=None):
     if os.path.exists(out_file):
         os.remove(out_file)
 
+    # 进程内编译会内存泄漏，所以放在会定期回收的工作进程中进行
+    if use_worker and compile2_c_worker(file, out_file):
+        if os.path.exists(out_file) and (os.path.getsize(out_file) > 0):
+            return out_file, "worker"
+
     # 这个实现会内存泄漏，具体原因未知，但我们无法继续使用此实现
     # ret = list()
     #
@@ -404,15 +836,15 @@ def compile2_c(file, target_path=None):
     #     return ret[0]
     # return ret
 
-    final_cmd = 'cython -3 -D -X emit_code_comments=False {} -o {}'.format(file, out_file)
+    final_cmd = 'cython {} {} -o {}'.format(CYTHON_FLAGS, file, out_file)
     # subprocess.run(
     #     cmd,
     #     shell=True,
     # )
     os.system(final_cmd)
     if os.path.exists(out_file) and (os.path.getsize(out_file) > 0):
-        return out_file
-    return None
+        return out_file, "cmd"
+    return None, "cmd"
 
 
 def compile2_so(file, target_path=None):
@@ -437,10 +869,11 @@ def compile2_so(file, target_path=None):
     header_sys = os.path.join(header_inc, "sys")
     # sysroot = toolchain_dir + r"arm-linux-gnueabihf\\libc"
 
-    compile_cmd = cc + " -I{} -I{} -I{} -shared -pthread -fPIC -fwrapv -O3 -w -fno-strict-aliasing".format(
+    compile_cmd = cc + " -I{} -I{} -I{} {}".format(
         header_inc,
         header_sys,
         header_py,
+        GCC_FLAGS,
     )
 
     name = os.path.basename(file).split(".")[0]
@@ -478,24 +911,57 @@ def build_impl(code, name, sources, so_target_path):
 
     # 使用临时文件夹进行编译
     with tempfile.TemporaryDirectory() as temp_path:
+        time_start = time.time()
         # 第零，先移动资源到临时目录并且重命名
         sources = shutil.copyfile(sources, os.path.join(temp_path, name))
         # 第一，先编译该文件为.c
-        csource = compile2_c(sources, temp_path)
+        csource, mode = compile2_c(sources, temp_path)
+        time_cython = time.time()
         # 第二，编译该文件为.so
         ssource = compile2_so(csource, temp_path)
+        time_gcc = time.time()
+        record_task_stats(code, name, mode, time_cython - time_start, time_gcc - time_cython, time_gcc - time_start)
         # 第四，移动到指定的输出目录，以指定的文件名格式
         so_path = os.path.join(so_target_path, create_md5_file_name(code))
         if not os.path.exists(so_path):
-            if ssource is not None:
+            if ssource is not None and os.path.exists(ssource):
                 shutil.move(ssource, so_path)
+                # 记录编译该资源时使用的工具链指纹
+                save_kv_data(code, get_toolchain_fingerprint(), BUILD_INFO_FILE)
         LOGGER.info(f"[+] 编译完成: {ssource} : {so_path}")
 
-    with STATE_LOCK:
-        if code in STATE_TASK:
-            STATE_TASK.remove(code)
 
-    task_count_decrement()
+def run_build_task(task):
+    """
+        在编译线程池中执行一个编译任务，
+        无论任务成功与否，都会释放占用的名额并且唤醒等待此任务的请求
+    :param task: md5 -> 文件名
+    :return:
+    """
+    try:
+        for code, name in task.items():
+            build_impl(code, name, get_upload_file(code, name), VAR_COMPILER_OUTPUT)
+    except Exception as e:
+        LOGGER.error(f"编译任务异常: {task}, {e}")
+    finally:
+        with STATE_LOCK:
+            for code in task.keys():
+                # 任务结束了但是没有产出运行库，说明编译出错
+                if not is_build_file_exists(code):
+                    STATE_ERRORS[code] = True
+                    STATE_ERRORS.move_to_end(code)
+                    while len(STATE_ERRORS) > STATE_ERRORS_MAX:
+                        STATE_ERRORS.popitem(last=False)
+                STATE_TASK.discard(code)
+                STATE_RUNNING.discard(code)
+                STATE_OWNERS.pop(code, None)
+            # 唤醒等待此任务的请求
+            STATE_CONDITION.notify_all()
+
+        task_count_decrement()
+        COMPILER_SLOTS.release()
+        # 设置任务完成标志位
+        QUEUE_TASK.task_done()
 
 
 def run_compiler_task():
@@ -505,33 +971,29 @@ def run_compiler_task():
     """
     while True:
         task: dict = QUEUE_TASK.get()
-
-        # 此处我们需要进行任务数量的限制
-        if get_task_count() >= VAR_COMPILER_MAX:
-            while get_task_count() >= VAR_COMPILER_MAX:
-                time.sleep(0.5)
-
-        LOGGER.info(f"开启一个信息的任务: {task}")
-
-        for code in task.keys():
-            name = task[code]
-            file = get_upload_file(code, task[code])
-            build_path = VAR_COMPILER_OUTPUT
-            p = threading.Thread(
-                target=build_impl,
-                args=(
-                    code,
-                    name,
-                    file,
-                    build_path,
-                )
-            )
-            p.start()
-
-        # 当前任务计数递增
+        # 等待名额的任务仍然算作排队中的任务
+        task_waiting_increment()
+
+        # 此处我们需要进行任务数量的限制，没有空闲的名额时任务继续留在队列中
+        COMPILER_SLOTS.acquire()
+
+        # 等待名额期间任务可能已经被取消
+        with STATE_LOCK:
+            cancelled = not any(code in STATE_TASK for code in task.keys())
+            if not cancelled:
+                STATE_RUNNING.update(task.keys())
+        if cancelled:
+            LOGGER.warning(f"任务已经被取消: {task}")
+            task_waiting_decrement()
+            COMPILER_SLOTS.release()
+            QUEUE_TASK.task_done()
+            continue
+
+        # 先计入运行中的任务再移出排队中的任务，任务在任何时候都能被统计到
         task_count_increment()
-        # 设置任务完成标志位
-        QUEUE_TASK.task_done()
+        task_waiting_decrement()
+        LOGGER.info(f"开启一个信息的任务: {task}")
+        COMPILER_EXECUTOR.submit(run_build_task, task)
 
 
 @FLASK_APP.route("/help")
@@ -554,7 +1016,7 @@ def flask_api_busy():
         返回当前的任务处理状态
     :return:
     """
-    return str(get_task_count() == VAR_COMPILER_MAX)
+    return str(get_task_count() >= VAR_COMPILER_MAX)
 
 
 @FLASK_APP.route("/count")
@@ -566,45 +1028,155 @@ def flask_api_count():
     return str(get_task_count())
 
 
-@FLASK_APP.route('/up', methods=['GET', 'POST'])
-def flask_api_up():
+@FLASK_APP.route("/state")
+def flask_api_state():
     """
-        接收上传的文件到服务器
+        返回当前的运行中的任务数、排队中的任务数以及被拒绝的任务数
     :return:
     """
-    if request.method == 'POST':
-        f = request.files['file']
-        if f is not None:
-            name = f.filename
-            data = f.read()
-            code = get_md5_for_data(data)
-            kv = {code: name}
+    return json.dumps({
+        "running": get_task_count(),
+        "max": VAR_COMPILER_MAX,
+        "queue": get_queue_count(),
+        "queue_max": QUEUE_TASK_MAX,
+        "rejected": get_rejected_count(),
+    })
 
-            # 判断一下当前是否已经存在相同的任务
-            if is_task_exists(code, name):
-                return code
 
-            # 添加到任务状态列表记录中
-            with STATE_LOCK:
-                STATE_TASK.add(code)
+@FLASK_APP.route("/max")
+def flask_api_max():
+    """
+        返回当前的任务上限数
+    :return:
+    """
+    return str(VAR_COMPILER_MAX)
 
-            # 我们以md5为文件名，避免文件名冲突
-            file = get_upload_file(code, name)
 
-            with open(file, "wb+") as fd:  # 写入到磁盘进行保存
+def spool_upload_stream(stream):
+    """
+        将上传的数据流分块写入上传目录中的临时文件，同时计算MD5
+    :param stream: 上传的数据流
+    :return: (文件的MD5, 临时文件)
+    """
+    make_sure_dir_exists(VAR_COMPILER_UPLOAD)
+    md5 = hashlib.md5()
+    fd = tempfile.NamedTemporaryFile(mode="wb", dir=VAR_COMPILER_UPLOAD, suffix=".part", delete=False)
+    try:
+        with fd:
+            for data in iter(lambda: stream.read(RECV_CHUNK_SIZE), b""):
+                md5.update(data)
                 fd.write(data)
+    except BaseException:
+        os.remove(fd.name)
+        raise
+    return md5.hexdigest(), fd.name
+
 
-            # 保存由md5码到原始文件名的唯一映射
-            save_kv_data(code, name)
-            # 然后提交一个编译任务
-            QUEUE_TASK.put(kv)
+def is_upload_name_valid(name):
+    """
+        上传的文件名只能是一个不带路径的py文件名
+    :param name:
+    :return:
+    """
+    return bool(name) and os.path.basename(name) == name and name.endswith(".py")
+
+
+def add_upload_task(name, stream, owner=None):
+    """
+        保存上传的文件并且开启一个编译任务
+    :param name: 文件名
+    :param stream: 文件内容的数据流
+    :param owner: 请求此任务的构建ID
+    :return: 文件的MD5，也就是任务的唯一标志
+    """
+    code, temp_file = spool_upload_stream(stream)
+    try:
+        return add_upload_file(name, code, temp_file, owner)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+
+def add_upload_file(name, code, temp_file, owner=None):
+    """
+        将已经写入磁盘的上传文件移动到上传目录并且开启一个编译任务
+    :param name: 文件名
+    :param code: 文件的MD5
+    :param temp_file: 上传的临时文件，任务已经存在时不会被移动
+    :param owner: 请求此任务的构建ID，为None时此任务不会被取消
+    :return: 文件的MD5，也就是任务的唯一标志
+    """
+    kv = {code: name}
+    owner = owner or TASK_OWNER_ANONYMOUS
+
+    # 任务还没有结束时记录新的请求者，与取消任务在同一个锁中判断，不会加入一个刚被取消的任务
+    with STATE_LOCK:
+        if code in STATE_TASK:
+            STATE_OWNERS.setdefault(code, set()).add(owner)
             return code
 
+    # 判断一下当前是否已经存在相同的任务
+    if is_task_exists(code, name):
+        return code
+
+    # 添加到任务状态列表记录中
+    with STATE_LOCK:
+        STATE_ERRORS.pop(code, None)
+        STATE_TASK.add(code)
+        STATE_OWNERS.setdefault(code, set()).add(owner)
+
+    # 我们以md5为文件名，避免文件名冲突
+    file = get_upload_file(code, name)
+    os.replace(temp_file, file)
+
+    # 保存由md5码到原始文件名的唯一映射
+    save_kv_data(code, name)
+    # 然后提交一个编译任务
+    try:
+        QUEUE_TASK.put_nowait(kv)
+    except Full:
+        # 队列已满，拒绝此任务，等待的客户端会立即得知任务失败并且换一个服务器
+        LOGGER.warning(f"任务队列已满，拒绝任务: {kv}")
+        task_rejected_increment()
+        with STATE_LOCK:
+            STATE_TASK.discard(code)
+            STATE_OWNERS.pop(code, None)
+            STATE_CONDITION.notify_all()
+    return code
+
+
+@FLASK_APP.route('/up', methods=['GET', 'POST'])
+def flask_api_up():
+    """
+        接收上传的文件到服务器
+    :return:
+    """
+    if request.method == 'POST':
+        f = request.files.get('file')
+        if f is None or not is_upload_name_valid(f.filename):
+            return "failed", 400
+        return add_upload_task(f.filename, f.stream, request.args.get('owner'))
+
     if request.method == 'GET':
         return UPLOAD_PAGE
     return "failed"
 
 
+@FLASK_APP.route('/up_batch', methods=['POST'])
+def flask_api_up_batch():
+    """
+        一次性接收多个上传的文件到服务器
+    :return: 文件名到MD5的映射
+    """
+    files = request.files.getlist('files')
+    if len(files) == 0 or not all(is_upload_name_valid(f.filename) for f in files):
+        return "failed", 400
+    codes = {}
+    for f in files:
+        codes[f.filename] = add_upload_task(f.filename, f.stream, request.args.get('owner'))
+    return json.dumps(codes)
+
+
 @FLASK_APP.route('/ok')
 def flask_api_ok():
     """
@@ -617,6 +1189,89 @@ def flask_api_ok():
     return str(False)
 
 
+@FLASK_APP.route('/wait')
+def flask_api_wait():
+    """
+        阻塞等待编译任务完成，任务完成的时候立即返回，
+        客户端不再需要间隔一段时间轮询一次
+    :return:
+    """
+    if request.method == "GET":
+        code = request.values['code']
+        timeout = min(float(request.values.get('timeout', WAIT_TIMEOUT_MAX)), WAIT_TIMEOUT_MAX)
+
+        def is_finished():
+            return is_build_file_exists(code) or code not in STATE_TASK
+
+        with STATE_CONDITION:
+            STATE_CONDITION.wait_for(is_finished, timeout)
+            if is_build_file_exists(code):
+                return str(True)
+            if code in STATE_ERRORS:
+                return "error"
+            if code not in STATE_TASK:
+                return "failed"
+        return str(False)
+    return str(False)
+
+
+@FLASK_APP.route('/toolchain')
+def flask_api_toolchain():
+    """
+        返回当前的编译工具链的指纹
+    :return:
+    """
+    return get_toolchain_fingerprint()
+
+
+@FLASK_APP.route('/has', methods=['GET', 'POST'])
+def flask_api_has():
+    """
+        判断是否已经存在编译完成的资源，
+        客户端在上传之前先以源码的MD5查询，命中时可以直接下载
+    :return:
+    """
+    if 'codes' in request.values:
+        codes = [code for code in request.values['codes'].split(",") if re.fullmatch(r"[0-9a-f]{32}", code)]
+        tc = request.values.get('tc', "")
+        codes = [code for code in dict.fromkeys(codes) if is_build_file_exists(code)]
+        # 指定了工具链指纹的话，只有用相同的工具链编译的资源才算命中，构建信息只需要读取一次
+        if len(tc) > 0:
+            build_info = get_kv_datas(BUILD_INFO_FILE)
+            codes = [code for code in codes if build_info.get(code) == tc]
+        return json.dumps(codes)
+    if request.method == "GET":
+        code = request.values['code']
+        tc = request.values.get('tc', "")
+        if not is_build_file_exists(code):
+            return str(False)
+        # 指定了工具链指纹的话，只有用相同的工具链编译的资源才算命中
+        if len(tc) > 0 and get_kv_data(code, file=BUILD_INFO_FILE) != tc:
+            return str(False)
+        return str(True)
+    return str(False)
+
+
+@FLASK_APP.route('/stats')
+def flask_api_stats():
+    """
+        返回编译任务的耗时统计
+    :return:
+    """
+    with STATS_LOCK:
+        total = dict(STATS_TOTAL)
+        recent = list(STATS_RECENT)
+    with CYTHON_WORKER_LOCK:
+        total["worker_idle"] = len(CYTHON_WORKER_IDLE)
+    count = max(total["tasks"], 1)
+    total["cython_avg"] = round(total["cython_time"] / count, 3)
+    total["gcc_avg"] = round(total["gcc_time"] / count, 3)
+    total["total_avg"] = round(total["total_time"] / count, 3)
+    total["running"] = get_task_count()
+    total["queue"] = get_queue_count()
+    return json.dumps({"total": total, "recent": recent})
+
+
 @FLASK_APP.route('/down')
 def flask_api_down():
     """
@@ -630,10 +1285,99 @@ def flask_api_down():
             if file is not None:
                 name = os.path.splitext(get_kv_data(code, "unknown"))[0]
                 suffix = os.path.splitext(os.path.basename(file))[1]
-                return send_file(file, as_attachment=True, attachment_filename=f"{name}{suffix}")
+                # 同一个MD5的so可能被不同的工具链重新编译，以修改时间与大小区分
+                stat = os.stat(file)
+                etag = f"{code}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+                return server_utils.make_file_response(file, f"{name}{suffix}", etag=etag)
     return "failed"
 
 
+class ZipStreamSink(io.RawIOBase):
+    """
+        不可定位的zip输出，写入的数据暂存在内存中，由下载的生成器逐个文件取出发送
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buffers = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffers.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        """
+            取出目前为止写入的数据
+        :return:
+        """
+        data = b"".join(self.buffers)
+        self.buffers.clear()
+        return data
+
+
+@FLASK_APP.route('/down_batch')
+def flask_api_down_batch():
+    """
+        以zip压缩包的形式一次性下载多个已经完成编译的资源，
+        压缩包边打包边发送，内存中最多只有一个资源
+    :return:
+    """
+    codes = request.values.get('codes', "")
+    codes = list(dict.fromkeys(code for code in codes.split(',') if re.fullmatch(r"[0-9a-f]{32}", code)))
+
+    def generate():
+        sink = ZipStreamSink()
+        # so文件本身压缩率不高，直接存储即可，省去压缩的时间
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as zip_fd:
+            for code in codes:
+                file = get_build_file(code) if is_build_file_exists(code) else None
+                if file is None:
+                    continue
+                try:
+                    zip_fd.write(file, f"{code}.so")
+                except FileNotFoundError:
+                    # 打包的过程中资源被删除了，当作没有完成处理
+                    continue
+                yield sink.take()
+        yield sink.take()
+
+    return current_app.response_class(generate(), mimetype='application/zip')
+
+
+@FLASK_APP.route('/cancel', methods=['GET', 'POST'])
+def flask_api_cancel():
+    """
+        取消一个构建请求的还没有开始编译的任务，正在编译的任务不受影响，
+        任务只有在所有请求过它的构建都取消之后才会被取消，等待被取消的任务的请求会立即得到failed
+    :return: 被取消的任务的MD5，以逗号分隔
+    """
+    owner = request.values.get('owner')
+    if not owner:
+        return "failed"
+    codes = set(filter(lambda item: len(item) > 0, request.values.get('codes', "").split(',')))
+    cancelled = []
+    with STATE_LOCK:
+        for code in codes:
+            owners = STATE_OWNERS.get(code)
+            if owners is None or owner not in owners:
+                continue
+            owners.discard(owner)
+            # 其他的构建仍然需要此任务时只移除请求者
+            if len(owners) == 0 and code in STATE_TASK and code not in STATE_RUNNING:
+                STATE_TASK.discard(code)
+                STATE_OWNERS.pop(code, None)
+                cancelled.append(code)
+        # 在锁中移除队列中的任务，同时进行的上传不会得到一个正在被移除的任务
+        QUEUE_TASK.remove(set(cancelled))
+        STATE_CONDITION.notify_all()
+    if len(cancelled) > 0:
+        LOGGER.warning(f"取消了 {len(cancelled)} 个任务")
+    return ",".join(cancelled)
+
+
 @FLASK_APP.route('/del')
 def flask_api_del():
     """
@@ -652,6 +1396,7 @@ def flask_api_del():
         code = request.values['code']
         file_so = get_build_file(code)
         file_py = get_upload_file(code)
+        save_kv_data(code, None, BUILD_INFO_FILE)
 
         if del_if_exists(file_so) or del_if_exists(file_py):
             return "success"
@@ -669,14 +1414,15 @@ def start_queue_loop():
     return thread
 
 
-def icc_request(action):
+def icc_request(action, params=None):
     """
         向网域控制器注册自己
+    :param params: 请求的附带参数
     :return:
     """
     url = f"http://127.0.0.1:6868/{action}"
     try:
-        with requests.get(url) as result:
+        with requests.get(url, params=params) as result:
             return result.content.decode()
     except Exception as e:
         LOGGER.info(f"网域控制器请求失败: {e}")
@@ -691,7 +1437,14 @@ def start_icc_register():
     def run_icc():
         # 进行ICC的注册，让打包器可以感知我们的存在
         while True:
-            icc_request("online")
+            # 随心跳上报当前的容量与负载，客户端不需要再逐个探测
+            icc_request("online", {
+                "cpu": os.cpu_count(),
+                "task_max": VAR_COMPILER_MAX,
+                "count": get_task_count(),
+                "queue": get_queue_count(),
+                "toolchain": get_toolchain_fingerprint(),
+            })
             time.sleep(1)
 
     thread = threading.Thread(target=run_icc)
@@ -720,6 +1473,11 @@ def start_compiler():
     if not is_cc_exists():
         raise Exception("默认的GCC不存在，请确保后续设置GCC，否则此服务端将不可用！")
 
+    # 无法获取内存占用的时候，cython工作进程的内存泄漏只能依靠任务数量的上限回收
+    if get_process_rss() == 0:
+        LOGGER.warning(f"无法获取进程的内存占用，cython工作进程的内存上限({CYTHON_WORKER_RSS_MAX})不会生效，"
+                       f"只按照处理的任务数({CYTHON_WORKER_TASKS_MAX})回收，建议安装psutil")
+
     start_icc_register()
 
     run_check_task()
@@ -730,4 +1488,6 @@ def start_compiler():
 
 
 if __name__ == '__main__':
+    # cython工作进程在打包后的程序中启动时需要
+    multiprocessing.freeze_support()
     start_compiler()